@@ -0,0 +1,139 @@
+"""
+ADMISSION CONTROL ДЛЯ WEBHOOK-СЕРВЕРА ROBOKASSA
+
+Каждое уведомление /robokassa/result занимает соединения из пула БД и делает
+вызовы Telegram. Без ограничения серия повторных уведомлений может занять
+весь пул и остановить обработчики бота.
+
+Для каждого маршрута из ADMISSION_LIMITS:
+- одновременно обрабатывается не больше max_concurrent запросов;
+- остальные ждут в очереди длиной не больше max_queue и не дольше
+  ADMISSION_QUEUE_TIMEOUT секунд;
+- при полной очереди или по таймауту запрос сразу получает 503 с Retry-After
+  (Robokassa повторит уведомление).
+
+Метрики (принято, отклонено, очередь, ожидание) - GET /robokassa/metrics
+в текстовом формате Prometheus (только если задан ADMIN_API_TOKEN, с токеном).
+"""
+import asyncio
+import hmac
+import time
+from typing import Dict
+from aiohttp import web
+from config import ADMISSION_LIMITS, ADMISSION_QUEUE_TIMEOUT, ADMIN_API_TOKEN
+
+# Через сколько секунд клиенту предлагается повторить отклоненный запрос
+RETRY_AFTER_SECONDS = 30
+
+
+class AdmissionController:
+    """Ограничение конкурентности маршрута с ограниченной очередью ожидания"""
+
+    def __init__(self, route: str, max_concurrent: int, max_queue: int, queue_timeout: float):
+        self.route = route
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self.active = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self.admitted = 0
+        self.shed_queue_full = 0
+        self.shed_timeout = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    async def acquire(self) -> bool:
+        """Занять слот; False - запрос нужно отклонить"""
+        if not self._semaphore.locked():
+            # Свободный слот и нет очереди - без ожидания
+            await self._semaphore.acquire()
+            self.active += 1
+            self.admitted += 1
+            return True
+        if self.waiting >= self.max_queue:
+            self.shed_queue_full += 1
+            return False
+
+        started = time.perf_counter()
+        self.waiting += 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.shed_timeout += 1
+            return False
+        finally:
+            self.waiting -= 1
+
+        waited = time.perf_counter() - started
+        self.wait_seconds_total += waited
+        self.wait_seconds_max = max(self.wait_seconds_max, waited)
+        self.active += 1
+        self.admitted += 1
+        return True
+
+    def release(self):
+        self.active -= 1
+        self._semaphore.release()
+
+    def metrics(self) -> Dict[str, float]:
+        return {
+            "admission_admitted_total": self.admitted,
+            "admission_shed_queue_full_total": self.shed_queue_full,
+            "admission_shed_timeout_total": self.shed_timeout,
+            "admission_active": self.active,
+            "admission_waiting": self.waiting,
+            "admission_waiting_max": self.max_waiting,
+            "admission_wait_seconds_total": round(self.wait_seconds_total, 6),
+            "admission_wait_seconds_max": round(self.wait_seconds_max, 6),
+            "admission_limit": self.max_concurrent,
+            "admission_queue_limit": self.max_queue,
+        }
+
+
+# Контроллеры по пути маршрута
+controllers: Dict[str, AdmissionController] = {
+    route: AdmissionController(route, max_concurrent, max_queue, ADMISSION_QUEUE_TIMEOUT)
+    for route, (max_concurrent, max_queue) in ADMISSION_LIMITS.items()
+}
+
+
+def route_path(request) -> str:
+    """Путь без имени арендатора: /robokassa/{tenant}/result делит лимит с /robokassa/result"""
+    tenant = request.match_info.get("tenant")
+    return request.path.replace(f"/{tenant}/", "/", 1) if tenant else request.path
+
+
+@web.middleware
+async def admission_middleware(request, handler):
+    controller = controllers.get(route_path(request))
+    if controller is None:
+        return await handler(request)
+
+    if not await controller.acquire():
+        return web.Response(
+            status=503,
+            text="Service temporarily overloaded, retry later",
+            headers={"Retry-After": str(RETRY_AFTER_SECONDS)}
+        )
+    try:
+        return await handler(request)
+    finally:
+        controller.release()
+
+
+async def admission_metrics_handler(request):
+    """
+    Метрики admission control в текстовом формате Prometheus
+    Токен: заголовок X-Admin-Token или параметр token.
+    """
+    token = request.headers.get("X-Admin-Token") or request.query.get("token", "")
+    if not hmac.compare_digest(token, ADMIN_API_TOKEN):
+        return web.Response(status=403, text="Forbidden")
+    lines = []
+    for route, controller in controllers.items():
+        for name, value in controller.metrics().items():
+            lines.append(f'{name}{{route="{route}"}} {value}')
+    return web.Response(text="\n".join(lines) + "\n", content_type="text/plain")
@@ -0,0 +1,153 @@
+import asyncio
+import time
+from typing import Optional, Set
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramNotFound
+from database import db
+from throttling import telegram_limiter, call_with_retry
+from config import (
+    BROADCAST_BATCH_SIZE, BROADCAST_SEND_CHUNK, BROADCAST_PROGRESS_INTERVAL,
+    BROADCAST_RETRY_PASSES, BROADCAST_RETRY_DELAY
+)
+
+# Ссылки на запущенные задачи рассылок (чтобы их не собрал GC)
+_running_tasks: Set[asyncio.Task] = set()
+
+
+async def deliver(bot: Bot, user_id: int, text: str) -> tuple:
+    """
+    Отправить сообщение рассылки одному получателю
+
+    Returns:
+        (telegram_id, status, error), где status: 'sent', 'blocked', 'failed'
+        (постоянная ошибка 4xx) или 'retry' (временная ошибка - сеть, 5xx,
+        flood control после всех повторов call_with_retry)
+    """
+    try:
+        await call_with_retry(telegram_limiter, lambda: bot.send_message(user_id, text))
+        return user_id, 'sent', None
+    except TelegramForbiddenError as e:
+        # Пользователь заблокировал бота - повторять бессмысленно
+        return user_id, 'blocked', str(e)
+    except (TelegramBadRequest, TelegramNotFound) as e:
+        return user_id, 'failed', str(e)
+    except Exception as e:
+        return user_id, 'retry', str(e)
+
+
+def format_progress(broadcast: dict, sent: int, failed: int, delivered_now: int, elapsed: float,
+                    retry: int = 0) -> str:
+    """Текст прогресса рассылки: количество, скорость и оставшееся время"""
+    done = sent + failed
+    total = broadcast['total']
+    rate = delivered_now / elapsed if elapsed > 0 else 0
+    remaining = max(total - done, 0)
+    eta = f"{int(remaining / rate // 60)} мин {int(remaining / rate % 60)} сек" if rate > 0 else "—"
+    return (
+        f"Рассылка #{broadcast['id']} ({broadcast['channel_name']})\n"
+        f"Обработано: {done} из {total}\n"
+        f"Доставлено: {sent}, ошибок: {failed}\n"
+        + (f"Временных ошибок (будет повтор): {retry}\n" if retry else "")
+        + f"Скорость: {rate:.1f} сообщ./сек\n"
+        f"Осталось: {eta}"
+    )
+
+
+async def run_broadcast(bot: Bot, broadcast: dict):
+    """
+    Выполнить (или продолжить) рассылку
+
+    Получатели читаются страницами по BROADCAST_BATCH_SIZE и отправляются
+    частями по BROADCAST_SEND_CHUNK через общий ограничитель частоты.
+    Результаты сохраняются в broadcast_deliveries после каждой части, поэтому
+    после сбоя повторно отправляется не больше одной части.
+    Получателям с временной ошибкой ('retry') отправка повторяется
+    следующими проходами (до BROADCAST_RETRY_PASSES) и после перезапуска бота.
+    """
+    broadcast_id = broadcast['id']
+    sent = broadcast['sent']
+    failed = broadcast['failed']
+    retry = 0
+    delivered_now = 0
+    started = time.monotonic()
+    last_progress = started
+
+    print(f"[BROADCAST] Starting broadcast #{broadcast_id} ({broadcast['channel_name']}), "
+          f"already processed: {sent + failed} of {broadcast['total']}")
+
+    try:
+        for attempt in range(BROADCAST_RETRY_PASSES + 1):
+            if attempt:
+                print(f"[BROADCAST] Broadcast #{broadcast_id}: {retry} temporary errors, "
+                      f"retry pass {attempt} in {BROADCAST_RETRY_DELAY:.0f} s")
+                await asyncio.sleep(BROADCAST_RETRY_DELAY)
+            retry = 0
+            async for recipients in db.iter_broadcast_recipients(
+                broadcast_id, broadcast['channel_name'], BROADCAST_BATCH_SIZE
+            ):
+                for start in range(0, len(recipients), BROADCAST_SEND_CHUNK):
+                    deliveries = await asyncio.gather(*[
+                        deliver(bot, user_id, broadcast['text'])
+                        for user_id in recipients[start:start + BROADCAST_SEND_CHUNK]
+                    ])
+                    await db.record_broadcast_deliveries(broadcast_id, deliveries)
+
+                    chunk_sent = sum(1 for _, status, _ in deliveries if status == 'sent')
+                    chunk_retry = sum(1 for _, status, _ in deliveries if status == 'retry')
+                    sent += chunk_sent
+                    retry += chunk_retry
+                    failed += len(deliveries) - chunk_sent - chunk_retry
+                    delivered_now += len(deliveries)
+
+                if time.monotonic() - last_progress >= BROADCAST_PROGRESS_INTERVAL:
+                    last_progress = time.monotonic()
+                    await _update_progress(
+                        bot, broadcast,
+                        format_progress(broadcast, sent, failed, delivered_now, last_progress - started, retry)
+                    )
+            if not retry:
+                break
+    except Exception as e:
+        print(f"[BROADCAST] Broadcast #{broadcast_id} interrupted: {e}")
+        await _update_progress(
+            bot, broadcast,
+            f"❌ Рассылка #{broadcast_id} прервана: {e}\n"
+            f"Она будет продолжена после перезапуска бота."
+        )
+        return
+
+    await db.finish_broadcast(broadcast_id)
+    print(f"[BROADCAST] Broadcast #{broadcast_id} finished: sent {sent}, failed {failed}, "
+          f"not delivered after retries {retry}")
+    await _update_progress(
+        bot, broadcast,
+        "✅ " + format_progress(broadcast, sent, failed, delivered_now, time.monotonic() - started)
+        + (f"\nНе доставлено из-за временных ошибок: {retry}" if retry else "")
+    )
+
+
+def start_broadcast_task(bot: Bot, broadcast: dict) -> asyncio.Task:
+    """Запустить рассылку фоновой задачей"""
+    task = asyncio.create_task(run_broadcast(bot, broadcast))
+    _running_tasks.add(task)
+    task.add_done_callback(_running_tasks.discard)
+    return task
+
+
+async def resume_broadcasts(bot: Bot):
+    """Продолжить рассылки, прерванные остановкой бота (вызывается при запуске)"""
+    for broadcast in await db.get_running_broadcasts():
+        print(f"[BROADCAST] Resuming broadcast #{broadcast['id']}")
+        start_broadcast_task(bot, broadcast)
+
+
+async def _update_progress(bot: Bot, broadcast: dict, text: str):
+    """Отредактировать сообщение с прогрессом (ошибки редактирования не критичны)"""
+    chat_id: Optional[int] = broadcast.get('progress_chat_id')
+    message_id: Optional[int] = broadcast.get('progress_message_id')
+    if not chat_id or not message_id:
+        return
+    try:
+        await bot.edit_message_text(text, chat_id=chat_id, message_id=message_id)
+    except Exception as e:
+        print(f"[BROADCAST] Could not update progress message: {e}")
@@ -0,0 +1,186 @@
+import asyncio
+import csv
+import io
+import tempfile
+import time
+from datetime import timedelta
+from clock import clock
+from typing import Iterator, List, Tuple
+from aiogram import Bot
+from aiogram.types import Message
+from database import db
+from handlers import get_join_request_link, send_gift_message
+from user_resolver import resolve_user_identifiers
+from events import event_log, GRANTED
+from config import FREE_TRIAL_DAYS, IMPORT_CHUNK_SIZE, IMPORT_PROGRESS_INTERVAL, IMPORT_STALE_MINUTES
+from tenants import current_tenant
+
+# Сколько нераспознанных идентификаторов показывать в итоговом отчете
+MAX_REPORTED_UNRESOLVED = 50
+
+
+def iter_identifier_chunks(text_stream, skip_rows: int, chunk_size: int) -> Iterator[Tuple[int, List[str]]]:
+    """
+    Потоково читать CSV/TXT и отдавать пачки идентификаторов
+
+    В строке может быть один или несколько ID/@username (через запятую или пробел).
+    Первая строка пропускается, если похожа на заголовок CSV.
+    Пачка всегда заканчивается на границе строки, поэтому номер строки
+    можно использовать как чекпоинт.
+
+    Yields:
+        (номер последней обработанной строки, список идентификаторов)
+    """
+    chunk = []
+    row_number = last_yielded = skip_rows
+    for row_number, row in enumerate(csv.reader(text_stream), start=1):
+        if row_number <= skip_rows:
+            continue
+        tokens = [token for cell in row for token in cell.split() if token]
+        if row_number == 1 and not any(t.isdigit() or t.startswith('@') for t in tokens):
+            continue  # заголовок
+        chunk.extend(tokens)
+        if len(chunk) >= chunk_size:
+            yield row_number, chunk
+            chunk = []
+            last_yielded = row_number
+    if row_number > last_yielded:
+        yield row_number, chunk
+
+
+async def run_file_import(message: Message, bot: Bot):
+    """
+    Импорт пользователей мастер-класса из загруженного файла
+
+    Файл обрабатывается пачками по IMPORT_CHUNK_SIZE идентификаторов:
+    1. Разрешение ID/@username в telegram_id
+    2. Массовая подготовка подарков в БД (prepare_gift_batch)
+    3. Отправка подарков через общий ограничитель частоты
+    4. Сохранение чекпоинта (complete_gift_batch)
+
+    Файл скачивается во временный файл на диске и читается потоково,
+    поэтому в памяти только текущая пачка, а не весь файл.
+    Сообщение с прогрессом периодически редактируется.
+    """
+    document = message.document
+    job = await db.claim_import_job(
+        document.file_unique_id, document.file_name, message.from_user.id
+    )
+    if job['status'] == 'done':
+        await message.answer(
+            f"Этот файл уже импортирован (задача #{job['id']}).\n"
+            f"Получили подарок: {job['gifted']}"
+        )
+        return
+    if not job['claimed']:
+        # Файл отправлен повторно во время импорта: второй проход подарил бы те же пачки
+        await message.answer(
+            f"Импорт этого файла уже выполняется (задача #{job['id']}, "
+            f"обработано строк: {job['processed_rows']}).\n"
+            f"Если импорт остановился, отправьте файл снова через {IMPORT_STALE_MINUTES} мин."
+        )
+        return
+
+    resume_from = job['processed_rows']
+    progress = await message.answer(
+        f"Импорт #{job['id']}: загрузка файла..."
+        + (f"\nПродолжаем со строки {resume_from + 1}" if resume_from else "")
+    )
+
+    processed_rows = resume_from
+    imported = job['imported']
+    gifted = job['gifted']
+    unresolved_total = job['unresolved']
+    unresolved_sample = []
+    last_progress = time.monotonic()
+    buffer = tempfile.TemporaryFile()
+
+    try:
+        channel_link = await get_join_request_link(bot, current_tenant().channel_id("channel_1"))
+        await bot.download(document, destination=buffer)
+        text_stream = io.TextIOWrapper(buffer, encoding='utf-8-sig', newline='')
+
+        for processed_rows, identifiers in iter_identifier_chunks(text_stream, resume_from, IMPORT_CHUNK_SIZE):
+            # 1. Разрешаем идентификаторы
+            telegram_ids = []
+            unresolved = 0
+            resolved = await resolve_user_identifiers(bot, identifiers)
+            for identifier in identifiers:
+                user_id = resolved[identifier]
+                if user_id:
+                    telegram_ids.append(user_id)
+                else:
+                    unresolved += 1
+                    if len(unresolved_sample) < MAX_REPORTED_UNRESOLVED:
+                        unresolved_sample.append(identifier)
+
+            # 2. Готовим подарки одной транзакцией
+            start_date = clock.now()
+            end_date = start_date + timedelta(days=FREE_TRIAL_DAYS)
+            reminder_date = start_date + timedelta(days=FREE_TRIAL_DAYS - 3)
+            users_to_gift = []
+            if telegram_ids:
+                users_to_gift = await db.prepare_gift_batch(
+                    telegram_ids, "channel_1", start_date, end_date, reminder_date
+                )
+
+            for user_id in users_to_gift:
+                event_log.record(GRANTED, user_id, "channel_1", method="gift", end_date=end_date)
+
+            # 3. Отправляем подарки (темп задает telegram_limiter)
+            await asyncio.gather(*[
+                send_gift_message(bot, user_id, start_date, end_date, channel_link)
+                for user_id in users_to_gift
+            ])
+
+            # 4. Чекпоинт
+            await db.complete_gift_batch(
+                job['id'], users_to_gift, processed_rows, len(telegram_ids), unresolved
+            )
+            imported += len(telegram_ids)
+            gifted += len(users_to_gift)
+            unresolved_total += unresolved
+
+            if time.monotonic() - last_progress >= IMPORT_PROGRESS_INTERVAL:
+                last_progress = time.monotonic()
+                await _update_progress(
+                    progress,
+                    f"Импорт #{job['id']}: обработано строк {processed_rows}\n"
+                    f"Найдено пользователей: {imported}\n"
+                    f"Получили подарок: {gifted}\n"
+                    f"Не найдено: {unresolved_total}"
+                )
+    except Exception as e:
+        print(f"[IMPORT] Error in import job {job['id']} at row {processed_rows}: {e}")
+        await db.finish_import_job(job['id'], "failed")
+        await _update_progress(
+            progress,
+            f"❌ Импорт #{job['id']} прерван на строке {processed_rows}: {e}\n"
+            f"Отправьте тот же файл еще раз, чтобы продолжить."
+        )
+        return
+    finally:
+        buffer.close()
+
+    await db.finish_import_job(job['id'])
+    await _update_progress(
+        progress,
+        f"Импорт #{job['id']} завершен.\n"
+        f"Обработано строк: {processed_rows}\n"
+        f"Всего пользователей: {imported}\n"
+        f"Получили подарок: {gifted}\n"
+        f"Не найдено: {unresolved_total}"
+    )
+    if unresolved_sample:
+        await message.answer(
+            f"⚠️ Не удалось найти пользователей (первые {len(unresolved_sample)}): "
+            f"{', '.join(unresolved_sample)}"
+        )
+
+
+async def _update_progress(progress: Message, text: str):
+    """Отредактировать сообщение с прогрессом (ошибки редактирования не критичны)"""
+    try:
+        await progress.edit_text(text)
+    except Exception as e:
+        print(f"[IMPORT] Could not update progress message: {e}")
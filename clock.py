@@ -0,0 +1,43 @@
+"""
+ЧАСЫ ПРИЛОЖЕНИЯ
+
+Все чтения текущего времени (даты подписок, напоминаний, проверки истечения)
+идут через clock.now(), а не datetime.now(). В обычной работе это системное
+время; симуляция (tools/simulate.py) переводит часы в виртуальный режим и
+прокручивает недели работы планировщика за секунды.
+"""
+from datetime import datetime, timedelta
+from typing import Optional
+
+
+class Clock:
+    """Системное время с возможностью переключения на виртуальное"""
+
+    def __init__(self):
+        self._virtual: Optional[datetime] = None
+
+    @property
+    def simulated(self) -> bool:
+        return self._virtual is not None
+
+    def now(self) -> datetime:
+        """Текущее время (naive, локальное - как datetime.now())"""
+        return self._virtual if self._virtual is not None else datetime.now()
+
+    def set(self, moment: datetime):
+        """Перейти в виртуальное время, начиная с moment"""
+        self._virtual = moment
+
+    def advance(self, delta: timedelta):
+        """Сдвинуть виртуальное время вперед"""
+        if self._virtual is None:
+            raise RuntimeError("clock.advance() доступен только в виртуальном времени (clock.set())")
+        self._virtual += delta
+
+    def reset(self):
+        """Вернуться к системному времени"""
+        self._virtual = None
+
+
+# Глобальные часы, используются во всех модулях
+clock = Clock()
@@ -29,6 +29,15 @@ ROBOKASSA_BASE_URL = "https://auth.robokassa.ru/Merchant/Index.aspx"
 # Channels
 CHANNEL_1_ID = os.getenv("CHANNEL_1_ID", "-1003424698595")  # Орден Демиургов
 CHANNEL_2_ID = os.getenv("CHANNEL_2_ID", "-1003267567681")  # Родители Демиурги
+CHANNEL_IDS = {
+    "channel_1": CHANNEL_1_ID,
+    "channel_2": CHANNEL_2_ID,
+}
+
+# Ссылки на вступление по заявке (creates_join_request). Если не заданы,
+# бот создает их сам один раз при первом использовании.
+CHANNEL_1_JOIN_LINK = os.getenv("CHANNEL_1_JOIN_LINK")
+CHANNEL_2_JOIN_LINK = os.getenv("CHANNEL_2_JOIN_LINK")
 
 # Database (PostgreSQL)
 DB_HOST = os.getenv("DB_HOST", "localhost")
@@ -51,3 +60,135 @@ FREE_TRIAL_DAYS = 14
 PAID_SUBSCRIPTION_DAYS = 30
 REMINDER_DAYS_BEFORE = 3
 
+
+# Telegram Bot API limits
+# Глобальный лимит исходящих сообщений (Telegram допускает ~30 сообщений/сек)
+TELEGRAM_RATE_LIMIT = float(os.getenv("TELEGRAM_RATE_LIMIT", "25"))
+
+# Bulk import (/import_users с файлом)
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", "500"))
+IMPORT_PROGRESS_INTERVAL = float(os.getenv("IMPORT_PROGRESS_INTERVAL", "5"))
+# Импорт без прогресса дольше стольких минут считается прерванным (бот остановлен
+# во время импорта) - повторная отправка файла продолжит его
+IMPORT_STALE_MINUTES = int(os.getenv("IMPORT_STALE_MINUTES", "10"))
+
+# Разрешение @username -> telegram_id
+RESOLVE_CONCURRENCY = int(os.getenv("RESOLVE_CONCURRENCY", "5"))
+RESOLVE_CACHE_SIZE = int(os.getenv("RESOLVE_CACHE_SIZE", "10000"))
+RESOLVE_CACHE_TTL = int(os.getenv("RESOLVE_CACHE_TTL", "86400"))  # найденные, сек
+RESOLVE_NEGATIVE_CACHE_TTL = int(os.getenv("RESOLVE_NEGATIVE_CACHE_TTL", "600"))  # ненайденные, сек
+
+# Broadcast (/broadcast)
+BROADCAST_BATCH_SIZE = int(os.getenv("BROADCAST_BATCH_SIZE", "500"))
+# Отправок, сохраняемых вместе: после сбоя повторно уйдут не больше стольких сообщений
+BROADCAST_SEND_CHUNK = int(os.getenv("BROADCAST_SEND_CHUNK", "20"))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "10"))
+# Повторные проходы по получателям с временными ошибками (сеть, 5xx, flood control)
+BROADCAST_RETRY_PASSES = int(os.getenv("BROADCAST_RETRY_PASSES", "3"))
+BROADCAST_RETRY_DELAY = float(os.getenv("BROADCAST_RETRY_DELAY", "60"))  # сек между проходами
+
+# Сверка членства в каналах с подписками (reconciliation)
+RECONCILE_BATCH_SIZE = int(os.getenv("RECONCILE_BATCH_SIZE", "200"))
+RECONCILE_CONCURRENCY = int(os.getenv("RECONCILE_CONCURRENCY", "10"))
+RECONCILE_INTERVAL_HOURS = int(os.getenv("RECONCILE_INTERVAL_HOURS", "6"))
+
+# Транзакции db.transaction() дольше этого порога печатаются в лог
+DB_SLOW_TRANSACTION_MS = float(os.getenv("DB_SLOW_TRANSACTION_MS", "100"))
+
+# Read replica (необязательно). Если задана, читающие запросы идут на реплику
+DB_REPLICA_URL = os.getenv("DB_REPLICA_URL")
+DB_REPLICA_MAX_LAG_SECONDS = float(os.getenv("DB_REPLICA_MAX_LAG_SECONDS", "5"))
+DB_REPLICA_CHECK_INTERVAL = float(os.getenv("DB_REPLICA_CHECK_INTERVAL", "10"))
+# Сколько секунд после записи чтения пользователя идут на основной сервер
+DB_READ_YOUR_WRITES_SECONDS = float(os.getenv("DB_READ_YOUR_WRITES_SECONDS", "10"))
+
+# Хранилище: "postgres" (по умолчанию) или "memory" (in-memory, для бенчмарков и локальных прогонов)
+DB_BACKEND = os.getenv("DB_BACKEND", "postgres").lower()
+
+# Сэмплирующий профилировщик обработчиков и задач планировщика (profiler.py).
+# Включается и без перезапуска: /profile on или POST /debug/profile?action=on
+PROFILE_ENABLED = os.getenv("PROFILE_ENABLED", "False").lower() == "true"
+# Доля профилируемых выполнений (0.05 = каждое 20-е) и интервал снятия стека
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0.05"))
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+# Токен для /debug/profile (без токена маршрут не регистрируется)
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN")
+
+# Event loop: "asyncio" (стандартный) или "uvloop" (быстрее, pip install uvloop; не для Windows)
+EVENT_LOOP = os.getenv("EVENT_LOOP", "asyncio").lower()
+# Контроль задержки event loop: период замера и порог, после которого в лог пишется стек
+LOOP_LAG_INTERVAL_MS = float(os.getenv("LOOP_LAG_INTERVAL_MS", "100"))
+LOOP_LAG_THRESHOLD_MS = float(os.getenv("LOOP_LAG_THRESHOLD_MS", "250"))
+
+# Ограничение конкурентности webhook-сервера Robokassa (admission.py):
+# (одновременно обрабатываемых запросов, длина очереди ожидания) по маршрутам.
+# Сверх очереди - сразу 503 (Robokassa повторит уведомление позже)
+ADMISSION_LIMITS = {
+    "/robokassa/result": (
+        int(os.getenv("ADMISSION_RESULT_CONCURRENCY", "5")),
+        int(os.getenv("ADMISSION_RESULT_QUEUE", "50")),
+    ),
+    "/robokassa/success": (
+        int(os.getenv("ADMISSION_REDIRECT_CONCURRENCY", "50")),
+        int(os.getenv("ADMISSION_REDIRECT_QUEUE", "100")),
+    ),
+    "/robokassa/fail": (
+        int(os.getenv("ADMISSION_REDIRECT_CONCURRENCY", "50")),
+        int(os.getenv("ADMISSION_REDIRECT_QUEUE", "100")),
+    ),
+}
+# Сколько секунд запрос может ждать в очереди, прежде чем получит 503
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "5"))
+
+# Сверка зависших платежей с Robokassa (payment_reconciler.py, интерфейс OpState)
+ROBOKASSA_OPSTATE_URL = os.getenv(
+    "ROBOKASSA_OPSTATE_URL", "https://auth.robokassa.ru/Merchant/WebService/Service.asmx/OpStateExt"
+)
+PAYMENT_RECONCILE_INTERVAL_MINUTES = int(os.getenv("PAYMENT_RECONCILE_INTERVAL_MINUTES", "10"))
+# Платеж считается зависшим, если ResultURL не пришел за это время
+PAYMENT_RECONCILE_MIN_AGE_MINUTES = int(os.getenv("PAYMENT_RECONCILE_MIN_AGE_MINUTES", "15"))
+# Неоплаченные платежи старше этого срока помечаются 'expired' и больше не проверяются
+PAYMENT_RECONCILE_MAX_AGE_HOURS = int(os.getenv("PAYMENT_RECONCILE_MAX_AGE_HOURS", "72"))
+PAYMENT_RECONCILE_BATCH_SIZE = int(os.getenv("PAYMENT_RECONCILE_BATCH_SIZE", "100"))
+PAYMENT_RECONCILE_CONCURRENCY = int(os.getenv("PAYMENT_RECONCILE_CONCURRENCY", "5"))
+
+# Токен административных HTTP-маршрутов (GET /admin/stats); без токена маршруты не регистрируются
+ADMIN_API_TOKEN = os.getenv("ADMIN_API_TOKEN")
+
+# Журнал событий подписок (events.py): события копятся в памяти и пишутся в БД пачками
+# через COPY - раз в EVENT_LOG_FLUSH_SECONDS или при накоплении EVENT_LOG_BATCH_SIZE событий.
+# Сверх EVENT_LOG_MAX_BUFFER (БД недоступна) самые старые события отбрасываются
+EVENT_LOG_FLUSH_SECONDS = float(os.getenv("EVENT_LOG_FLUSH_SECONDS", "2"))
+EVENT_LOG_BATCH_SIZE = int(os.getenv("EVENT_LOG_BATCH_SIZE", "500"))
+EVENT_LOG_MAX_BUFFER = int(os.getenv("EVENT_LOG_MAX_BUFFER", "50000"))
+
+# Несколько ботов в одном процессе (tenants.py): JSON-файл с арендаторами.
+# Без файла бот один - настройки берутся из переменных окружения выше
+TENANTS_FILE = os.getenv("TENANTS_FILE")
+
+# Пул соединений PostgreSQL (database.py)
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "5"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "20"))
+DB_REPLICA_POOL_MIN_SIZE = int(os.getenv("DB_REPLICA_POOL_MIN_SIZE", "2"))
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", "60"))
+DB_CONNECT_TIMEOUT = float(os.getenv("DB_CONNECT_TIMEOUT", "60"))
+# Простаивающее соединение закрывается через столько секунд (0 - не закрывать)
+DB_MAX_INACTIVE_CONNECTION_LIFETIME = float(os.getenv("DB_MAX_INACTIVE_CONNECTION_LIFETIME", "300"))
+# Кэш подготовленных запросов на соединение (statements.py): не меньше числа объявленных запросов
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "200"))
+# Подготавливать все запросы реестра при открытии соединения (иначе - при первом выполнении)
+DB_PREPARE_ON_CONNECT = os.getenv("DB_PREPARE_ON_CONNECT", "True").lower() == "true"
+# Подключение через PgBouncer в режиме pool_mode=transaction: без кэша подготовленных
+# запросов и без настроек сессии (схемы арендаторов, кроме public, не поддерживаются)
+DB_PGBOUNCER = os.getenv("DB_PGBOUNCER", "False").lower() == "true"
+
+# Обработка апдейтов polling (update_queue.py): апдейты разных пользователей
+# выполняются параллельно, но не больше UPDATE_CONCURRENCY одновременно;
+# апдейты одного пользователя - строго по очереди
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "50"))
+# Кнопки оплаты получают свободный слот раньше навигации по меню
+UPDATE_PRIORITIZE_PAYMENTS = os.getenv("UPDATE_PRIORITIZE_PAYMENTS", "True").lower() == "true"
+
+# Кэш отрисованных сообщений (render_cache.py): сколько последних сообщений
+# помнится, чтобы не отправлять editMessageText с тем же текстом и клавиатурой
+RENDER_CACHE_SIZE = int(os.getenv("RENDER_CACHE_SIZE", "10000"))
@@ -1,7 +1,53 @@
+import asyncio
 import asyncpg
-from datetime import datetime, timedelta
-from typing import Optional, List
-from config import DB_URL
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from datetime import date, datetime, timedelta
+from clock import clock
+from typing import Optional, List, Dict, Callable, Hashable, AsyncIterator
+from config import (
+    DB_URL, DB_SLOW_TRANSACTION_MS, DB_REPLICA_URL, DB_REPLICA_MAX_LAG_SECONDS,
+    DB_REPLICA_CHECK_INTERVAL, DB_READ_YOUR_WRITES_SECONDS, DB_BACKEND,
+    DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_REPLICA_POOL_MIN_SIZE, DB_COMMAND_TIMEOUT, DB_CONNECT_TIMEOUT,
+    DB_MAX_INACTIVE_CONNECTION_LIFETIME, DB_STATEMENT_CACHE_SIZE, DB_PREPARE_ON_CONNECT, DB_PGBOUNCER,
+    IMPORT_STALE_MINUTES
+)
+from subscriber_index import subscriber_index
+from tenants import current_tenant, TENANTS, TenantLocal, DEFAULT_SCHEMA
+from migrations import run_migrations
+from models import User, Subscription, Payment, Reminder
+from stats import subscription_delta, payment_delta, merge_delta, empty_delta, DAILY_FIELDS, GAUGE_FIELDS
+from export import EXPORT_COLUMNS
+from statements import (
+    PreparedConnection, STATEMENTS, stats as statement_stats, cache_usage,
+    UPSERT_USER, GET_USER, GET_USER_IDS_BY_USERNAMES, INSERT_MISSING_USERS, GET_NOT_GIFTED_USERS,
+    MARK_GIFT_RECEIVED, MARK_GIFTS_RECEIVED, CLAIM_IMPORT_JOB, GET_IMPORT_JOB, UPDATE_IMPORT_JOB_PROGRESS,
+    FINISH_IMPORT_JOB, LOCK_SUBSCRIPTION, LOCK_SUBSCRIPTIONS, UPDATE_SUBSCRIPTION,
+    INSERT_SUBSCRIPTION, UPSERT_GIFT_SUBSCRIPTIONS, GET_ACTIVE_SUBSCRIPTION,
+    GET_USER_SUBSCRIPTIONS, GET_ACTIVE_SUBSCRIBERS, DEACTIVATE_SUBSCRIPTION,
+    COUNT_USER_SUBSCRIPTIONS, GET_EXPIRING_GIFT_SUBSCRIPTIONS,
+    GET_EXPIRED_SUBSCRIPTIONS_PAGE, GET_SUBSCRIPTIONS_PAGE, GET_CHANGED_SUBSCRIPTIONS_PAGE,
+    INSERT_PAYMENT, UPDATE_PAYMENT_STATUS, CONFIRM_PAYMENT, EXPIRE_PAYMENT,
+    GET_STALE_PENDING_PAYMENTS, GET_PAYMENT, ADD_DAILY_STATS, ADD_CHANNEL_STATS, GET_CHANNEL_STATS,
+    GET_STATS_TOTALS, GET_DAILY_STATS, GET_USER_EVENTS, UPSERT_REMINDER, UPSERT_GIFT_REMINDERS,
+    MARK_REMINDER_SENT, GET_PENDING_REMINDERS, GET_PENDING_REMINDERS_PAGE, GET_CHECKPOINT, SAVE_CHECKPOINT, CREATE_BROADCAST,
+    SET_BROADCAST_PROGRESS_MESSAGE, GET_RUNNING_BROADCASTS, GET_BROADCAST_RECIPIENTS,
+    INSERT_BROADCAST_DELIVERY, ADD_BROADCAST_COUNTERS, FINISH_BROADCAST, REPLICA_LAG
+)
+
+class UnitOfWork:
+    """Состояние единицы работы: общее соединение и отложенные до фиксации действия"""
+    
+    def __init__(self, conn: asyncpg.Connection, name: str):
+        self.conn = conn
+        self.name = name
+        self.operations = 0
+        self.after_commit: List[Callable[[], None]] = []
+
+
+# Текущая единица работы (db.transaction()) в контексте задачи asyncio
+_current_uow: ContextVar[Optional[UnitOfWork]] = ContextVar("db_unit_of_work", default=None)
 
 class Database:
     """
@@ -11,6 +57,8 @@ class Database:
     -----------------
     Подключение происходит через connection pool в методе get_connection().
     Каждый метод получает соединение из пула, выполняет запрос и возвращает соединение в пул.
+    Внутри db.transaction() все методы используют одно соединение и одну транзакцию.
+    Если задан DB_REPLICA_URL, читающие методы идут на реплику (см. _acquire).
     
     Инициализация пула происходит в методе init_db() при первом запуске бота.
     """
@@ -18,104 +66,279 @@ class Database:
     def __init__(self):
         self.db_url = DB_URL
         self.pool: Optional[asyncpg.Pool] = None
+        # Необязательная реплика для чтения (см. _acquire)
+        self.replica_url = DB_REPLICA_URL
+        self.replica_pool: Optional[asyncpg.Pool] = None
+        self.replica_healthy = False
+        self._replica_monitor: Optional[asyncio.Task] = None
+        # Ключ (telegram_id или ("payment", payment_id)) -> время последней записи
+        self._recent_writes: Dict[Hashable, float] = {}
+        # Статистика транзакций db.transaction(): имя -> count/total_ms/max_ms
+        self.transaction_stats: Dict[str, dict] = {}
 
     async def init_db(self):
         """
         ИНИЦИАЛИЗАЦИЯ БАЗЫ ДАННЫХ И СОЗДАНИЕ ПУЛА СОЕДИНЕНИЙ
         
         Этот метод вызывается при запуске бота (см. main.py, функция on_startup).
-        Создает пул соединений к PostgreSQL и инициализирует таблицы.
-        """
-        # Создаем пул соединений
-        self.pool = await asyncpg.create_pool(
-            self.db_url,
-            min_size=5,
-            max_size=20,
-            command_timeout=60
+        Создает пул соединений к PostgreSQL и применяет миграции схемы.
+        Если схема актуальна, выполняется только один SELECT версии.
+        
+        Вызывается для каждого арендатора (tenants.py): пул создается при первом
+        вызове и общий для всех, миграции применяются в схеме текущего арендатора.
+        
+        Размер пула и тайм-ауты - DB_POOL_*, DB_*_TIMEOUT в config.py. За PgBouncer
+        в режиме транзакций (DB_PGBOUNCER) поддерживается только схема public.
+        """
+        schema = current_tenant().schema
+        if DB_PGBOUNCER and schema != DEFAULT_SCHEMA:
+            # search_path ставится на сессию, а в режиме транзакций PgBouncer
+            # сессия сервера после каждой транзакции достается другому клиенту
+            raise RuntimeError(f"Tenant schema {schema} is not supported with DB_PGBOUNCER")
+        if self.pool is None:
+            # Создаем пул соединений
+            self.pool = await self._create_pool(self.db_url, DB_POOL_MIN_SIZE)
+        
+        # Применяем недостающие миграции схемы (см. migrations.py)
+        async with self.pool.acquire() as conn:
+            if schema != DEFAULT_SCHEMA:
+                await conn.execute(f'CREATE SCHEMA IF NOT EXISTS "{schema}"')
+            await run_migrations(conn)
+            # Соединения, открытые до миграций, не нашли таблиц и запросы не подготовили:
+            # это соединение готовит их сейчас, остальные - при первом выполнении
+            if self._prepares_statements():
+                await conn.prepare_registry()
+        
+        # Пул реплики для чтения (необязательно). Ошибка подключения не мешает запуску:
+        # все запросы пойдут на основной сервер
+        if self.replica_url and self.replica_pool is None:
+            try:
+                self.replica_pool = await self._create_pool(self.replica_url, DB_REPLICA_POOL_MIN_SIZE)
+            except Exception as e:
+                print(f"[DB] Could not connect to read replica, using primary only: {e}")
+            else:
+                self._replica_monitor = asyncio.create_task(self._monitor_replica())
+
+    async def _create_pool(self, dsn: str, min_size: int) -> asyncpg.Pool:
+        """
+        Пул соединений с параметрами из config.py (DB_POOL_*, DB_*_TIMEOUT)
+        
+        Соединения - PreparedConnection (statements.py): при открытии соединения
+        хук init подготавливает запросы реестра. С DB_PGBOUNCER кэш подготовленных
+        запросов выключен (statement_cache_size=0) и подготовки нет.
+        """
+        if not DB_PGBOUNCER and DB_STATEMENT_CACHE_SIZE < len(STATEMENTS):
+            print(f"[DB] DB_STATEMENT_CACHE_SIZE={DB_STATEMENT_CACHE_SIZE} is less than "
+                  f"{len(STATEMENTS)} registered statements: they will evict each other")
+        return await asyncpg.create_pool(
+            dsn,
+            min_size=min_size,
+            max_size=DB_POOL_MAX_SIZE,
+            command_timeout=DB_COMMAND_TIMEOUT,
+            timeout=DB_CONNECT_TIMEOUT,
+            max_inactive_connection_lifetime=DB_MAX_INACTIVE_CONNECTION_LIFETIME,
+            statement_cache_size=0 if DB_PGBOUNCER else DB_STATEMENT_CACHE_SIZE,
+            connection_class=PreparedConnection,
+            init=self._init_connection,
+            setup=self._setup_connection
         )
+
+    def _prepares_statements(self) -> bool:
+        return DB_PREPARE_ON_CONNECT and not DB_PGBOUNCER and DB_STATEMENT_CACHE_SIZE > 0
+
+    async def _init_connection(self, conn: PreparedConnection):
+        """Подготовка нового соединения пула: запросы реестра (statements.py)"""
+        if self._prepares_statements():
+            await conn.prepare_registry()
+
+    async def _setup_connection(self, conn: asyncpg.Connection):
+        """
+        Подготовка соединения при каждой выдаче из пула: схема текущего арендатора
+        
+        При возврате в пул asyncpg выполняет RESET ALL, поэтому search_path
+        ставится при каждой выдаче (лишний запрос - только для схем кроме public).
+        Схема - единственная в search_path: таблицы другого арендатора недоступны.
+        """
+        tenant = current_tenant()
+        tenant.metrics["db_acquires"] += 1
+        if tenant.schema != DEFAULT_SCHEMA:
+            await conn.execute(f'SET search_path TO "{tenant.schema}"')
+
+    @asynccontextmanager
+    async def _acquire(self, read: bool = False, key: Hashable = None):
+        """
+        Соединение для одного метода Database
+        
+        Внутри db.transaction() возвращает соединение текущей единицы работы,
+        иначе берет соединение из пула и возвращает его по выходу.
+        
+        read=True - запрос только читает и может идти на реплику, если она
+        настроена и исправна, а по ключу key (обычно telegram_id) не было
+        записи за последние DB_READ_YOUR_WRITES_SECONDS секунд.
+        """
+        uow = _current_uow.get()
+        if uow is not None:
+            uow.operations += 1
+            yield uow.conn
+            return
+        if self.pool is None:
+            raise RuntimeError("Database pool not initialized. Call init_db() first.")
+        
+        if read and self._can_read_from_replica(key):
+            try:
+                conn = await self.replica_pool.acquire()
+            except (OSError, asyncpg.PostgresError, asyncio.TimeoutError) as e:
+                # Реплика недоступна - переключаемся на основной сервер до следующей проверки
+                print(f"[DB] Replica unavailable, falling back to primary: {e}")
+                self.replica_healthy = False
+            else:
+                try:
+                    yield conn
+                finally:
+                    await self.replica_pool.release(conn)
+                return
         
-        # Инициализируем таблицы
         async with self.pool.acquire() as conn:
-            # Users table
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    telegram_id BIGINT PRIMARY KEY,
-                    username VARCHAR(255),
-                    first_name VARCHAR(255),
-                    last_name VARCHAR(255),
-                    gift_received BOOLEAN DEFAULT FALSE,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            
-            # Subscriptions table
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS subscriptions (
-                    id SERIAL PRIMARY KEY,
-                    telegram_id BIGINT NOT NULL REFERENCES users(telegram_id) ON DELETE CASCADE,
-                    channel_name VARCHAR(50) NOT NULL,
-                    is_active BOOLEAN DEFAULT FALSE,
-                    payment_method VARCHAR(50) NOT NULL,
-                    start_date TIMESTAMP NOT NULL,
-                    end_date TIMESTAMP NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    UNIQUE(telegram_id, channel_name)
-                )
-            """)
-            
-            # Payments table
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS payments (
-                    id SERIAL PRIMARY KEY,
-                    telegram_id BIGINT NOT NULL REFERENCES users(telegram_id) ON DELETE CASCADE,
-                    channel_name VARCHAR(50) NOT NULL,
-                    amount INTEGER NOT NULL,
-                    payment_id VARCHAR(255) UNIQUE NOT NULL,
-                    status VARCHAR(50) DEFAULT 'pending',
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            
-            # Reminders table
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS reminders (
-                    id SERIAL PRIMARY KEY,
-                    telegram_id BIGINT NOT NULL REFERENCES users(telegram_id) ON DELETE CASCADE,
-                    channel_name VARCHAR(50) NOT NULL,
-                    reminder_sent BOOLEAN DEFAULT FALSE,
-                    reminder_date TIMESTAMP NOT NULL,
-                    UNIQUE(telegram_id, channel_name)
-                )
-            """)
-            
-            # Создаем индексы для оптимизации
-            await conn.execute("""
-                CREATE INDEX IF NOT EXISTS idx_subscriptions_active 
-                ON subscriptions(telegram_id, channel_name, is_active) 
-                WHERE is_active = TRUE
-            """)
-            
-            await conn.execute("""
-                CREATE INDEX IF NOT EXISTS idx_subscriptions_end_date 
-                ON subscriptions(end_date) 
-                WHERE is_active = TRUE
-            """)
-            
-            await conn.execute("""
-                CREATE INDEX IF NOT EXISTS idx_payments_status 
-                ON payments(status)
-            """)
-            
-            await conn.execute("""
-                CREATE INDEX IF NOT EXISTS idx_payments_telegram_id 
-                ON payments(telegram_id)
-            """)
+            yield conn
+
+    def _can_read_from_replica(self, key: Hashable) -> bool:
+        """Можно ли выполнить чтение на реплике"""
+        if self.replica_pool is None or not self.replica_healthy:
+            return False
+        if key is None:
+            return True
+        written_at = self._recent_writes.get(key)
+        return written_at is None or time.monotonic() - written_at > DB_READ_YOUR_WRITES_SECONDS
+
+    def _mark_written(self, *keys: Hashable):
+        """Запомнить запись по ключам: ближайшие чтения по ним пойдут на основной сервер"""
+        if self.replica_pool is None:
+            return
+        now = time.monotonic()
+        for key in keys:
+            self._recent_writes[key] = now
+
+    async def _monitor_replica(self):
+        """
+        Периодически проверять отставание реплики
+        
+        Реплика используется, только если отстает не больше DB_REPLICA_MAX_LAG_SECONDS.
+        Заодно очищаются устаревшие отметки read-your-writes.
+        """
+        while True:
+            try:
+                async with self.replica_pool.acquire() as conn:
+                    lag = await conn.fetchval(REPLICA_LAG)
+                healthy = lag <= DB_REPLICA_MAX_LAG_SECONDS
+                if healthy != self.replica_healthy:
+                    print(f"[DB] Replica {'enabled' if healthy else 'disabled'} (lag {lag:.1f} s)")
+                self.replica_healthy = healthy
+            except Exception as e:
+                if self.replica_healthy:
+                    print(f"[DB] Replica health check failed, using primary: {e}")
+                self.replica_healthy = False
             
-            await conn.execute("""
-                CREATE INDEX IF NOT EXISTS idx_reminders_pending 
-                ON reminders(reminder_date, reminder_sent) 
-                WHERE reminder_sent = FALSE
-            """)
+            threshold = time.monotonic() - DB_READ_YOUR_WRITES_SECONDS
+            self._recent_writes = {
+                key: written_at for key, written_at in self._recent_writes.items() if written_at > threshold
+            }
+            await asyncio.sleep(DB_REPLICA_CHECK_INTERVAL)
+
+    def _after_commit(self, callback: Callable[[], None]):
+        """Выполнить callback после фиксации текущей транзакции (или сразу, если её нет)"""
+        uow = _current_uow.get()
+        if uow is not None:
+            uow.after_commit.append(callback)
+        else:
+            callback()
+
+    @asynccontextmanager
+    async def _atomic(self):
+        """
+        Соединение для метода из нескольких запросов, которые должны выполниться вместе
+        
+        Внутри db.transaction() - соединение уже открытой транзакции (без SAVEPOINT),
+        иначе - соединение из пула с отдельной транзакцией.
+        """
+        async with self._acquire() as conn:
+            if _current_uow.get() is not None:
+                yield conn
+            else:
+                async with conn.transaction():
+                    yield conn
+
+    async def _apply_stats(self, conn: asyncpg.Connection, channel_name: str, delta: Dict[str, int]):
+        """
+        Применить изменение счетчиков статистики (stats.py) в транзакции записи
+        
+        Строки stats_channels блокируются до конца транзакции, поэтому вызывается
+        последним запросом метода записи.
+        """
+        now = clock.now()
+        if any(delta[field] for field in DAILY_FIELDS):
+            await conn.execute(ADD_DAILY_STATS, now.date(), channel_name, delta["new_subscriptions"],
+                               delta["new_trials"], delta["conversions"], delta["deactivations"],
+                               delta["payments"], delta["revenue"])
+        if delta["active_subscriptions"] or delta["active_trials"]:
+            await conn.execute(ADD_CHANNEL_STATS, channel_name, delta["active_subscriptions"],
+                               delta["active_trials"], now)
+
+    @asynccontextmanager
+    async def transaction(self, name: str = "transaction"):
+        """
+        ЕДИНИЦА РАБОТЫ (UNIT OF WORK)
+        
+        Все методы Database, вызванные внутри блока, используют одно соединение
+        и одну транзакцию: одно обращение к пулу вместо отдельного на каждый метод,
+        и все изменения фиксируются (или откатываются) вместе.
+        
+            async with db.transaction("payment_success") as uow:
+                await db.create_subscription(...)
+                await db.has_ever_had_subscription(...)
+        
+        Вложенный вызов создает SAVEPOINT в той же транзакции.
+        Внутри блока нельзя выполнять методы Database параллельно (asyncio.gather):
+        у соединения может быть только одна активная операция.
+        Длительность транзакции учитывается в transaction_stats.
+        
+        ПОДКЛЮЧЕНИЕ: Получает одно соединение из пула на весь блок,
+        возвращает его в пул по выходу.
+        """
+        outer = _current_uow.get()
+        if outer is not None:
+            # SAVEPOINT: при откате блока отменяются и его действия после фиксации
+            position = len(outer.after_commit)
+            try:
+                async with outer.conn.transaction():
+                    yield outer
+            except BaseException:
+                del outer.after_commit[position:]
+                raise
+            return
+        
+        started = time.perf_counter()
+        async with self.pool.acquire() as conn:
+            uow = UnitOfWork(conn, name)
+            token = _current_uow.set(uow)
+            try:
+                async with conn.transaction():
+                    yield uow
+            finally:
+                _current_uow.reset(token)
+        
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self._record_transaction(name, elapsed_ms, uow.operations)
+        for callback in uow.after_commit:
+            callback()
+
+    def _record_transaction(self, name: str, elapsed_ms: float, operations: int):
+        """Учесть длительность транзакции (медленные печатаются в лог)"""
+        stats = self.transaction_stats.setdefault(name, {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+        stats["count"] += 1
+        stats["total_ms"] += elapsed_ms
+        stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+        if elapsed_ms >= DB_SLOW_TRANSACTION_MS:
+            print(f"[DB] Slow transaction {name}: {elapsed_ms:.0f} ms, {operations} operations")
 
     async def get_connection(self):
         """Получить соединение из пула"""
@@ -130,46 +353,54 @@ class Database:
         ПОДКЛЮЧЕНИЕ: Получает соединение из пула, выполняет INSERT ... ON CONFLICT,
         возвращает соединение в пул.
         """
-        async with self.pool.acquire() as conn:
-            await conn.execute("""
-                INSERT INTO users (telegram_id, username, first_name, last_name)
-                VALUES ($1, $2, $3, $4)
-                ON CONFLICT (telegram_id) 
-                DO UPDATE SET 
-                    username = EXCLUDED.username,
-                    first_name = EXCLUDED.first_name,
-                    last_name = EXCLUDED.last_name
-            """, telegram_id, username, first_name, last_name)
-
-    async def get_user(self, telegram_id: int) -> Optional[dict]:
+        self._mark_written(telegram_id)
+        async with self._acquire() as conn:
+            await conn.execute(UPSERT_USER, telegram_id, username, first_name, last_name)
+
+    async def get_user(self, telegram_id: int) -> Optional[User]:
         """
         Получить пользователя по telegram_id
         
         ПОДКЛЮЧЕНИЕ: Получает соединение из пула, выполняет SELECT,
         возвращает соединение в пул.
         """
-        async with self.pool.acquire() as conn:
-            row = await conn.fetchrow("SELECT * FROM users WHERE telegram_id = $1", telegram_id)
-            return dict(row) if row else None
+        async with self._acquire(read=True, key=telegram_id) as conn:
+            row = await conn.fetchrow(GET_USER, telegram_id)
+            return User.from_record(row) if row else None
+
+    async def get_user_ids_by_usernames(self, usernames: List[str]) -> Dict[str, int]:
+        """
+        Найти telegram_id по списку username (без учета регистра, одним запросом)
+        
+        Использует индекс idx_users_username_lower.
+        Возвращает словарь {username в нижнем регистре: telegram_id}.
+        
+        ПОДКЛЮЧЕНИЕ: Получает соединение из пула, выполняет SELECT,
+        возвращает соединение в пул.
+        """
+        async with self._acquire(read=True) as conn:
+            rows = await conn.fetch(GET_USER_IDS_BY_USERNAMES, [username.lower() for username in usernames])
+            return {row['username']: row['telegram_id'] for row in rows}
 
     async def import_users_from_masterclass(self, telegram_ids: List[int]):
         """
         Импортировать пользователей из мастер-класса
         
-        ПОДКЛЮЧЕНИЕ: Получает соединение из пула, выполняет несколько запросов,
-        возвращает соединение в пул.
+        Возвращает пользователей, которые еще не получали подарок
+        (в порядке исходного списка, без повторов).
+        
+        ПОДКЛЮЧЕНИЕ: Получает соединение из пула, выполняет INSERT и SELECT
+        одной транзакцией, возвращает соединение в пул.
         """
-        users_to_gift = []
-        async with self.pool.acquire() as conn:
-            for telegram_id in telegram_ids:
-                # Check if user exists and hasn't received gift
-                user = await self.get_user(telegram_id)
-                if not user or not user.get('gift_received', False):
-                    # Add user if doesn't exist
-                    if not user:
-                        await self.add_user(telegram_id)
-                    users_to_gift.append(telegram_id)
-        return users_to_gift
+        self._mark_written(*telegram_ids)
+        async with self._acquire() as conn:
+            async with conn.transaction():
+                # Add users that don't exist yet
+                await conn.execute(INSERT_MISSING_USERS, telegram_ids)
+                # Users that haven't received gift
+                rows = await conn.fetch(GET_NOT_GIFTED_USERS, telegram_ids)
+        not_gifted = {row['telegram_id'] for row in rows}
+        return list(dict.fromkeys(telegram_id for telegram_id in telegram_ids if telegram_id in not_gifted))
 
     async def mark_gift_received(self, telegram_id: int):
         """
@@ -178,81 +409,191 @@ class Database:
         ПОДКЛЮЧЕНИЕ: Получает соединение из пула, выполняет UPDATE,
         возвращает соединение в пул.
         """
-        async with self.pool.acquire() as conn:
-            await conn.execute("UPDATE users SET gift_received = TRUE WHERE telegram_id = $1", telegram_id)
+        self._mark_written(telegram_id)
+        async with self._acquire() as conn:
+            await conn.execute(MARK_GIFT_RECEIVED, telegram_id)
+
+    async def prepare_gift_batch(self, telegram_ids: List[int], channel_name: str,
+                                 start_date: datetime, end_date: datetime, reminder_date: datetime) -> List[int]:
+        """
+        Подготовить пачку пользователей к выдаче подарка (массовый импорт)
+        
+        Добавляет отсутствующих пользователей, выбирает тех, кто еще не получал подарок,
+        и создает им подписку и напоминание. Флаг gift_received не выставляется -
+        это делает complete_gift_batch() после отправки сообщений, поэтому при
+        повторном запуске прерванного импорта подарок не теряется.
+        
+        ПОДКЛЮЧЕНИЕ: Получает соединение из пула, выполняет несколько запросов
+        одной транзакцией, возвращает соединение в пул.
+        """
+        self._mark_written(*telegram_ids)
+        async with self._acquire() as conn:
+            async with conn.transaction():
+                await conn.execute(INSERT_MISSING_USERS, telegram_ids)
+                
+                rows = await conn.fetch(GET_NOT_GIFTED_USERS, telegram_ids)
+                users_to_gift = [row['telegram_id'] for row in rows]
+                if not users_to_gift:
+                    return []
+                
+                # Прежнее состояние подписок - для счетчиков статистики
+                existing = await conn.fetch(LOCK_SUBSCRIPTIONS, users_to_gift, channel_name)
+                old_states = [(row['is_active'], row['payment_method']) for row in existing]
+                old_states += [(False, None)] * (len(users_to_gift) - len(existing))
+                delta = empty_delta()
+                for old_active, old_method in old_states:
+                    merge_delta(delta, subscription_delta(old_active, old_method, True, "gift"))
+                
+                await conn.execute(UPSERT_GIFT_SUBSCRIPTIONS, users_to_gift, channel_name,
+                                   start_date, end_date, clock.now())
+                
+                await conn.execute(UPSERT_GIFT_REMINDERS, users_to_gift, channel_name, reminder_date)
+                
+                await self._apply_stats(conn, channel_name, delta)
+        
+        def update_index():
+            for telegram_id in users_to_gift:
+                subscriber_index.add(telegram_id, channel_name, end_date)
+        self._after_commit(update_index)
+        return users_to_gift
+
+    async def complete_gift_batch(self, job_id: int, gifted_ids: List[int], processed_rows: int,
+                                  imported: int, unresolved: int):
+        """
+        Отметить подарки пачки как полученные и сохранить чекпоинт импорта
+        
+        ПОДКЛЮЧЕНИЕ: Получает соединение из пула, выполняет UPDATE'ы одной транзакцией,
+        возвращает соединение в пул.
+        """
+        async with self._acquire() as conn:
+            async with conn.transaction():
+                if gifted_ids:
+                    await conn.execute(MARK_GIFTS_RECEIVED, gifted_ids)
+                await conn.execute(UPDATE_IMPORT_JOB_PROGRESS, job_id, processed_rows, imported,
+                                   len(gifted_ids), unresolved)
+
+    async def claim_import_job(self, file_unique_id: str, file_name: str, admin_id: int) -> dict:
+        """
+        Захватить импорт файла: создать чекпоинт или продолжить прерванный
+        
+        Повторная загрузка того же файла (тот же file_unique_id) продолжает
+        прерванный импорт с сохраненной строки. Захват атомарный (условный
+        UPSERT), поэтому файл, отправленный повторно во время импорта, второй
+        раз не импортируется. Поле claimed: False - импорт уже выполняется или
+        завершен ('done'), выполнять его не нужно.
+        
+        ПОДКЛЮЧЕНИЕ: Получает соединение из пула, выполняет INSERT ... ON CONFLICT
+        (и SELECT, если импорт не захвачен), возвращает соединение в пул.
+        """
+        async with self._acquire() as conn:
+            row = await conn.fetchrow(CLAIM_IMPORT_JOB, file_unique_id, file_name, admin_id, IMPORT_STALE_MINUTES)
+            if row is not None:
+                return dict(row, claimed=True)
+            row = await conn.fetchrow(GET_IMPORT_JOB, file_unique_id)
+            return dict(row, claimed=False)
+
+    async def finish_import_job(self, job_id: int, status: str = "done"):
+        """
+        Завершить импорт (status: 'done' или 'failed')
+        
+        ПОДКЛЮЧЕНИЕ: Получает соединение из пула, выполняет UPDATE,
+        возвращает соединение в пул.
+        """
+        async with self._acquire() as conn:
+            await conn.execute(FINISH_IMPORT_JOB, job_id, status)
 
     async def create_subscription(self, telegram_id: int, channel_name: str, payment_method: str, 
                                  start_date: datetime, end_date: datetime, is_active: bool = True):
         """
         Создать или обновить подписку
         
-        ПОДКЛЮЧЕНИЕ: Получает соединение из пула, выполняет INSERT ... ON CONFLICT,
-        возвращает соединение в пул.
+        В той же транзакции обновляются счетчики статистики (stats.py).
+        Возвращает True, если активная подписка уже была (продление).
+        
+        ПОДКЛЮЧЕНИЕ: Получает соединение из пула, выполняет SELECT и INSERT/UPDATE
+        одной транзакцией, возвращает соединение в пул.
         """
-        async with self.pool.acquire() as conn:
+        self._mark_written(telegram_id)
+        async with self._atomic() as conn:
             # Check if subscription exists
-            existing = await conn.fetchrow("""
-                SELECT id FROM subscriptions 
-                WHERE telegram_id = $1 AND channel_name = $2
-            """, telegram_id, channel_name)
+            existing = await conn.fetchrow(LOCK_SUBSCRIPTION, telegram_id, channel_name)
             
             if existing:
                 # Update existing subscription
-                await conn.execute("""
-                    UPDATE subscriptions 
-                    SET is_active = $1, payment_method = $2, start_date = $3, end_date = $4
-                    WHERE telegram_id = $5 AND channel_name = $6
-                """, is_active, payment_method, start_date, end_date, telegram_id, channel_name)
+                await conn.execute(UPDATE_SUBSCRIPTION, is_active, payment_method, start_date, end_date,
+                                   telegram_id, channel_name, clock.now())
             else:
                 # Create new subscription
-                await conn.execute("""
-                    INSERT INTO subscriptions (telegram_id, channel_name, is_active, payment_method, start_date, end_date)
-                    VALUES ($1, $2, $3, $4, $5, $6)
-                """, telegram_id, channel_name, is_active, payment_method, start_date, end_date)
+                await conn.execute(INSERT_SUBSCRIPTION, telegram_id, channel_name, is_active, payment_method,
+                                   start_date, end_date, clock.now())
+            
+            if existing:
+                delta = subscription_delta(existing['is_active'], existing['payment_method'],
+                                           is_active, payment_method)
+            else:
+                delta = subscription_delta(False, None, is_active, payment_method)
+            await self._apply_stats(conn, channel_name, delta)
+        
+        if is_active:
+            self._after_commit(lambda: subscriber_index.add(telegram_id, channel_name, end_date))
+        else:
+            self._after_commit(lambda: subscriber_index.discard(telegram_id, channel_name))
+        return bool(existing and existing['is_active'])
 
-    async def get_active_subscription(self, telegram_id: int, channel_name: str) -> Optional[dict]:
+    async def get_active_subscription(self, telegram_id: int, channel_name: str,
+                                      primary: bool = False) -> Optional[Subscription]:
         """
         Получить активную подписку пользователя на канал
         
+        primary=True - читать только с основного сервера (проверка перед баном).
+        
         ПОДКЛЮЧЕНИЕ: Получает соединение из пула, выполняет SELECT,
         возвращает соединение в пул.
         """
-        async with self.pool.acquire() as conn:
-            row = await conn.fetchrow("""
-                SELECT * FROM subscriptions 
-                WHERE telegram_id = $1 AND channel_name = $2 AND is_active = TRUE
-                ORDER BY end_date DESC LIMIT 1
-            """, telegram_id, channel_name)
-            return dict(row) if row else None
+        async with self._acquire(read=not primary, key=telegram_id) as conn:
+            row = await conn.fetchrow(GET_ACTIVE_SUBSCRIPTION, telegram_id, channel_name)
+            return Subscription.from_record(row) if row else None
 
-    async def get_user_subscriptions(self, telegram_id: int) -> List[dict]:
+    async def get_user_subscriptions(self, telegram_id: int) -> List[Subscription]:
         """
         Получить все подписки пользователя
         
         ПОДКЛЮЧЕНИЕ: Получает соединение из пула, выполняет SELECT,
         возвращает соединение в пул.
         """
-        async with self.pool.acquire() as conn:
-            rows = await conn.fetch("""
-                SELECT * FROM subscriptions 
-                WHERE telegram_id = $1
-                ORDER BY end_date DESC
-            """, telegram_id)
-            return [dict(row) for row in rows]
+        async with self._acquire(read=True, key=telegram_id) as conn:
+            rows = await conn.fetch(GET_USER_SUBSCRIPTIONS, telegram_id)
+            return [Subscription.from_record(row) for row in rows]
+
+    async def get_active_subscribers(self) -> List[Subscription]:
+        """
+        Получить все активные подписки (telegram_id, channel_name, end_date)
+        для загрузки индекса subscriber_index
+        
+        Читается с основного сервера: индекс решает заявки на вступление без БД,
+        и в него должна попасть оплата, еще не дошедшая до реплики.
+        
+        ПОДКЛЮЧЕНИЕ: Получает соединение из пула, выполняет SELECT,
+        возвращает соединение в пул.
+        """
+        async with self._acquire() as conn:
+            rows = await conn.fetch(GET_ACTIVE_SUBSCRIBERS)
+            return [Subscription.from_record(row) for row in rows]
 
     async def deactivate_subscription(self, telegram_id: int, channel_name: str):
         """
         Деактивировать подписку
         
-        ПОДКЛЮЧЕНИЕ: Получает соединение из пула, выполняет UPDATE,
-        возвращает соединение в пул.
+        ПОДКЛЮЧЕНИЕ: Получает соединение из пула, выполняет UPDATE (и обновление
+        счетчиков статистики) одной транзакцией, возвращает соединение в пул.
         """
-        async with self.pool.acquire() as conn:
-            await conn.execute("""
-                UPDATE subscriptions 
-                SET is_active = FALSE 
-                WHERE telegram_id = $1 AND channel_name = $2
-            """, telegram_id, channel_name)
+        self._mark_written(telegram_id)
+        async with self._atomic() as conn:
+            old = await conn.fetchrow(DEACTIVATE_SUBSCRIPTION, telegram_id, channel_name, clock.now())
+            if old and old['is_active']:
+                await self._apply_stats(conn, channel_name, subscription_delta(
+                    True, old['payment_method'], False, old['payment_method']))
+        self._after_commit(lambda: subscriber_index.discard(telegram_id, channel_name))
 
     async def has_ever_had_subscription(self, telegram_id: int, channel_name: str) -> bool:
         """
@@ -261,11 +602,8 @@ class Database:
         ПОДКЛЮЧЕНИЕ: Получает соединение из пула, выполняет SELECT,
         возвращает соединение в пул.
         """
-        async with self.pool.acquire() as conn:
-            count = await conn.fetchval("""
-                SELECT COUNT(*) FROM subscriptions 
-                WHERE telegram_id = $1 AND channel_name = $2
-            """, telegram_id, channel_name)
+        async with self._acquire(read=True, key=telegram_id) as conn:
+            count = await conn.fetchval(COUNT_USER_SUBSCRIPTIONS, telegram_id, channel_name)
             return count > 0
 
     async def create_payment(self, telegram_id: int, channel_name: str, amount: int, payment_id: str, status: str = "pending"):
@@ -275,34 +613,172 @@ class Database:
         ПОДКЛЮЧЕНИЕ: Получает соединение из пула, выполняет INSERT,
         возвращает соединение в пул.
         """
-        async with self.pool.acquire() as conn:
-            await conn.execute("""
-                INSERT INTO payments (telegram_id, channel_name, amount, payment_id, status)
-                VALUES ($1, $2, $3, $4, $5)
-            """, telegram_id, channel_name, amount, payment_id, status)
+        self._mark_written(telegram_id, ("payment", payment_id))
+        async with self._atomic() as conn:
+            await conn.execute(INSERT_PAYMENT, telegram_id, channel_name, amount, payment_id, status,
+                               clock.now())
+            if status == "success":
+                await self._apply_stats(conn, channel_name, payment_delta(None, status, amount))
 
     async def update_payment_status(self, payment_id: str, status: str):
         """
         Обновить статус платежа
         
+        Переход в 'success' (или из него) учитывается в счетчиках статистики.
+        
+        ПОДКЛЮЧЕНИЕ: Получает соединение из пула, выполняет UPDATE (и обновление
+        счетчиков статистики) одной транзакцией, возвращает соединение в пул.
+        """
+        self._mark_written(("payment", payment_id))
+        async with self._atomic() as conn:
+            row = await conn.fetchrow(UPDATE_PAYMENT_STATUS, status, payment_id)
+            if row and (row['old_status'] == "success") != (status == "success"):
+                await self._apply_stats(conn, row['channel_name'],
+                                        payment_delta(row['old_status'], status, row['amount']))
+
+    async def confirm_payment(self, payment_id: str) -> Optional[Payment]:
+        """
+        Идемпотентно перевести платеж в статус 'success'
+        
+        Возвращает платеж, только если статус изменил именно этот вызов.
+        Повторное уведомление ResultURL или сверка уже оплаченного платежа
+        получают None - доступ не выдается второй раз.
+        
+        ПОДКЛЮЧЕНИЕ: Получает соединение из пула, выполняет UPDATE ... RETURNING
+        (и обновление счетчиков статистики) одной транзакцией, возвращает соединение в пул.
+        """
+        self._mark_written(("payment", payment_id))
+        async with self._atomic() as conn:
+            row = await conn.fetchrow(CONFIRM_PAYMENT, payment_id)
+            if row is None:
+                return None
+            payment = Payment.from_record(row)
+            await self._apply_stats(conn, payment.channel_name, payment_delta(None, "success", payment.amount))
+            return payment
+
+    async def expire_payment(self, payment_id: str) -> bool:
+        """
+        Пометить неоплаченный платеж как 'expired' (только если он еще 'pending')
+        
         ПОДКЛЮЧЕНИЕ: Получает соединение из пула, выполняет UPDATE,
         возвращает соединение в пул.
         """
-        async with self.pool.acquire() as conn:
-            await conn.execute("""
-                UPDATE payments SET status = $1 WHERE payment_id = $2
-            """, status, payment_id)
+        self._mark_written(("payment", payment_id))
+        async with self._acquire() as conn:
+            result = await conn.execute(EXPIRE_PAYMENT, payment_id)
+            return result.endswith(" 1")
+
+    async def get_stale_pending_payments(self, created_before: datetime, after_id: int, limit: int) -> List[Payment]:
+        """
+        Страница платежей в статусе 'pending', созданных раньше created_before
+        (keyset-пагинация по id, индекс idx_payments_pending)
+        
+        ПОДКЛЮЧЕНИЕ: Получает соединение из пула, выполняет SELECT,
+        возвращает соединение в пул.
+        """
+        async with self._acquire() as conn:
+            rows = await conn.fetch(GET_STALE_PENDING_PAYMENTS, created_before, after_id, limit)
+            return [Payment.from_record(row) for row in rows]
 
-    async def get_payment(self, payment_id: str) -> Optional[dict]:
+    async def get_payment(self, payment_id: str) -> Optional[Payment]:
         """
         Получить платеж по payment_id
         
         ПОДКЛЮЧЕНИЕ: Получает соединение из пула, выполняет SELECT,
         возвращает соединение в пул.
         """
-        async with self.pool.acquire() as conn:
-            row = await conn.fetchrow("SELECT * FROM payments WHERE payment_id = $1", payment_id)
-            return dict(row) if row else None
+        async with self._acquire(read=True, key=("payment", payment_id)) as conn:
+            row = await conn.fetchrow(GET_PAYMENT, payment_id)
+            return Payment.from_record(row) if row else None
+
+    async def get_stats(self, since: date) -> dict:
+        """
+        Статистика из сводных таблиц (stats.py): по каналам - текущие счетчики
+        и итоги за все время, по дням - строки начиная с since
+        
+        ПОДКЛЮЧЕНИЕ: Получает соединение из пула (можно реплику), выполняет три SELECT,
+        возвращает соединение в пул.
+        """
+        async with self._acquire(read=True) as conn:
+            gauges = await conn.fetch(GET_CHANNEL_STATS)
+            totals = await conn.fetch(GET_STATS_TOTALS)
+            daily = await conn.fetch(GET_DAILY_STATS, since)
+        
+        channels: Dict[str, dict] = {}
+        for row in gauges:
+            channels.setdefault(row['channel_name'], empty_delta()).update(
+                {field: row[field] for field in GAUGE_FIELDS})
+        for row in totals:
+            channels.setdefault(row['channel_name'], empty_delta()).update(
+                {field: row[field] for field in DAILY_FIELDS})
+        return {'channels': channels, 'daily': [dict(row) for row in daily]}
+
+    async def export_csv(self, table: str, path: str, channel_name: str = None, status: str = None,
+                         since: datetime = None, until: datetime = None) -> int:
+        """
+        Выгрузить payments или subscriptions в CSV-файл (COPY ... TO STDOUT)
+        
+        Фильтры: канал, статус ('pending'/'success'/'expired' для платежей,
+        'active'/'inactive' для подписок), created_at в [since, until).
+        Строки пишутся в файл по мере получения (память не зависит от объема),
+        а соединение занято только на время COPY - отдача файла клиенту идет
+        уже без него (см. export.py). Возвращает число выгруженных строк.
+        
+        ПОДКЛЮЧЕНИЕ: Получает соединение из пула (можно реплику), выполняет COPY,
+        возвращает соединение в пул.
+        """
+        columns = EXPORT_COLUMNS[table]
+        conditions, args = [], []
+        if channel_name:
+            args.append(channel_name)
+            conditions.append(f"channel_name = ${len(args)}")
+        if status and table == "payments":
+            args.append(status)
+            conditions.append(f"status = ${len(args)}")
+        elif status:
+            args.append(status == "active")
+            conditions.append(f"is_active = ${len(args)}")
+        if since:
+            args.append(since)
+            conditions.append(f"created_at >= ${len(args)}")
+        if until:
+            args.append(until)
+            conditions.append(f"created_at < ${len(args)}")
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        
+        async with self._acquire(read=True) as conn:
+            result = await conn.copy_from_query(
+                f"SELECT {', '.join(columns)} FROM {table} {where} ORDER BY id",
+                *args, output=path, format="csv", header=True
+            )
+        return int(result.split()[-1])
+
+    async def write_events(self, events: List[tuple]):
+        """
+        Записать пачку событий в subscription_events (см. events.py)
+        
+        events - кортежи (occurred_at, telegram_id, channel_name, event, details_json).
+        Бинарный COPY: одна операция на всю пачку, без разбора SQL на каждую строку.
+        
+        ПОДКЛЮЧЕНИЕ: Получает соединение из пула, выполняет COPY,
+        возвращает соединение в пул.
+        """
+        async with self._acquire() as conn:
+            await conn.copy_records_to_table(
+                "subscription_events", records=events,
+                columns=("occurred_at", "telegram_id", "channel_name", "event", "details")
+            )
+
+    async def get_user_events(self, telegram_id: int, limit: int = 50) -> List[dict]:
+        """
+        Последние события пользователя (новые сверху)
+        
+        ПОДКЛЮЧЕНИЕ: Получает соединение из пула (можно реплику), выполняет SELECT,
+        возвращает соединение в пул.
+        """
+        async with self._acquire(read=True) as conn:
+            rows = await conn.fetch(GET_USER_EVENTS, telegram_id, limit)
+            return [dict(row) for row in rows]
 
     async def create_reminder(self, telegram_id: int, channel_name: str, reminder_date: datetime):
         """
@@ -311,13 +787,9 @@ class Database:
         ПОДКЛЮЧЕНИЕ: Получает соединение из пула, выполняет INSERT ... ON CONFLICT,
         возвращает соединение в пул.
         """
-        async with self.pool.acquire() as conn:
-            await conn.execute("""
-                INSERT INTO reminders (telegram_id, channel_name, reminder_date, reminder_sent)
-                VALUES ($1, $2, $3, FALSE)
-                ON CONFLICT (telegram_id, channel_name) 
-                DO UPDATE SET reminder_date = EXCLUDED.reminder_date, reminder_sent = FALSE
-            """, telegram_id, channel_name, reminder_date)
+        self._mark_written(telegram_id)
+        async with self._acquire() as conn:
+            await conn.execute(UPSERT_REMINDER, telegram_id, channel_name, reminder_date)
 
     async def mark_reminder_sent(self, telegram_id: int, channel_name: str):
         """
@@ -326,98 +798,250 @@ class Database:
         ПОДКЛЮЧЕНИЕ: Получает соединение из пула, выполняет UPDATE,
         возвращает соединение в пул.
         """
-        async with self.pool.acquire() as conn:
-            await conn.execute("""
-                UPDATE reminders SET reminder_sent = TRUE 
-                WHERE telegram_id = $1 AND channel_name = $2
-            """, telegram_id, channel_name)
+        self._mark_written(telegram_id)
+        async with self._acquire() as conn:
+            await conn.execute(MARK_REMINDER_SENT, telegram_id, channel_name)
 
-    async def get_pending_reminders(self) -> List[dict]:
+    async def get_pending_reminders(self) -> List[Reminder]:
         """
         Получить все неотправленные напоминания
         
         ПОДКЛЮЧЕНИЕ: Получает соединение из пула, выполняет SELECT,
         возвращает соединение в пул.
         """
-        async with self.pool.acquire() as conn:
-            rows = await conn.fetch("""
-                SELECT * FROM reminders 
-                WHERE reminder_sent = FALSE AND reminder_date <= $1
-            """, datetime.now())
-            return [dict(row) for row in rows]
+        async with self._acquire(read=True) as conn:
+            rows = await conn.fetch(GET_PENDING_REMINDERS, clock.now())
+            return [Reminder.from_record(row) for row in rows]
 
-    async def get_expiring_subscriptions(self) -> List[dict]:
+    async def get_expiring_subscriptions(self) -> List[Subscription]:
         """
         Получить подписки, истекающие в ближайшее время
         
         ПОДКЛЮЧЕНИЕ: Получает соединение из пула, выполняет SELECT,
         возвращает соединение в пул.
         """
-        async with self.pool.acquire() as conn:
-            now = datetime.now()
+        async with self._acquire() as conn:
+            now = clock.now()
             end_date = now + timedelta(days=3)
-            rows = await conn.fetch("""
-                SELECT * FROM subscriptions 
-                WHERE is_active = TRUE 
-                AND end_date BETWEEN $1 AND $2
-                AND payment_method = 'gift'
-            """, now, end_date)
-            return [dict(row) for row in rows]
+            rows = await conn.fetch(GET_EXPIRING_GIFT_SUBSCRIPTIONS, now, end_date)
+            return [Subscription.from_record(row) for row in rows]
+
+    async def _iter_pages(self, model, query: str, *args, batch_size: int = 500):
+        """
+        Потоково читать результат запроса страницами по id (async-генератор моделей)
+        
+        query получает args, затем id последней строки предыдущей страницы и
+        размер страницы (WHERE ... AND id > $n ORDER BY id LIMIT $n+1).
+        В памяти одновременно находится не больше batch_size строк.
+        
+        Соединение возвращается в пул до обработки строк страницы: вызовы Bot API
+        и записи вызывающего кода не держат соединение и долгую транзакцию
+        (которая мешала бы VACUUM при большой догоняющей обработке).
+        
+        ПОДКЛЮЧЕНИЕ: Получает соединение из пула на каждую страницу, выполняет SELECT,
+        возвращает соединение в пул.
+        """
+        after_id = 0
+        while True:
+            async with self._acquire() as conn:
+                rows = await conn.fetch(query, *args, after_id, batch_size)
+            for row in rows:
+                yield model.from_record(row)
+            if len(rows) < batch_size:
+                break
+            after_id = rows[-1]['id']
+
+    def iter_expired_subscriptions(self, batch_size: int = 500) -> AsyncIterator[Subscription]:
+        """
+        Потоково получить истекшие подписки (режим итератора для больших объемов)
+        
+            async for subscription in db.iter_expired_subscriptions():
+                ...
+        """
+        return self._iter_pages(Subscription, GET_EXPIRED_SUBSCRIPTIONS_PAGE, clock.now(), batch_size=batch_size)
+
+    def iter_pending_reminders(self, batch_size: int = 500) -> AsyncIterator[Reminder]:
+        """Потоково получить неотправленные напоминания (режим итератора)"""
+        return self._iter_pages(Reminder, GET_PENDING_REMINDERS_PAGE, clock.now(), batch_size=batch_size)
+
+    async def get_subscriptions_page(self, after_id: int, limit: int) -> List[Subscription]:
+        """
+        Получить страницу всех подписок по возрастанию id (keyset-пагинация)
+        
+        Читается с основного сервера: по странице сверка решает, кого банить.
+        
+        ПОДКЛЮЧЕНИЕ: Получает соединение из пула, выполняет SELECT,
+        возвращает соединение в пул.
+        """
+        async with self._acquire() as conn:
+            rows = await conn.fetch(GET_SUBSCRIPTIONS_PAGE, after_id, limit)
+            return [Subscription.from_record(row) for row in rows]
 
-    async def get_expired_subscriptions(self) -> List[dict]:
+    async def get_changed_subscriptions_page(self, since: datetime, after_ts: datetime,
+                                             after_id: int, limit: int) -> List[Subscription]:
         """
-        Получить истекшие подписки (все активные подписки, у которых end_date прошла)
+        Получить страницу подписок, измененных после since (keyset по (updated_at, id))
+        
+        after_ts/after_id - последняя строка предыдущей страницы.
+        Использует индекс idx_subscriptions_updated_at. Читается с основного
+        сервера: по странице сверка решает, кого банить.
         
         ПОДКЛЮЧЕНИЕ: Получает соединение из пула, выполняет SELECT,
         возвращает соединение в пул.
         """
-        async with self.pool.acquire() as conn:
-            now = datetime.now()
-            
-            # Сначала проверим все активные подписки для отладки
-            all_active = await conn.fetch("""
-                SELECT telegram_id, channel_name, end_date, is_active 
-                FROM subscriptions 
-                WHERE is_active = TRUE
-                ORDER BY end_date ASC
-            """)
-            print(f"[DB] Всего активных подписок: {len(all_active)}")
-            for sub in all_active:
-                sub_dict = dict(sub)
-                end_date = sub_dict['end_date']
-                if isinstance(end_date, str):
-                    end_date = datetime.fromisoformat(end_date.replace('Z', '+00:00'))
-                elif hasattr(end_date, 'replace'):
-                    end_date = end_date.replace(tzinfo=None)
-                print(f"  - User {sub_dict['telegram_id']}, channel {sub_dict['channel_name']}, end_date: {end_date} (now: {now}, expired: {end_date < now})")
-            
-            # Теперь ищем истекшие
-            rows = await conn.fetch("""
-                SELECT * FROM subscriptions 
-                WHERE is_active = TRUE 
-                AND end_date < $1
-                ORDER BY end_date ASC
-            """, now)
-            result = [dict(row) for row in rows]
-            
-            # Логируем для отладки
-            if result:
-                print(f"[DB] ✅ Found {len(result)} expired subscriptions (current time: {now})")
-                for sub in result:
-                    end_date = sub['end_date']
-                    if isinstance(end_date, str):
-                        end_date = datetime.fromisoformat(end_date.replace('Z', '+00:00'))
-                    elif hasattr(end_date, 'replace'):
-                        end_date = end_date.replace(tzinfo=None)
-                    print(f"  - User {sub['telegram_id']}, channel {sub['channel_name']}, end_date: {end_date}")
-            else:
-                print(f"[DB] ❌ No expired subscriptions found (current time: {now})")
-            return result
+        async with self._acquire() as conn:
+            rows = await conn.fetch(GET_CHANGED_SUBSCRIPTIONS_PAGE, since, after_ts, after_id, limit)
+            return [Subscription.from_record(row) for row in rows]
+
+    async def get_checkpoint(self, job_name: str) -> Optional[dict]:
+        """
+        Получить чекпоинт фоновой задачи
+        
+        ПОДКЛЮЧЕНИЕ: Получает соединение из пула, выполняет SELECT,
+        возвращает соединение в пул.
+        """
+        async with self._acquire() as conn:
+            row = await conn.fetchrow(GET_CHECKPOINT, job_name)
+            return dict(row) if row else None
+
+    async def save_checkpoint(self, job_name: str, cursor_id: int, cursor_ts: Optional[datetime],
+                              watermark: Optional[datetime]):
+        """
+        Сохранить чекпоинт фоновой задачи
+        
+        ПОДКЛЮЧЕНИЕ: Получает соединение из пула, выполняет INSERT ... ON CONFLICT,
+        возвращает соединение в пул.
+        """
+        async with self._acquire() as conn:
+            await conn.execute(SAVE_CHECKPOINT, job_name, cursor_id, cursor_ts, watermark)
+
+    async def create_broadcast(self, admin_id: int, channel_name: str, text: str) -> dict:
+        """
+        Создать рассылку по активным подписчикам канала
+        
+        Количество получателей фиксируется в total для расчета прогресса и ETA.
+        
+        ПОДКЛЮЧЕНИЕ: Получает соединение из пула, выполняет INSERT,
+        возвращает соединение в пул.
+        """
+        async with self._acquire() as conn:
+            row = await conn.fetchrow(CREATE_BROADCAST, admin_id, channel_name, text)
+            return dict(row)
+
+    async def set_broadcast_progress_message(self, broadcast_id: int, chat_id: int, message_id: int):
+        """
+        Запомнить сообщение с прогрессом рассылки (чтобы обновлять его после перезапуска)
+        
+        ПОДКЛЮЧЕНИЕ: Получает соединение из пула, выполняет UPDATE,
+        возвращает соединение в пул.
+        """
+        async with self._acquire() as conn:
+            await conn.execute(SET_BROADCAST_PROGRESS_MESSAGE, broadcast_id, chat_id, message_id)
+
+    async def get_running_broadcasts(self) -> List[dict]:
+        """
+        Получить незавершенные рассылки (для продолжения после перезапуска)
+        
+        ПОДКЛЮЧЕНИЕ: Получает соединение из пула, выполняет SELECT,
+        возвращает соединение в пул.
+        """
+        async with self._acquire() as conn:
+            rows = await conn.fetch(GET_RUNNING_BROADCASTS)
+            return [dict(row) for row in rows]
+
+    async def iter_broadcast_recipients(self, broadcast_id: int, channel_name: str, batch_size: int):
+        """
+        Потоково получить получателей рассылки пачками (async-генератор)
+        
+        Пачки читаются страницами по telegram_id, поэтому память не зависит от числа
+        подписчиков. Получатели, которым рассылка уже доставлялась, пропускаются -
+        так прерванная рассылка продолжается с места остановки.
+        
+        ПОДКЛЮЧЕНИЕ: Получает соединение из пула на каждую пачку, выполняет SELECT,
+        возвращает соединение в пул до отправки пачки (рассылка идет часами -
+        соединение и транзакция на все время обхода заняли бы слот пула и мешали VACUUM).
+        """
+        after_id = 0
+        while True:
+            async with self._acquire() as conn:
+                rows = await conn.fetch(GET_BROADCAST_RECIPIENTS, channel_name, broadcast_id, after_id, batch_size)
+            if not rows:
+                break
+            yield [row['telegram_id'] for row in rows]
+            if len(rows) < batch_size:
+                break
+            after_id = rows[-1]['telegram_id']
+
+    async def record_broadcast_deliveries(self, broadcast_id: int, deliveries: List[tuple]):
+        """
+        Сохранить результаты доставки пачки: список (telegram_id, status, error)
+        
+        Доставка 'retry' (временная ошибка) не попадает в счетчики и заменяется
+        результатом следующей попытки.
+        
+        ПОДКЛЮЧЕНИЕ: Получает соединение из пула, выполняет INSERT (executemany)
+        и UPDATE счетчиков одной транзакцией, возвращает соединение в пул.
+        """
+        sent = sum(1 for _, status, _ in deliveries if status == 'sent')
+        failed = sum(1 for _, status, _ in deliveries if status in ('blocked', 'failed'))
+        async with self._acquire() as conn:
+            async with conn.transaction():
+                await conn.executemany(INSERT_BROADCAST_DELIVERY, [
+                    (broadcast_id, telegram_id, status, error) for telegram_id, status, error in deliveries
+                ])
+                await conn.execute(ADD_BROADCAST_COUNTERS, broadcast_id, sent, failed)
+
+    async def finish_broadcast(self, broadcast_id: int, status: str = "done"):
+        """
+        Завершить рассылку (status: 'done' или 'failed')
+        
+        ПОДКЛЮЧЕНИЕ: Получает соединение из пула, выполняет UPDATE,
+        возвращает соединение в пул.
+        """
+        async with self._acquire() as conn:
+            await conn.execute(FINISH_BROADCAST, broadcast_id, status)
+
+    def pool_stats(self) -> dict:
+        """Состояние пулов и кэша подготовленных запросов (для /dbstats)"""
+        def describe(pool: Optional[asyncpg.Pool]) -> Optional[dict]:
+            if pool is None:
+                return None
+            return {"size": pool.get_size(), "idle": pool.get_idle_size(),
+                    "min_size": pool.get_min_size(), "max_size": pool.get_max_size()}
+        
+        return {
+            "backend": "postgres",
+            "pgbouncer": DB_PGBOUNCER,
+            "pool": describe(self.pool),
+            "replica_pool": describe(self.replica_pool),
+            "command_timeout": DB_COMMAND_TIMEOUT,
+            "max_inactive_lifetime": DB_MAX_INACTIVE_CONNECTION_LIFETIME,
+            "statements": len(STATEMENTS),
+            "statement_cache": {
+                "size": 0 if DB_PGBOUNCER else DB_STATEMENT_CACHE_SIZE,
+                "prepared": statement_stats["prepared"],
+                "prepared_connections": statement_stats["connections"],
+                "prepare_errors": statement_stats["prepare_errors"],
+                **cache_usage(),
+            },
+        }
 
     async def close(self):
-        """Закрыть пул соединений"""
+        """Закрыть пулы соединений"""
+        if self._replica_monitor:
+            self._replica_monitor.cancel()
+        if self.replica_pool:
+            await self.replica_pool.close()
         if self.pool:
             await self.pool.close()
 
+def create_storage():
+    """Создать хранилище по DB_BACKEND (см. storage.Storage)"""
+    if DB_BACKEND == "memory":
+        from memory_storage import MemoryDatabase
+        # Несколько арендаторов - отдельное хранилище на каждого
+        return MemoryDatabase() if len(TENANTS) == 1 else TenantLocal(MemoryDatabase)
+    return Database()
+
 # Глобальный экземпляр базы данных для использования во всех модулях
-db = Database()
+db = create_storage()
@@ -0,0 +1,138 @@
+"""
+EVENT LOOP: ВЫБОР РЕАЛИЗАЦИИ И КОНТРОЛЬ ЗАДЕРЖКИ
+
+Polling, веб-сервер Robokassa, планировщик и вся работа с БД идут в одном
+event loop, поэтому любой блокирующий вызов задерживает всех.
+
+LoopLagMonitor:
+- корутина-пульс раз в LOOP_LAG_INTERVAL_MS измеряет, насколько позже
+  запланированного она проснулась (задержка планирования);
+- сторожевой поток замечает, что пульса нет дольше LOOP_LAG_THRESHOLD_MS,
+  и пишет в лог стек потока event loop и имя текущей задачи - то есть
+  место блокировки, пока она еще продолжается.
+
+select_event_loop() включает uvloop (EVENT_LOOP=uvloop), если он установлен.
+"""
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from typing import Optional
+from config import LOOP_LAG_INTERVAL_MS, LOOP_LAG_THRESHOLD_MS
+
+logger = logging.getLogger(__name__)
+
+
+def select_event_loop(name: str) -> str:
+    """
+    Установить политику event loop до asyncio.run()
+
+    Returns:
+        Название фактически используемой реализации
+    """
+    if name == "uvloop":
+        try:
+            import uvloop
+        except ImportError:
+            logger.warning("EVENT_LOOP=uvloop, но uvloop не установлен - используется asyncio")
+            return "asyncio"
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        return "uvloop"
+    return "asyncio"
+
+
+class LoopLagMonitor:
+    """Непрерывный замер задержки event loop и стеки длительных блокировок"""
+
+    def __init__(self, interval_ms: float, threshold_ms: float, window: int = 600):
+        self.interval = interval_ms / 1000
+        self.threshold = threshold_ms / 1000
+        # Последние замеры задержки (секунды) для перцентилей
+        self.recent = deque(maxlen=window)
+        self.samples = 0
+        self.total_lag = 0.0
+        self.max_lag = 0.0
+        self.stalls = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._running = False
+        self._last_beat = 0.0
+        self._stall_reported = False
+
+    def start(self):
+        """Запустить пульс и сторожевой поток (вызывается внутри работающего loop)"""
+        if self._running:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._running = True
+        self._task = self._loop.create_task(self._heartbeat())
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+
+    def stop(self):
+        self._running = False
+        if self._task:
+            self._task.cancel()
+
+    async def _heartbeat(self):
+        loop = asyncio.get_running_loop()
+        while self._running:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - expected)
+            self._last_beat = time.monotonic()
+            self.samples += 1
+            self.total_lag += lag
+            self.max_lag = max(self.max_lag, lag)
+            self.recent.append(lag)
+            if lag > self.threshold:
+                self.stalls += 1
+                if self._stall_reported:
+                    logger.warning(f"[LOOP] Event loop was blocked for {lag * 1000:.0f} ms")
+            self._stall_reported = False
+
+    def _watch(self):
+        while self._running:
+            time.sleep(self.interval / 2)
+            blocked = time.monotonic() - self._last_beat - self.interval
+            if blocked > self.threshold and not self._stall_reported:
+                self._stall_reported = True
+                self._report_stall(blocked)
+
+    def _report_stall(self, blocked: float):
+        """Стек потока event loop и текущая задача в момент блокировки"""
+        frame = sys._current_frames().get(self._loop_thread)
+        stack = "".join(traceback.format_stack(frame)) if frame is not None else "<нет стека>"
+        try:
+            task = asyncio.current_task(self._loop)
+            task_name = task.get_name() if task else "<вне задачи>"
+        except RuntimeError:
+            task_name = "<неизвестно>"
+        logger.warning(
+            f"[LOOP] Event loop blocked for {blocked * 1000:.0f} ms+ in task {task_name}:\n{stack}"
+        )
+
+    def percentile(self, q: float) -> float:
+        if not self.recent:
+            return 0.0
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def summary(self) -> str:
+        average = self.total_lag / self.samples if self.samples else 0.0
+        return (
+            f"Event loop: задержка средняя {average * 1000:.1f} мс, "
+            f"p99 {self.percentile(0.99) * 1000:.1f} мс, макс. {self.max_lag * 1000:.0f} мс, "
+            f"блокировок > {self.threshold * 1000:.0f} мс: {self.stalls}"
+        )
+
+
+# Глобальный монитор, запускается в main.on_startup
+loop_monitor = LoopLagMonitor(LOOP_LAG_INTERVAL_MS, LOOP_LAG_THRESHOLD_MS)
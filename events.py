@@ -0,0 +1,145 @@
+"""
+ЖУРНАЛ СОБЫТИЙ ПОДПИСОК (subscription_events)
+
+Строка подписки перезаписывается при продлении и деактивации, поэтому история
+пользователя хранится отдельно - в журнале, который только дополняется:
+выдача и продление подписки, напоминание, истечение, бан, подтверждение оплаты.
+
+event_log.record() не обращается к БД: событие добавляется в буфер в памяти.
+Фоновая задача пишет буфер пачками через бинарный COPY (db.write_events) -
+раз в EVENT_LOG_FLUSH_SECONDS или сразу при накоплении EVENT_LOG_BATCH_SIZE
+событий. При остановке бота буфер дописывается (event_log.stop()).
+
+История пользователя - /history <telegram_id>; выборки по времени
+используют BRIN-индекс по occurred_at.
+
+Буфер общий для всех арендаторов (tenants.py): событие запоминает арендатора,
+в контексте которого записано, и пишется в его схему.
+"""
+import asyncio
+import json
+from typing import Dict, List, Optional, Tuple
+from clock import clock
+from database import db
+from config import EVENT_LOG_FLUSH_SECONDS, EVENT_LOG_BATCH_SIZE, EVENT_LOG_MAX_BUFFER
+from tenants import Tenant, current_tenant, tenant_context
+
+# Типы событий
+GRANTED = "granted"
+RENEWED = "renewed"
+REMINDED = "reminded"
+EXPIRED = "expired"
+BANNED = "banned"
+PAYMENT_CONFIRMED = "payment_confirmed"
+
+
+class EventLog:
+    """Буфер событий с пакетной записью в subscription_events"""
+
+    def __init__(self, flush_seconds: float, batch_size: int, max_buffer: int):
+        self.flush_seconds = flush_seconds
+        self.batch_size = batch_size
+        self.max_buffer = max_buffer
+        # (арендатор, строка subscription_events)
+        self._buffer: List[Tuple[Tenant, tuple]] = []
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self.recorded = 0
+        self.written = 0
+        self.dropped = 0
+        self.flushes = 0
+        self.failures = 0
+
+    def record(self, event: str, telegram_id: int, channel_name: str = None, **details):
+        """Добавить событие в буфер (без обращения к БД)"""
+        self._buffer.append((current_tenant(), (
+            clock.now(), telegram_id, channel_name, event,
+            json.dumps(details, ensure_ascii=False, default=str) if details else None
+        )))
+        self.recorded += 1
+        if len(self._buffer) > self.max_buffer:
+            del self._buffer[0]
+            self.dropped += 1
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    async def flush(self) -> int:
+        """Записать накопленные события одной пачкой; вернуть их число"""
+        if not self._buffer:
+            return 0
+        batch, self._buffer = self._buffer, []
+        by_tenant: Dict[Tenant, List[tuple]] = {}
+        for tenant, row in batch:
+            by_tenant.setdefault(tenant, []).append(row)
+        
+        written, failed = 0, []
+        for tenant, rows in by_tenant.items():
+            try:
+                with tenant_context(tenant):
+                    await db.write_events(rows)
+            except Exception as e:
+                self.failures += 1
+                failed += [(tenant, row) for row in rows]
+                print(f"[EVENTS] Could not write {len(rows)} events of {tenant.name}, will retry: {e}")
+            else:
+                written += len(rows)
+        
+        if failed:
+            # Непринятые события возвращаются в начало буфера и будут записаны следующей попыткой
+            self._buffer = failed + self._buffer
+            overflow = len(self._buffer) - self.max_buffer
+            if overflow > 0:
+                del self._buffer[:overflow]
+                self.dropped += overflow
+        if written:
+            self.written += written
+            self.flushes += 1
+        return written
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+        await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Остановить фоновую запись, дописав буфер"""
+        if self._task is None:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+
+    def summary(self) -> str:
+        return (
+            f"Журнал событий: записано {self.written} из {self.recorded}, в буфере {len(self._buffer)}, "
+            f"пачек {self.flushes}, ошибок записи {self.failures}, отброшено {self.dropped}"
+        )
+
+
+def format_history(telegram_id: int, events: List[dict]) -> str:
+    """Текст /history: события пользователя, новые сверху"""
+    if not events:
+        return f"Событий пользователя {telegram_id} нет."
+    lines = [f"История пользователя {telegram_id}:"]
+    for event in events:
+        line = f"{event['occurred_at']:%d.%m.%Y %H:%M} {event['channel_name'] or '-'}: {event['event']}"
+        if event['details']:
+            line += f" {event['details']}"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+# Глобальный журнал событий
+event_log = EventLog(EVENT_LOG_FLUSH_SECONDS, EVENT_LOG_BATCH_SIZE, EVENT_LOG_MAX_BUFFER)
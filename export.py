@@ -0,0 +1,128 @@
+"""
+ВЫГРУЗКА ПЛАТЕЖЕЙ И ПОДПИСОК В CSV (/export, GET /admin/export)
+
+Выгрузка идет в два шага:
+1. db.export_csv() - COPY ... TO STDOUT в CSV, строки пишутся во временный
+   файл по мере получения. Соединение из пула занято только на время COPY.
+2. Файл отдается администратору документом Telegram или HTTP-ответом
+   (частями), уже без соединения с БД - медленный клиент не держит пул.
+Память не зависит от числа строк. Временный файл удаляется после отправки.
+
+Фильтры: channel, status ('pending'/'success'/'expired' для payments,
+'active'/'inactive' для subscriptions), from/to - created_at в [from, to).
+"""
+import asyncio
+import hmac
+import os
+import tempfile
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Mapping
+from aiohttp import web
+from clock import clock
+from config import ADMIN_API_TOKEN
+
+# Колонки выгрузки по таблицам
+EXPORT_COLUMNS = {
+    "payments": ("id", "telegram_id", "channel_name", "amount", "payment_id", "status", "created_at"),
+    "subscriptions": ("id", "telegram_id", "channel_name", "is_active", "payment_method",
+                      "start_date", "end_date", "created_at", "updated_at"),
+}
+EXPORT_STATUSES = {
+    "payments": ("pending", "success", "expired"),
+    "subscriptions": ("active", "inactive"),
+}
+
+# Размер части файла при отдаче по HTTP
+EXPORT_CHUNK_SIZE = 256 * 1024
+
+# Лимит размера документа, который бот может отправить в Telegram
+TELEGRAM_DOCUMENT_LIMIT = 50 * 1024 * 1024
+
+# Одновременных выгрузок (каждая - долгий COPY на соединении из пула)
+_export_slots = asyncio.Semaphore(2)
+
+
+def parse_export_filters(table: str, params: Mapping[str, str]) -> dict:
+    """
+    Фильтры выгрузки из параметров (channel, status, from, to)
+
+    Raises:
+        ValueError: неизвестная таблица, статус или неверная дата
+    """
+    if table not in EXPORT_COLUMNS:
+        raise ValueError(f"table must be one of: {', '.join(EXPORT_COLUMNS)}")
+    status = params.get("status")
+    if status and status not in EXPORT_STATUSES[table]:
+        raise ValueError(f"status for {table} must be one of: {', '.join(EXPORT_STATUSES[table])}")
+    return {
+        "channel_name": params.get("channel"),
+        "status": status,
+        "since": datetime.fromisoformat(params["from"]) if params.get("from") else None,
+        "until": datetime.fromisoformat(params["to"]) if params.get("to") else None,
+    }
+
+
+def export_filename(table: str) -> str:
+    return f"{table}_{clock.now():%Y%m%d_%H%M}.csv"
+
+
+@asynccontextmanager
+async def exported_csv(table: str, filters: dict):
+    """
+    Временный CSV-файл с выгрузкой: yield (путь, число строк)
+
+        async with exported_csv("payments", filters) as (path, rows):
+            ...отправить файл...
+    """
+    from database import db
+
+    fd, path = tempfile.mkstemp(prefix=f"export_{table}_", suffix=".csv")
+    os.close(fd)
+    try:
+        async with _export_slots:
+            rows = await db.export_csv(table, path, **filters)
+        yield path, rows
+    finally:
+        os.remove(path)
+
+
+async def export_http_handler(request):
+    """
+    GET /admin/export?table=payments[&channel=...&status=...&from=2026-01-01&to=2026-02-01]
+    Токен: заголовок X-Admin-Token или параметр token.
+    """
+    token = request.headers.get("X-Admin-Token") or request.query.get("token", "")
+    if not hmac.compare_digest(token, ADMIN_API_TOKEN):
+        return web.Response(status=403, text="Forbidden")
+    table = request.query.get("table", "")
+    try:
+        filters = parse_export_filters(table, request.query)
+    except ValueError as e:
+        return web.Response(status=400, text=str(e))
+
+    loop = asyncio.get_running_loop()
+    async with exported_csv(table, filters) as (path, rows):
+        response = web.StreamResponse(headers={
+            "Content-Type": "text/csv; charset=utf-8",
+            "Content-Disposition": f'attachment; filename="{export_filename(table)}"',
+            "X-Export-Rows": str(rows),
+        })
+        response.content_length = os.path.getsize(path)
+        await response.prepare(request)
+        # Файл отдается частями до выхода из блока, который его удалит
+        with open(path, "rb") as csv_file:
+            while True:
+                chunk = await loop.run_in_executor(None, csv_file.read, EXPORT_CHUNK_SIZE)
+                if not chunk:
+                    break
+                await response.write(chunk)
+        await response.write_eof()
+    return response
+
+
+def setup_export_routes(app: web.Application):
+    """Маршрут /admin/export (только если задан ADMIN_API_TOKEN)"""
+    if not ADMIN_API_TOKEN:
+        return
+    app.router.add_get('/admin/export', export_http_handler)
@@ -1,7 +1,9 @@
+import os
 from aiogram import Router, F
-from aiogram.types import Message, CallbackQuery
+from aiogram.types import Message, CallbackQuery, ChatJoinRequest
 from aiogram.filters import Command
 from datetime import datetime, timedelta
+from clock import clock
 from typing import Optional
 from database import db
 from keyboards import (
@@ -12,42 +14,75 @@ from messages import (
     get_start_message, get_channel_1_info_message, get_channel_2_info_message,
     get_subscriptions_message, get_legal_info_message, get_gift_welcome_message,
     get_reminder_message, get_expired_message, get_payment_success_message,
-    get_payment_success_with_bonus_message
+    get_payment_success_with_bonus_message, get_join_request_declined_message
 )
 from robokassa import generate_payment_url
-from config import (
-    CHANNEL_1_ID, CHANNEL_2_ID, CHANNEL_1_PRICE, CHANNEL_2_PRICE,
-    FREE_TRIAL_DAYS, PAID_SUBSCRIPTION_DAYS, ADMIN_IDS
-)
+from throttling import telegram_limiter, call_with_retry
+from user_resolver import resolve_user_identifiers
+from subscriber_index import subscriber_index
+from profiler import profiler, ProfilingMiddleware
+from events import event_log, GRANTED, RENEWED
+from tenants import current_tenant, TENANTS, format_tenant_metrics
+from statements import format_pool_stats
+from render_cache import edit_if_changed, render_cache
+from jobs import job_runner, start_background, QUEUED, DONE
+from config import FREE_TRIAL_DAYS, PAID_SUBSCRIPTION_DAYS
 from aiogram import Bot
 
 router = Router()
 
+# Профилирование выбранных выполнений обработчиков (включается командой /profile)
+for observer in (router.message, router.callback_query, router.chat_join_request):
+    observer.middleware(ProfilingMiddleware())
+
+# Кэш ссылок на вступление по заявке: channel_id -> ссылка (каналы всех арендаторов)
+_join_links = {
+    channel.channel_id: channel.join_link
+    for tenant in TENANTS for channel in tenant.channels.values()
+}
+
+async def get_join_request_link(bot: Bot, channel_id: str) -> Optional[str]:
+    """
+    Получить общую ссылку на вступление в канал по заявке (creates_join_request)
+    
+    Ссылка одна на канал: берется из конфигурации или создается один раз
+    и кэшируется. Заявки одобряет on_chat_join_request по индексу подписчиков.
+    """
+    if _join_links.get(channel_id):
+        return _join_links[channel_id]
+    try:
+        invite_link = await call_with_retry(
+            telegram_limiter,
+            lambda: bot.create_chat_invite_link(
+                chat_id=channel_id,
+                name="Подписчики",
+                creates_join_request=True
+            )
+        )
+        _join_links[channel_id] = invite_link.invite_link
+        return invite_link.invite_link
+    except Exception as e:
+        print(f"Note: Could not create join request link for {channel_id}: {e}")
+        return None
+
 async def add_user_to_channel(bot: Bot, user_id: int, channel_id: str):
     """Add user to channel"""
     try:
-        # Разбаниваем пользователя (если был забанен) - это позволяет ему присоединиться
-        await bot.unban_chat_member(chat_id=channel_id, user_id=user_id, only_if_banned=False)
+        # Разбаниваем пользователя (если был забанен) - это позволяет ему подать заявку.
+        # only_if_banned=True: иначе Telegram удаляет из канала текущего участника
+        await bot.unban_chat_member(chat_id=channel_id, user_id=user_id, only_if_banned=True)
         
-        # Для приватных каналов создаем одноразовую ссылку-приглашение
-        try:
-            invite_link = await bot.create_chat_invite_link(
-                chat_id=channel_id,
-                member_limit=1,  # Одноразовая ссылка
-                creates_join_request=False
-            )
-            # Отправляем ссылку пользователю для автоматического присоединения
+        # Отправляем общую ссылку на вступление: заявка будет одобрена автоматически
+        join_link = await get_join_request_link(bot, channel_id)
+        if join_link:
             try:
                 await bot.send_message(
                     chat_id=user_id,
-                    text=f"🔗 Присоединяйтесь к каналу по ссылке:\n{invite_link.invite_link}"
+                    text=f"🔗 Присоединяйтесь к каналу по ссылке:\n{join_link}"
                 )
             except:
-                # Если не удалось отправить сообщение, ссылка все равно создана
+                # Если не удалось отправить сообщение, ссылку можно получить повторно
                 pass
-        except Exception as e:
-            # Если не удалось создать ссылку (например, нет прав), просто разбаниваем
-            print(f"Note: Could not create invite link for {user_id}: {e}")
     except Exception as e:
         print(f"Error adding user to channel {channel_id}: {e}")
 
@@ -58,6 +93,39 @@ async def remove_user_from_channel(bot: Bot, user_id: int, channel_id: str):
     except Exception as e:
         print(f"Error removing user from channel: {e}")
 
+@router.chat_join_request()
+async def on_chat_join_request(request: ChatJoinRequest, bot: Bot):
+    """Одобрить или отклонить заявку на вступление в канал по активной подписке"""
+    user_id = request.from_user.id
+    channel_name = current_tenant().channel_name_by_id(request.chat.id)
+    if channel_name is None:
+        return  # Заявка в чужой чат - не наше дело
+    
+    if subscriber_index.loaded:
+        has_access = subscriber_index.is_active(user_id, channel_name)
+    else:
+        # Индекс еще загружается при запуске - проверяем по БД
+        subscription = await db.get_active_subscription(user_id, channel_name)
+        has_access = subscription is not None and not subscription.is_expired(clock.now())
+    
+    try:
+        if has_access:
+            await request.approve()
+            return
+        await request.decline()
+    except Exception as e:
+        print(f"Error processing join request from {user_id} to {channel_name}: {e}")
+        return
+    
+    try:
+        await bot.send_message(
+            user_id,
+            get_join_request_declined_message(),
+            reply_markup=get_payment_keyboard(channel_name)
+        )
+    except Exception as e:
+        print(f"Error sending join request decline message to {user_id}: {e}")
+
 @router.message(Command("start"))
 async def cmd_start(message: Message, bot: Bot):
     """Handle /start command"""
@@ -78,7 +146,8 @@ async def cmd_start(message: Message, bot: Bot):
 @router.callback_query(F.data == "main_menu")
 async def callback_main_menu(callback: CallbackQuery):
     """Handle main menu callback"""
-    await callback.message.edit_text(
+    await edit_if_changed(
+        callback.message,
         get_start_message(),
         reply_markup=get_main_menu_keyboard()
     )
@@ -87,7 +156,8 @@ async def callback_main_menu(callback: CallbackQuery):
 @router.callback_query(F.data == "channel_1_info")
 async def callback_channel_1_info(callback: CallbackQuery):
     """Handle channel 1 info callback"""
-    await callback.message.edit_text(
+    await edit_if_changed(
+        callback.message,
         get_channel_1_info_message(),
         reply_markup=get_payment_keyboard("channel_1")
     )
@@ -96,7 +166,8 @@ async def callback_channel_1_info(callback: CallbackQuery):
 @router.callback_query(F.data == "channel_2_info")
 async def callback_channel_2_info(callback: CallbackQuery):
     """Handle channel 2 info callback"""
-    await callback.message.edit_text(
+    await edit_if_changed(
+        callback.message,
         get_channel_2_info_message(),
         reply_markup=get_payment_keyboard("channel_2")
     )
@@ -108,7 +179,8 @@ async def callback_my_subscriptions(callback: CallbackQuery):
     user_id = callback.from_user.id
     subscriptions = await db.get_user_subscriptions(user_id)
     
-    await callback.message.edit_text(
+    await edit_if_changed(
+        callback.message,
         get_subscriptions_message(subscriptions),
         reply_markup=get_back_to_main_keyboard()
     )
@@ -117,7 +189,8 @@ async def callback_my_subscriptions(callback: CallbackQuery):
 @router.callback_query(F.data == "legal_info")
 async def callback_legal_info(callback: CallbackQuery):
     """Handle legal info callback"""
-    await callback.message.edit_text(
+    await edit_if_changed(
+        callback.message,
         get_legal_info_message(),
         reply_markup=get_legal_info_keyboard()
     )
@@ -131,11 +204,10 @@ async def callback_payment(callback: CallbackQuery, bot: Bot):
     channel_name = callback.data.replace("pay_", "")  # channel_1 or channel_2
     
     # Determine price and description
+    amount = current_tenant().price(channel_name)
     if channel_name == "channel_1":
-        amount = CHANNEL_1_PRICE
         description = "Орден Демиургов - 1 месяц"
     else:
-        amount = CHANNEL_2_PRICE
         description = "Родители Демиурги - 1 месяц"
     
     # Generate payment URL with channel-specific credentials
@@ -151,7 +223,8 @@ async def callback_payment(callback: CallbackQuery, bot: Bot):
         [InlineKeyboardButton(text="На главную", callback_data="main_menu")]
     ])
     
-    await callback.message.edit_text(
+    await edit_if_changed(
+        callback.message,
         f"{description}\nСумма: {amount} ₽",
         reply_markup=payment_keyboard
     )
@@ -159,46 +232,66 @@ async def callback_payment(callback: CallbackQuery, bot: Bot):
 
 async def process_payment_success(user_id: int, channel_name: str, bot: Bot):
     """Process successful payment"""
-    # Determine price and period
-    if channel_name == "channel_1":
-        amount = CHANNEL_1_PRICE
-        channel_id = CHANNEL_1_ID
-    else:
-        amount = CHANNEL_2_PRICE
-        channel_id = CHANNEL_2_ID
+    grant = await grant_paid_subscription(user_id, channel_name)
+    await deliver_paid_subscription(bot, user_id, channel_name, grant)
+
+async def grant_paid_subscription(user_id: int, channel_name: str) -> dict:
+    """
+    Выдать оплаченную подписку (и бонус) в БД, без обращений к Bot API
     
-    start_date = datetime.now()
+    Внутри db.transaction() вызывающего кода (complete_payment) изменения
+    фиксируются вместе с подтверждением платежа.
+    """
+    start_date = clock.now()
     end_date = start_date + timedelta(days=PAID_SUBSCRIPTION_DAYS)
+    bonus_start = bonus_end = None
     
-    # Create subscription
-    await db.create_subscription(
-        user_id, channel_name, "paid", start_date, end_date, is_active=True
-    )
+    # Все изменения в БД - одной транзакцией на одном соединении
+    async with db.transaction("payment_success"):
+        # Create subscription
+        renewed = await db.create_subscription(
+            user_id, channel_name, "paid", start_date, end_date, is_active=True
+        )
+        
+        # Special case: if user paid for channel_2 and never had channel_1, give bonus
+        if channel_name == "channel_2":
+            has_ever_had_channel_1 = await db.has_ever_had_subscription(user_id, "channel_1")
+            if not has_ever_had_channel_1:
+                # Give bonus gift
+                bonus_start = clock.now()
+                bonus_end = bonus_start + timedelta(days=FREE_TRIAL_DAYS)
+                await db.create_subscription(
+                    user_id, "channel_1", "gift", bonus_start, bonus_end, is_active=True
+                )
+    return {"renewed": renewed, "start_date": start_date, "end_date": end_date,
+            "bonus_start": bonus_start, "bonus_end": bonus_end}
+
+async def deliver_paid_subscription(bot: Bot, user_id: int, channel_name: str, grant: dict):
+    """Журнал событий, доступ в канал и сообщение об оплате (после фиксации grant_paid_subscription)"""
+    tenant = current_tenant()
+    channel_id = tenant.channel_id(channel_name)
+    start_date, end_date = grant["start_date"], grant["end_date"]
+    bonus_start, bonus_end = grant["bonus_start"], grant["bonus_end"]
+    
+    event_log.record(RENEWED if grant["renewed"] else GRANTED, user_id, channel_name, method="paid", end_date=end_date)
+    if bonus_start is not None:
+        event_log.record(GRANTED, user_id, "channel_1", method="gift", end_date=bonus_end, bonus=True)
     
     # Add user to channel
     await add_user_to_channel(bot, user_id, channel_id)
     
-    # Special case: if user paid for channel_2 and never had channel_1, give bonus
-    if channel_name == "channel_2":
-        has_ever_had_channel_1 = await db.has_ever_had_subscription(user_id, "channel_1")
-        if not has_ever_had_channel_1:
-            # Give bonus gift
-            bonus_start = datetime.now()
-            bonus_end = bonus_start + timedelta(days=FREE_TRIAL_DAYS)
-            await db.create_subscription(
-                user_id, "channel_1", "gift", bonus_start, bonus_end, is_active=True
-            )
-            await add_user_to_channel(bot, user_id, CHANNEL_1_ID)
-            
-            # Send message with bonus
-            await bot.send_message(
-                user_id,
-                get_payment_success_with_bonus_message(
-                    start_date, end_date, bonus_start, bonus_end
-                ),
-                reply_markup=get_back_to_main_keyboard()
-            )
-            return
+    if bonus_start is not None:
+        await add_user_to_channel(bot, user_id, tenant.channel_id("channel_1"))
+        
+        # Send message with bonus
+        await bot.send_message(
+            user_id,
+            get_payment_success_with_bonus_message(
+                start_date, end_date, bonus_start, bonus_end
+            ),
+            reply_markup=get_back_to_main_keyboard()
+        )
+        return
     
     # Regular payment success message
     await bot.send_message(
@@ -211,7 +304,7 @@ async def process_payment_success(user_id: int, channel_name: str, bot: Bot):
 @router.message(Command("admin"))
 async def cmd_admin(message: Message):
     """Admin panel entry point"""
-    if message.from_user.id not in ADMIN_IDS:
+    if not current_tenant().is_admin(message.from_user.id):
         await message.answer("У вас нет доступа к админ-панели.")
         return
     
@@ -220,8 +313,24 @@ async def cmd_admin(message: Message):
         "Доступные команды:\n"
         "/import_users - Импорт пользователей из мастер-класса\n"
         "Формат: /import_users 123456789 @username1 @username2\n"
-        "Можно использовать telegram_id или @username\n\n"
-        "/check_expired - Проверить истекшие подписки (ручная проверка)"
+        "Можно использовать telegram_id или @username\n"
+        "Для большого списка отправьте CSV/TXT файл с подписью /import_users "
+        "(по одному ID или @username в строке). Повторная отправка того же файла "
+        "продолжит прерванный импорт.\n\n"
+        "/check_expired - Проверить истекшие подписки (ручная проверка)\n"
+        "/jobs - Фоновые задачи: текущий и последний запуски, прогресс\n\n"
+        "/broadcast - Рассылка активным подписчикам канала\n"
+        "Формат: /broadcast channel_1 Текст сообщения\n\n"
+        "/reconcile - Сверить участников каналов с подписками (изменения с прошлой сверки)\n"
+        "/reconcile full - Полная сверка всех подписок\n\n"
+        "/profile - Сводка профилировщика обработчиков\n"
+        "/profile on [доля] | off | reset | dump [обработчик]\n\n"
+        "/stats [дней] - Подписки, пробные периоды, конверсии и выручка\n\n"
+        "/export payments|subscriptions [channel=...] [status=...] [from=ГГГГ-ММ-ДД] [to=ГГГГ-ММ-ДД]\n"
+        "Выгрузка в CSV (to - не включая)\n\n"
+        "/history telegram_id - История подписок и оплат пользователя\n\n"
+        "/tenants - Нагрузка по ботам процесса (администраторам первого бота)\n\n"
+        "/dbstats - Пул соединений с БД и кэш подготовленных запросов"
     )
 
 async def resolve_user_identifier(bot: Bot, identifier: str) -> Optional[int]:
@@ -239,58 +348,105 @@ async def resolve_user_identifier(bot: Bot, identifier: str) -> Optional[int]:
     - Пользователь хотя бы раз писал боту (/start)
     - ИЛИ пользователь находится в общем чате/канале с ботом
     - ИЛИ бот является администратором канала, где находится пользователь
-    """
-    # Если это число, возвращаем как есть
-    if identifier.isdigit():
-        return int(identifier)
-    
-    # Если это username (начинается с @), убираем @
-    if identifier.startswith('@'):
-        username = identifier[1:]
-    else:
-        username = identifier
     
-    # Пробуем разные варианты получения информации о пользователе
-    variants = [
-        f"@{username}",  # С @
-        username,        # Без @
-    ]
+    Для списка идентификаторов используйте resolve_user_identifiers() -
+    он проверяет таблицу users одним запросом на весь список.
+    """
+    resolved = await resolve_user_identifiers(bot, [identifier])
+    return resolved[identifier]
+
+async def send_gift_message(bot: Bot, user_id: int, start_date: datetime, end_date: datetime,
+                            channel_link: Optional[str] = None):
+    """
+    Разблокировать пользователю вступление в канал «Орден Демиургов»
+    и отправить сообщение с подарком
     
-    for variant in variants:
+    channel_link - ссылка на вступление по заявке (см. get_join_request_link).
+    Все вызовы Bot API идут через общий ограничитель частоты.
+    """
+    try:
+        # Разбаниваем пользователя (если был забанен) - это позволяет ему подать заявку
+        await call_with_retry(
+            telegram_limiter,
+            lambda: bot.unban_chat_member(chat_id=current_tenant().channel_id("channel_1"), user_id=user_id,
+                                          only_if_banned=True)
+        )
+        
+        # Создаем клавиатуру с кнопкой для перехода в канал
+        from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+        if channel_link:
+            gift_keyboard = InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="📖 Перейти в канал «Орден Демиургов»", url=channel_link)],
+                [InlineKeyboardButton(text="Главное меню", callback_data="main_menu")]
+            ])
+        else:
+            # Если не удалось создать ссылку, используем обычное меню
+            gift_keyboard = get_main_menu_keyboard()
+        
+        # Отправляем сообщение с кнопкой для перехода в канал
+        await call_with_retry(
+            telegram_limiter,
+            lambda: bot.send_message(
+                user_id,
+                get_gift_welcome_message(start_date, end_date),
+                reply_markup=gift_keyboard
+            )
+        )
+    except Exception as e:
+        # Если произошла ошибка, отправляем сообщение без кнопки
+        print(f"Error adding user to channel {user_id}: {e}")
         try:
-            # Пытаемся получить информацию о пользователе по username
-            # Это работает только если:
-            # - Пользователь хотя бы раз писал боту (/start)
-            # - ИЛИ пользователь находится в общем чате/канале с ботом
-            chat = await bot.get_chat(variant)
-            if hasattr(chat, 'id'):
-                return chat.id
-        except Exception:
-            continue
-    
-    # Если не удалось, значит пользователь не взаимодействовал с ботом
-    print(f"Не удалось разрешить username {identifier}: пользователь не найден или не взаимодействовал с ботом")
-    return None
+            await call_with_retry(
+                telegram_limiter,
+                lambda: bot.send_message(
+                    user_id,
+                    get_gift_welcome_message(start_date, end_date),
+                    reply_markup=get_main_menu_keyboard()
+                )
+            )
+        except Exception as e2:
+            print(f"Error sending message to {user_id}: {e2}")
 
 @router.message(Command("import_users"))
 async def cmd_import_users(message: Message, bot: Bot):
     """Import users from masterclass"""
-    if message.from_user.id not in ADMIN_IDS:
+    if not current_tenant().is_admin(message.from_user.id):
         await message.answer("У вас нет доступа к этой команде.")
         return
     
+    # Импорт идет в фоне: отправка подарков под ограничителем частоты занимает
+    # минуты, а очередь апдейтов администратора не должна ждать (update_queue.py)
+    
+    # Файл со списком пользователей (CSV/TXT) обрабатывается потоково
+    if message.document:
+        from bulk_import import run_file_import
+        start_background(run_file_import(message, bot))
+        return
+    
     # Parse user identifiers from command (ID или @username)
     parts = message.text.split()[1:]
     if not parts:
         await message.answer("Укажите telegram_id или @username пользователей через пробел.\nПример: /import_users 123456789 @username1 @username2")
         return
     
+    start_background(import_listed_users(message, bot, parts))
+
+async def import_listed_users(message: Message, bot: Bot, parts: list):
+    """Импорт пользователей, перечисленных в команде /import_users"""
+    try:
+        await _import_listed_users(message, bot, parts)
+    except Exception as e:
+        print(f"[IMPORT] Error importing listed users: {e}")
+        await message.answer(f"❌ Импорт прерван: {e}")
+
+async def _import_listed_users(message: Message, bot: Bot, parts: list):
     # Разрешаем все идентификаторы в telegram_id
     telegram_ids = []
     unresolved = []
     
+    resolved = await resolve_user_identifiers(bot, parts)
     for identifier in parts:
-        user_id = await resolve_user_identifier(bot, identifier)
+        user_id = resolved[identifier]
         if user_id:
             telegram_ids.append(user_id)
         else:
@@ -317,83 +473,26 @@ async def cmd_import_users(message: Message, bot: Bot):
     users_to_gift = await db.import_users_from_masterclass(telegram_ids)
     
     # Send gift messages to eligible users
+    channel_link = await get_join_request_link(bot, current_tenant().channel_id("channel_1"))
     for user_id in users_to_gift:
-        start_date = datetime.now()
+        start_date = clock.now()
         end_date = start_date + timedelta(days=FREE_TRIAL_DAYS)
         
-        # Create subscription
-        await db.create_subscription(
-            user_id, "channel_1", "gift", start_date, end_date, is_active=True
-        )
-        
-        # Mark gift as received
-        await db.mark_gift_received(user_id)
-        
-        # Create reminder
-        reminder_date = start_date + timedelta(days=FREE_TRIAL_DAYS - 3)
-        await db.create_reminder(user_id, "channel_1", reminder_date)
-        
-        # Добавляем пользователя в канал и создаем ссылку для перехода
-        try:
-            # Разбаниваем пользователя (если был забанен) - это позволяет ему присоединиться
-            await bot.unban_chat_member(chat_id=CHANNEL_1_ID, user_id=user_id, only_if_banned=False)
-            
-            # Пытаемся получить публичную ссылку на канал или создать приглашение
-            channel_link = None
-            try:
-                # Пытаемся получить информацию о канале
-                chat = await bot.get_chat(chat_id=CHANNEL_1_ID)
-                # Если есть публичная ссылка (username), используем её
-                if chat.username:
-                    channel_link = f"https://t.me/{chat.username.lstrip('@')}"
-                else:
-                    # Если канал приватный, создаем ссылку-приглашение
-                    invite_link = await bot.create_chat_invite_link(
-                        chat_id=CHANNEL_1_ID,
-                        member_limit=1,
-                        creates_join_request=False
-                    )
-                    channel_link = invite_link.invite_link
-            except Exception as e:
-                # Если не удалось получить ссылку, создаем приглашение
-                try:
-                    invite_link = await bot.create_chat_invite_link(
-                        chat_id=CHANNEL_1_ID,
-                        member_limit=1,
-                        creates_join_request=False
-                    )
-                    channel_link = invite_link.invite_link
-                except:
-                    pass
+        async with db.transaction("import_gift"):
+            # Create subscription
+            await db.create_subscription(
+                user_id, "channel_1", "gift", start_date, end_date, is_active=True
+            )
             
-            # Создаем клавиатуру с кнопкой для перехода в канал
-            from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-            if channel_link:
-                gift_keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="📖 Перейти в канал «Орден Демиургов»", url=channel_link)],
-                    [InlineKeyboardButton(text="Главное меню", callback_data="main_menu")]
-                ])
-            else:
-                # Если не удалось создать ссылку, используем обычное меню
-                gift_keyboard = get_main_menu_keyboard()
+            # Mark gift as received
+            await db.mark_gift_received(user_id)
             
-            # Отправляем сообщение с кнопкой для перехода в канал
-            await bot.send_message(
-                user_id,
-                get_gift_welcome_message(start_date, end_date),
-                reply_markup=gift_keyboard
-            )
-        except Exception as e:
-            # Если произошла ошибка, отправляем сообщение без кнопки
-            print(f"Error adding user to channel {user_id}: {e}")
-            try:
-                await bot.send_message(
-                    user_id,
-                    get_gift_welcome_message(start_date, end_date),
-                    reply_markup=get_main_menu_keyboard()
-                )
-            except Exception as e2:
-                print(f"Error sending message to {user_id}: {e2}")
+            # Create reminder
+            reminder_date = start_date + timedelta(days=FREE_TRIAL_DAYS - 3)
+            await db.create_reminder(user_id, "channel_1", reminder_date)
+        
+        event_log.record(GRANTED, user_id, "channel_1", method="gift", end_date=end_date)
+        await send_gift_message(bot, user_id, start_date, end_date, channel_link)
     
     await message.answer(
         f"Импорт завершен.\n"
@@ -404,15 +503,217 @@ async def cmd_import_users(message: Message, bot: Bot):
 @router.message(Command("check_expired"))
 async def cmd_check_expired(message: Message, bot: Bot):
     """Проверить истекшие подписки (ручная проверка)"""
-    if message.from_user.id not in ADMIN_IDS:
+    if not current_tenant().is_admin(message.from_user.id):
         await message.answer("У вас нет доступа к этой команде.")
         return
     
-    await message.answer("Проверяю истекшие подписки...")
-    
     # Импортируем функцию проверки из scheduler
     from scheduler import check_expired_subscriptions
-    await check_expired_subscriptions(bot)
+    # Проверка идет в фоне через job_runner: если она уже выполняется (планировщик,
+    # запуск при старте), запрос объединяется со следующим запуском
+    run = job_runner.submit(check_expired_subscriptions, bot, trigger=f"admin {message.from_user.id}")
+    if run.status == QUEUED:
+        await message.answer(
+            f"Проверка уже выполняется. Запрос добавлен в следующий запуск #{run.run_id}, "
+            f"он начнется после текущего. Прогресс: /jobs"
+        )
+    else:
+        await message.answer(f"Проверяю истекшие подписки (запуск #{run.run_id}). Прогресс: /jobs")
+    
+    job_runner.notify(run, lambda finished: message.answer(
+        ("✅ Проверка завершена. Результаты в логах.\n" if finished.status == DONE else "❌ Проверка не завершена.\n")
+        + finished.describe()
+    ))
+
+@router.message(Command("jobs"))
+async def cmd_jobs(message: Message):
+    """Запуски фоновых задач: номер, прогресс, итог последнего запуска"""
+    if not current_tenant().is_admin(message.from_user.id):
+        await message.answer("У вас нет доступа к этой команде.")
+        return
     
-    await message.answer("✅ Проверка завершена. Результаты в логах.")
+    await message.answer(job_runner.summary(current_tenant().name))
+
+
+@router.message(Command("broadcast"))
+async def cmd_broadcast(message: Message, bot: Bot):
+    """Рассылка сообщения всем активным подписчикам канала"""
+    if not current_tenant().is_admin(message.from_user.id):
+        await message.answer("У вас нет доступа к этой команде.")
+        return
+    
+    # html_text сохраняет форматирование исходного сообщения
+    parts = message.html_text.split(maxsplit=2)
+    if len(parts) < 3 or parts[1] not in ("channel_1", "channel_2"):
+        await message.answer(
+            "Укажите канал и текст рассылки.\n"
+            "Пример: /broadcast channel_1 Текст сообщения"
+        )
+        return
+    
+    from broadcast import start_broadcast_task
+    broadcast = await db.create_broadcast(message.from_user.id, parts[1], parts[2])
+    progress = await message.answer(
+        f"Рассылка #{broadcast['id']} запущена.\n"
+        f"Получателей: {broadcast['total']}"
+    )
+    await db.set_broadcast_progress_message(broadcast['id'], progress.chat.id, progress.message_id)
+    broadcast['progress_chat_id'] = progress.chat.id
+    broadcast['progress_message_id'] = progress.message_id
+    start_broadcast_task(bot, broadcast)
 
+@router.message(Command("reconcile"))
+async def cmd_reconcile(message: Message, bot: Bot):
+    """Сверка участников каналов с подписками"""
+    if not current_tenant().is_admin(message.from_user.id):
+        await message.answer("У вас нет доступа к этой команде.")
+        return
+    
+    from reconciliation import format_report
+    from scheduler import reconcile_memberships
+    full = message.text.split()[1:2] == ["full"]
+    # Сверка идет в фоне через job_runner - не параллельно со сверкой планировщика
+    run = job_runner.submit(reconcile_memberships, bot, full, trigger=f"admin {message.from_user.id}")
+    if run.status == QUEUED:
+        await message.answer(
+            f"Сверка уже выполняется. Запрос добавлен в следующий запуск #{run.run_id}, "
+            f"он начнется после текущего (режим - первого запроса в нем). Прогресс: /jobs"
+        )
+    else:
+        await message.answer(
+            f"Запускаю {'полную сверку' if full else 'сверку изменений'} (запуск #{run.run_id}). Прогресс: /jobs"
+        )
+    
+    job_runner.notify(run, lambda finished: message.answer(
+        format_report(finished.result) if finished.status == DONE
+        else f"❌ Сверка не завершена.\n{finished.describe()}"
+    ))
+
+@router.message(Command("profile"))
+async def cmd_profile(message: Message):
+    """Управление сэмплирующим профилировщиком без перезапуска"""
+    if not current_tenant().is_admin(message.from_user.id):
+        await message.answer("У вас нет доступа к этой команде.")
+        return
+    
+    args = message.text.split()[1:]
+    action = args[0] if args else "status"
+    if action == "on":
+        try:
+            rate = float(args[1]) if len(args) > 1 else None
+        except ValueError:
+            await message.answer("Доля должна быть числом от 0 до 1, например: /profile on 0.1")
+            return
+        profiler.enable(rate)
+    elif action == "off":
+        profiler.disable()
+    elif action == "reset":
+        profiler.reset()
+    elif action == "dump":
+        from aiogram.types import BufferedInputFile
+        label = args[1] if len(args) > 1 else None
+        stacks = profiler.collapsed(label)
+        if not stacks:
+            await message.answer("Стеков пока нет.")
+            return
+        await message.answer_document(
+            BufferedInputFile(stacks.encode("utf-8"), filename="profile.folded"),
+            caption="Свернутые стеки (flamegraph.pl / speedscope)"
+        )
+        return
+    
+    from event_loop import loop_monitor
+    from update_queue import update_executor
+    await message.answer(
+        f"{profiler.summary()}\n\n{loop_monitor.summary()}\n\n{update_executor.summary()}\n\n"
+        f"{render_cache.summary()}"
+    )
+
+@router.message(Command("stats"))
+async def cmd_stats(message: Message):
+    """Статистика подписок и оплат из сводных таблиц"""
+    if not current_tenant().is_admin(message.from_user.id):
+        await message.answer("У вас нет доступа к этой команде.")
+        return
+    
+    from stats import parse_days, stats_since, format_stats, MAX_DAYS
+    args = message.text.split()[1:]
+    try:
+        days = parse_days(args[0] if args else None)
+    except ValueError:
+        await message.answer(f"Укажите число дней от 1 до {MAX_DAYS}, например: /stats 30")
+        return
+    
+    stats = await db.get_stats(stats_since(days))
+    await message.answer(format_stats(stats, days))
+
+@router.message(Command("export"))
+async def cmd_export(message: Message):
+    """Выгрузка платежей или подписок в CSV-документ"""
+    if not current_tenant().is_admin(message.from_user.id):
+        await message.answer("У вас нет доступа к этой команде.")
+        return
+    
+    from aiogram.types import FSInputFile
+    from export import parse_export_filters, exported_csv, export_filename, TELEGRAM_DOCUMENT_LIMIT
+    args = message.text.split()[1:]
+    table = args[0] if args else ""
+    params = dict(arg.split("=", 1) for arg in args[1:] if "=" in arg)
+    try:
+        filters = parse_export_filters(table, params)
+    except ValueError as e:
+        await message.answer(
+            f"Неверные параметры выгрузки: {e}\n"
+            "Пример: /export payments channel=channel_1 status=success from=2026-01-01 to=2026-02-01"
+        )
+        return
+    
+    await message.answer("Готовлю выгрузку...")
+    async with exported_csv(table, filters) as (path, rows):
+        if os.path.getsize(path) > TELEGRAM_DOCUMENT_LIMIT:
+            await message.answer(
+                f"Файл выгрузки ({rows} строк) больше 50 МБ - Telegram его не примет.\n"
+                "Сузьте фильтры или используйте GET /admin/export."
+            )
+            return
+        await message.answer_document(
+            FSInputFile(path, filename=export_filename(table)),
+            caption=f"{table}: {rows} строк"
+        )
+
+@router.message(Command("history"))
+async def cmd_history(message: Message):
+    """История событий подписок пользователя (журнал subscription_events)"""
+    if not current_tenant().is_admin(message.from_user.id):
+        await message.answer("У вас нет доступа к этой команде.")
+        return
+    
+    args = message.text.split()[1:]
+    if not args or not args[0].isdigit():
+        await message.answer("Укажите telegram_id, например: /history 123456789")
+        return
+    
+    from events import format_history
+    telegram_id = int(args[0])
+    # Сначала дописываем буфер, чтобы в истории были и последние события
+    await event_log.flush()
+    events = await db.get_user_events(telegram_id)
+    await message.answer(format_history(telegram_id, events))
+
+@router.message(Command("dbstats"))
+async def cmd_dbstats(message: Message):
+    """Пулы соединений и кэш подготовленных запросов (statements.py)"""
+    if not current_tenant().is_admin(message.from_user.id):
+        await message.answer("У вас нет доступа к этой команде.")
+        return
+    
+    await message.answer(format_pool_stats(db.pool_stats()))
+
+@router.message(Command("tenants"))
+async def cmd_tenants(message: Message):
+    """Метрики арендаторов процесса (tenants.py) - для администраторов арендатора по умолчанию"""
+    if current_tenant() is not TENANTS[0] or not TENANTS[0].is_admin(message.from_user.id):
+        await message.answer("У вас нет доступа к этой команде.")
+        return
+    
+    await message.answer(format_tenant_metrics())
@@ -0,0 +1,231 @@
+"""
+ЗАПУСК ФОНОВЫХ ЗАДАЧ: НЕ БОЛЬШЕ ОДНОГО ОДНОВРЕМЕННО
+
+Проверку истекших подписок запускают планировщик (раз в час), догоняющая
+обработка при старте (main.py) и команда /check_expired, сверку участников
+каналов - планировщик и /reconcile. Без согласования запуски накладываются:
+одни и те же подписки обрабатываются дважды, пользователь получает два бана
+и два сообщения об окончании подписки.
+
+JobRunner выполняет задачу арендатора не больше чем одним запуском
+одновременно, откуда бы она ни была запрошена:
+- задача не выполняется - запуск начинается сразу;
+- задача уже выполняется - запрос попадает в следующий запуск, который
+  начнется после текущего. Все запросы, пришедшие за время текущего запуска,
+  объединяются в один следующий запуск.
+Следующий запуск нужен: текущий мог уже пройти данные, изменившиеся после
+его начала (например, подписка истекла во время проверки).
+
+У каждого запуска номер (#N), задача сообщает прогресс через job_progress().
+Текущий, следующий и последний завершенный запуски арендатора - в /jobs.
+"""
+import asyncio
+import functools
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from datetime import datetime
+from itertools import count
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+from clock import clock
+from tenants import current_tenant
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+STATUS_NAMES = {
+    QUEUED: "ожидает", RUNNING: "выполняется", DONE: "завершен", FAILED: "ошибка", CANCELLED: "отменен",
+}
+
+# Ссылки на фоновые задачи start_background (чтобы их не собрал GC)
+_background_tasks: Set[asyncio.Task] = set()
+
+# Запуск, который выполняется в текущей задаче asyncio (для job_progress)
+_current_run: ContextVar[Optional["JobRun"]] = ContextVar("current_job_run", default=None)
+
+
+@dataclass
+class JobRun:
+    """Запуск задачи и все запросы, объединенные в него"""
+    run_id: int
+    job: str
+    tenant: str
+    triggers: List[str]
+    call: Optional[Callable[[], Awaitable[Any]]] = field(default=None, repr=False)
+    done: Optional[asyncio.Future] = field(default=None, repr=False)
+    status: str = QUEUED
+    started_at: Optional[datetime] = None
+    duration: float = 0.0
+    processed: int = 0
+    total: Optional[int] = None
+    error: Optional[str] = None
+    # Значение, которое вернула задача (например, отчет сверки)
+    result: Any = None
+    _started: float = field(default=0.0, repr=False)
+
+    async def wait(self):
+        """Дождаться окончания запуска (отмена ожидающего не отменяет запуск)"""
+        await asyncio.shield(self.done)
+
+    def describe(self) -> str:
+        if self.status == RUNNING:
+            elapsed = time.perf_counter() - self._started
+        else:
+            elapsed = self.duration
+        text = f"#{self.run_id} {self.job}: {STATUS_NAMES[self.status]}"
+        if self.started_at is not None:
+            text += f", начат {self.started_at:%d.%m %H:%M:%S}, {elapsed:.1f} с"
+        if self.processed or self.total:
+            text += f", обработано {self.processed}" + (f" из {self.total}" if self.total else "")
+        text += f"\n  Запросы: {', '.join(self.triggers)}"
+        if self.error:
+            text += f"\n  Ошибка: {self.error}"
+        return text
+
+
+def job_progress(processed: int, total: Optional[int] = None):
+    """Прогресс текущего запуска (вне JobRunner - ничего не делает)"""
+    run = _current_run.get()
+    if run is not None:
+        run.processed = processed
+        run.total = total
+
+
+def start_background(coro) -> asyncio.Task:
+    """
+    Запустить фоновую задачу без единичного запуска (например, импорт файла)
+
+    Обработчик апдейта не ждет ее: долгая команда не держит очередь апдейтов
+    пользователя (update_queue.py). Необработанная ошибка пишется в лог.
+    """
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_done)
+    return task
+
+
+def _background_done(task: asyncio.Task):
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        print(f"[JOBS] Background task failed: {task.exception()!r}")
+
+
+class JobRunner:
+    """Одиночный запуск задач по (арендатор, задача) с объединением запросов"""
+
+    def __init__(self):
+        self._ids = count(1)
+        self._running: Dict[Tuple[str, str], JobRun] = {}
+        self._pending: Dict[Tuple[str, str], JobRun] = {}
+        self._last: Dict[Tuple[str, str], JobRun] = {}
+        # Ссылки на задачи запусков и уведомлений (чтобы их не собрал GC)
+        self._tasks: Set[asyncio.Task] = set()
+        self.started = 0
+        self.coalesced = 0
+
+    def submit(self, job: Callable[..., Awaitable[Any]], *args, trigger: str) -> JobRun:
+        """
+        Запросить запуск job(*args) для текущего арендатора, не дожидаясь его
+
+        Возвращает запуск, который выполнит запрос: новый, если задача не
+        выполняется, иначе следующий после текущего (общий для всех запросов,
+        пришедших за время текущего запуска).
+        """
+        key = (current_tenant().name, job.__name__)
+        pending = self._pending.get(key)
+        if pending is not None:
+            pending.triggers.append(trigger)
+            self.coalesced += 1
+            return pending
+
+        run = JobRun(
+            next(self._ids), job.__name__, key[0], [trigger],
+            call=functools.partial(job, *args), done=asyncio.get_running_loop().create_future()
+        )
+        if key in self._running:
+            self._pending[key] = run
+        else:
+            self._start(key, run)
+        return run
+
+    async def run(self, job: Callable[..., Awaitable[Any]], *args, trigger: str) -> JobRun:
+        """Запросить запуск и дождаться его окончания (ошибка задачи - RuntimeError)"""
+        run = self.submit(job, *args, trigger=trigger)
+        await run.wait()
+        if run.status == FAILED:
+            raise RuntimeError(f"run #{run.run_id}: {run.error}")
+        return run
+
+    def notify(self, run: JobRun, callback: Callable[[JobRun], Awaitable[Any]]):
+        """Вызвать callback(run) после окончания запуска (например, ответить администратору)"""
+        async def wait_and_notify():
+            await run.wait()
+            try:
+                await callback(run)
+            except Exception as e:
+                print(f"[JOBS] Could not report run #{run.run_id}: {e}")
+        self._spawn(wait_and_notify())
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _start(self, key: Tuple[str, str], run: JobRun):
+        self._running[key] = run
+        run.status = RUNNING
+        run.started_at = clock.now()
+        run._started = time.perf_counter()
+        self.started += 1
+        # Задача наследует арендатора из контекста запроса
+        self._spawn(self._execute(key, run))
+
+    async def _execute(self, key: Tuple[str, str], run: JobRun):
+        _current_run.set(run)
+        print(f"[JOBS] Run #{run.run_id} {run.job} ({run.tenant}) started by: {', '.join(run.triggers)}")
+        try:
+            run.result = await run.call()
+            run.status = DONE
+        except asyncio.CancelledError:
+            run.status = CANCELLED
+            raise
+        except Exception as e:
+            run.status = FAILED
+            run.error = str(e) or type(e).__name__
+            print(f"[JOBS] Run #{run.run_id} {run.job} ({run.tenant}) failed: {e}")
+        finally:
+            run.duration = time.perf_counter() - run._started
+            run.call = None
+            run.done.set_result(None)
+            print(f"[JOBS] Run #{run.run_id} {run.job} ({run.tenant}) {run.status} in {run.duration:.1f} s")
+            self._last[key] = run
+            del self._running[key]
+            pending = self._pending.pop(key, None)
+            if pending is not None:
+                if run.status == CANCELLED:
+                    # Остановка бота: следующий запуск не начинаем
+                    pending.status = CANCELLED
+                    pending.done.set_result(None)
+                else:
+                    self._start(key, pending)
+
+    def summary(self, tenant: str) -> str:
+        """Текущие, следующие и последние запуски задач арендатора"""
+        jobs = sorted({job for name, job in (*self._running, *self._pending, *self._last) if name == tenant})
+        if not jobs:
+            return "Задачи еще не запускались."
+        lines = [f"Запусков: {self.started}, запросов объединено со следующим запуском: {self.coalesced}"]
+        for job in jobs:
+            key = (tenant, job)
+            lines.append("")
+            for title, run in (("Сейчас", self._running.get(key)), ("Следующий", self._pending.get(key)),
+                               ("Последний", self._last.get(key))):
+                if run is not None:
+                    lines.append(f"{title}: {run.describe()}")
+        return "\n".join(lines)
+
+
+# Глобальный исполнитель задач всех ботов процесса
+job_runner = JobRunner()
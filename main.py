@@ -1,13 +1,27 @@
+import time
+PROCESS_STARTED = time.perf_counter()
+
 import asyncio
 import logging
+from contextlib import contextmanager
 from aiogram import Bot, Dispatcher
 from aiogram.enums import ParseMode
 from aiohttp import web
-from config import BOT_TOKEN
+from config import EVENT_LOOP
 from database import db
+from subscriber_index import subscriber_index
 from handlers import router
 from scheduler import setup_scheduler
 from payment_handler import setup_payment_routes
+from profiler import setup_profile_routes
+from stats import setup_stats_routes
+from export import setup_export_routes
+from event_loop import select_event_loop, loop_monitor
+from payment_reconciler import close_session as close_robokassa_session
+from events import event_log
+from tenants import TENANTS, TenantMiddleware, tenant_context
+from update_queue import OrderedUpdateMiddleware, update_executor
+from jobs import job_runner, start_background
 
 # Configure logging
 logging.basicConfig(
@@ -16,65 +30,146 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-async def on_startup(bot: Bot):
+@contextmanager
+def startup_phase(name: str):
+    """Замер длительности фазы запуска (пишется в лог)"""
+    started = time.perf_counter()
+    yield
+    logger.info(f"[STARTUP] {name}: {(time.perf_counter() - started) * 1000:.0f} ms")
+
+async def load_subscriber_index():
+    """Загрузить индекс активных подписчиков (до загрузки заявки проверяются по БД)"""
+    with startup_phase("subscriber index"):
+        # Оплаты, пришедшие во время чтения, повторяются поверх снимка
+        subscriber_index.begin_load()
+        try:
+            subscribers = await db.get_active_subscribers()
+        except Exception:
+            subscriber_index.cancel_load()
+            raise
+        subscriber_index.load(subscribers)
+    logger.info("Active subscriber index loaded")
+
+async def initial_catch_up(bot: Bot):
+    """
+    Догоняющая обработка после простоя: истекшие подписки и прерванные рассылки
+    
+    Выполняется в фоне - бот отвечает на апдейты, пока идет обработка.
+    Прогресс пишется в лог (см. check_expired_subscriptions) и виден в /jobs.
+    Проверка идет через job_runner и не пересекается с /check_expired.
+    """
+    from scheduler import check_expired_subscriptions
+    from broadcast import resume_broadcasts
+    
+    logger.info("Performing initial check of expired subscriptions in background...")
+    try:
+        with startup_phase("initial expired subscriptions check"):
+            await job_runner.run(check_expired_subscriptions, bot, trigger="startup")
+        logger.info("Initial check completed")
+    except Exception as e:
+        logger.error(f"Initial check of expired subscriptions failed: {e}", exc_info=True)
+    
+    # Продолжаем рассылки, прерванные предыдущей остановкой бота
+    try:
+        await resume_broadcasts(bot)
+    except Exception as e:
+        logger.error(f"Could not resume broadcasts: {e}", exc_info=True)
+
+async def on_startup():
     """
     ИНИЦИАЛИЗАЦИЯ ПРИ ЗАПУСКЕ БОТА
     
     ПОДКЛЮЧЕНИЕ К БД:
     -----------------
     Здесь происходит первичное подключение к PostgreSQL через метод db.init_db().
-    Метод создает пул соединений (connection pool) с параметрами:
-    - min_size=5: минимум 5 соединений в пуле
-    - max_size=20: максимум 20 соединений в пуле
+    Метод создает пул соединений (connection pool) с параметрами из config.py:
+    - DB_POOL_MIN_SIZE (5): минимум соединений в пуле
+    - DB_POOL_MAX_SIZE (20): максимум соединений в пуле
+    Новое соединение сразу подготавливает запросы реестра (statements.py).
     
     Пул соединений позволяет эффективно переиспользовать соединения к БД,
     избегая создания нового соединения для каждого запроса.
+    Пул общий для всех ботов процесса (tenants.py): init_db() вызывается для
+    каждого арендатора и применяет миграции в его схеме.
+    
+    В блокирующей части запуска остаются только пул, миграции (один SELECT,
+    если схема актуальна) и планировщик. Загрузка индекса подписчиков и
+    догоняющая проверка истекших подписок выполняются в фоне.
     """
-    await db.init_db()
+    # Контроль задержки event loop - с самого начала, включая догоняющие задачи
+    loop_monitor.start()
+    
+    with startup_phase("database pool and migrations"):
+        for tenant in TENANTS:
+            with tenant_context(tenant):
+                await db.init_db()
     logger.info("Database initialized and connection pool created")
     
-    setup_scheduler(bot)
+    # Фоновая запись журнала событий подписок (events.py)
+    event_log.start()
+    
+    with startup_phase("scheduler"):
+        setup_scheduler()
     logger.info("Scheduler started")
     
-    # Выполняем немедленную проверку истекших подписок при запуске
-    from scheduler import check_expired_subscriptions
-    logger.info("Performing initial check of expired subscriptions...")
-    await check_expired_subscriptions(bot)
-    logger.info("Initial check completed")
+    # Фоновые задачи наследуют арендатора, в контексте которого созданы
+    for tenant in TENANTS:
+        with tenant_context(tenant):
+            start_background(load_subscriber_index())
+            start_background(initial_catch_up(tenant.bot))
 
 async def main():
     """Main function"""
     try:
-        # Initialize bot and dispatcher
-        bot = Bot(token=BOT_TOKEN, parse_mode=ParseMode.HTML)
-        dp = Dispatcher()
+        # Initialize bots (one per tenant) and a single dispatcher for all of them
+        for tenant in TENANTS:
+            tenant.bot = Bot(token=tenant.bot_token, parse_mode=ParseMode.HTML)
+        # FSM боту не нужен, а MemoryStorage заводит запись на каждого пользователя
+        # и никогда ее не удаляет (найдено прогоном tools/soak.py)
+        dp = Dispatcher(disable_fsm=True)
+        # Апдейты одного пользователя - по очереди, разных - параллельно в пределах
+        # UPDATE_CONCURRENCY (первым: ожидание очереди не входит во время обработки)
+        dp.update.outer_middleware(OrderedUpdateMiddleware(update_executor))
+        # Апдейт обрабатывается от имени арендатора бота, который его получил
+        dp.update.outer_middleware(TenantMiddleware(TENANTS))
         
         # Register handlers
         dp.include_router(router)
         
+        # Startup (до веб-сервера, чтобы webhook'и не приходили раньше пула соединений)
+        await on_startup()
+        
         # Setup payment webhook server
         app = web.Application()
-        setup_payment_routes(app, bot)
+        setup_payment_routes(app, TENANTS[0].bot)
+        setup_profile_routes(app)
+        setup_stats_routes(app)
+        setup_export_routes(app)
         
         # Start webhook server for payment callbacks
-        runner = web.AppRunner(app)
-        await runner.setup()
-        site = web.TCPSite(runner, '0.0.0.0', 8080)
-        await site.start()
+        with startup_phase("payment webhook server"):
+            runner = web.AppRunner(app)
+            await runner.setup()
+            site = web.TCPSite(runner, '0.0.0.0', 8080)
+            await site.start()
         logger.info("Payment webhook server started on port 8080")
         
-        # Startup
-        await on_startup(bot)
-        
         # Start polling
-        logger.info("Bot started")
-        await dp.start_polling(bot)
+        logger.info(f"Bot started, ready in {(time.perf_counter() - PROCESS_STARTED) * 1000:.0f} ms since process start")
+        # allowed_updates включает chat_join_request (заявки на вступление в каналы)
+        await dp.start_polling(*(tenant.bot for tenant in TENANTS), allowed_updates=dp.resolve_used_update_types())
     finally:
+        loop_monitor.stop()
+        await close_robokassa_session()
+        # Дописываем буфер журнала событий, пока пул еще открыт
+        await event_log.stop()
         # Закрываем пул соединений при завершении работы
         await db.close()
         logger.info("Database connection pool closed")
 
 if __name__ == "__main__":
+    # Реализация event loop выбирается до создания loop (EVENT_LOOP=uvloop)
+    logger.info(f"Event loop: {select_event_loop(EVENT_LOOP)}")
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
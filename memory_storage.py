@@ -0,0 +1,556 @@
+"""
+IN-MEMORY РЕАЛИЗАЦИЯ ХРАНИЛИЩА (DB_BACKEND=memory)
+
+Повторяет поведение Database (PostgreSQL) без сервера БД: уникальные ключи
+и внешние ключи (те же исключения asyncpg), выборки по частичным индексам
+(только активные подписки / неотправленные напоминания), порядок сортировки
+и откат транзакций db.transaction().
+
+Используется для микробенчмарков обработчиков и планировщика (см. tools/),
+где нужно измерить накладные расходы Python без сетевых обращений к БД.
+"""
+import csv
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from datetime import date, datetime, timedelta
+from clock import clock
+from typing import Optional, List, Dict, Callable, Hashable, AsyncIterator
+from asyncpg.exceptions import UniqueViolationError, ForeignKeyViolationError
+from models import User, Subscription, Payment, Reminder
+from config import IMPORT_STALE_MINUTES
+from subscriber_index import subscriber_index
+from stats import subscription_delta, payment_delta, empty_delta, DAILY_FIELDS, GAUGE_FIELDS
+from export import EXPORT_COLUMNS
+
+# Отсутствующее значение в журнале отмены
+_MISSING = object()
+
+
+class MemoryTransaction:
+    """Транзакция in-memory хранилища: журнал отмены и отложенные до фиксации действия"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.operations = 0
+        self.undo_log: List[tuple] = []
+        self.after_commit: List[Callable[[], None]] = []
+
+    def rollback_to(self, position: int, callbacks: int = 0):
+        """Откатить изменения, записанные в журнал после position, и действия после callbacks"""
+        del self.after_commit[callbacks:]
+        while len(self.undo_log) > position:
+            table, key, old_value = self.undo_log.pop()
+            if old_value is _MISSING:
+                table.pop(key, None)
+            else:
+                table[key] = old_value
+
+
+_current_transaction: ContextVar[Optional[MemoryTransaction]] = ContextVar(
+    "memory_db_transaction", default=None
+)
+
+
+class MemoryDatabase:
+    """
+    Хранилище в памяти с тем же интерфейсом, что и Database
+
+    Таблицы - словари по первичному/уникальному ключу. Строки неизменяемы:
+    любое изменение заменяет объект целиком, поэтому возвращаемые модели
+    безопасно отдавать вызывающему коду, а откат транзакции - это
+    восстановление прежних объектов из журнала.
+    """
+
+    def __init__(self):
+        self.users: Dict[int, User] = {}
+        self.subscriptions: Dict[tuple, Subscription] = {}
+        self.payments: Dict[str, Payment] = {}
+        self.reminders: Dict[tuple, Reminder] = {}
+        self.import_jobs: Dict[str, dict] = {}
+        self.job_checkpoints: Dict[str, dict] = {}
+        self.broadcasts: Dict[int, dict] = {}
+        self.broadcast_deliveries: Dict[tuple, dict] = {}
+        self.stats_daily: Dict[tuple, dict] = {}
+        self.stats_channels: Dict[str, dict] = {}
+        self.subscription_events: List[tuple] = []
+        self._sequences: Dict[str, int] = {}
+        self.transaction_stats: Dict[str, dict] = {}
+
+    # ---- инфраструктура ----
+
+    async def init_db(self):
+        """Нечего инициализировать: таблицы создаются в __init__"""
+
+    async def close(self):
+        """Нечего закрывать"""
+
+    def pool_stats(self) -> dict:
+        """Пула соединений нет"""
+        return {"backend": "memory"}
+
+    def _next_id(self, sequence: str) -> int:
+        self._sequences[sequence] = self._sequences.get(sequence, 0) + 1
+        return self._sequences[sequence]
+
+    def _set(self, table: dict, key: Hashable, value):
+        """Записать строку (с журналированием внутри транзакции)"""
+        transaction = _current_transaction.get()
+        if transaction is not None:
+            transaction.operations += 1
+            transaction.undo_log.append((table, key, table.get(key, _MISSING)))
+        table[key] = value
+
+    def _replace(self, table: dict, key: Hashable, **changes):
+        """Заменить строку-модель копией с измененными полями"""
+        row = table[key]
+        values = row.to_dict()
+        values.update(changes)
+        self._set(table, key, type(row)(**values))
+
+    def _after_commit(self, callback: Callable[[], None]):
+        transaction = _current_transaction.get()
+        if transaction is not None:
+            transaction.after_commit.append(callback)
+        else:
+            callback()
+
+    def _apply_stats(self, channel_name: str, delta: Dict[str, int]):
+        """Аналог Database._apply_stats: счетчики stats_daily и stats_channels"""
+        if any(delta[field] for field in DAILY_FIELDS):
+            key = (clock.now().date(), channel_name)
+            row = self.stats_daily.get(key) or dict.fromkeys(DAILY_FIELDS, 0)
+            self._set(self.stats_daily, key, {field: row[field] + delta[field] for field in DAILY_FIELDS})
+        if any(delta[field] for field in GAUGE_FIELDS):
+            row = self.stats_channels.get(channel_name) or dict.fromkeys(GAUGE_FIELDS, 0)
+            self._set(self.stats_channels, channel_name,
+                      {field: row[field] + delta[field] for field in GAUGE_FIELDS})
+
+    def _check_user(self, telegram_id: int, table: str):
+        """Аналог REFERENCES users(telegram_id)"""
+        if telegram_id not in self.users:
+            raise ForeignKeyViolationError(
+                f'insert or update on table "{table}" violates foreign key constraint '
+                f'"{table}_telegram_id_fkey"'
+            )
+
+    @asynccontextmanager
+    async def transaction(self, name: str = "transaction"):
+        """Единица работы: при исключении все изменения блока откатываются"""
+        outer = _current_transaction.get()
+        if outer is not None:
+            # SAVEPOINT: откат только изменений вложенного блока
+            position, callbacks = len(outer.undo_log), len(outer.after_commit)
+            try:
+                yield outer
+            except BaseException:
+                outer.rollback_to(position, callbacks)
+                raise
+            return
+
+        started = time.perf_counter()
+        transaction = MemoryTransaction(name)
+        token = _current_transaction.set(transaction)
+        try:
+            yield transaction
+        except BaseException:
+            transaction.rollback_to(0)
+            raise
+        finally:
+            _current_transaction.reset(token)
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        stats = self.transaction_stats.setdefault(name, {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+        stats["count"] += 1
+        stats["total_ms"] += elapsed_ms
+        stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+        for callback in transaction.after_commit:
+            callback()
+
+    # ---- users ----
+
+    async def add_user(self, telegram_id: int, username: str = None, first_name: str = None, last_name: str = None):
+        existing = self.users.get(telegram_id)
+        if existing:
+            self._replace(self.users, telegram_id, username=username, first_name=first_name, last_name=last_name)
+        else:
+            self._set(self.users, telegram_id, User(telegram_id, username, first_name, last_name,
+                                                    False, clock.now()))
+
+    async def get_user(self, telegram_id: int) -> Optional[User]:
+        return self.users.get(telegram_id)
+
+    async def get_user_ids_by_usernames(self, usernames: List[str]) -> Dict[str, int]:
+        wanted = {username.lower() for username in usernames}
+        return {
+            user.username.lower(): user.telegram_id
+            for user in self.users.values()
+            if user.username and user.username.lower() in wanted
+        }
+
+    def _insert_missing_users(self, telegram_ids: List[int]):
+        for telegram_id in dict.fromkeys(telegram_ids):
+            if telegram_id not in self.users:
+                self._set(self.users, telegram_id, User(telegram_id, created_at=clock.now()))
+
+    async def import_users_from_masterclass(self, telegram_ids: List[int]):
+        async with self.transaction("import_users_from_masterclass"):
+            self._insert_missing_users(telegram_ids)
+        return [
+            telegram_id for telegram_id in dict.fromkeys(telegram_ids)
+            if not self.users[telegram_id].gift_received
+        ]
+
+    async def mark_gift_received(self, telegram_id: int):
+        if telegram_id in self.users:
+            self._replace(self.users, telegram_id, gift_received=True)
+
+    async def prepare_gift_batch(self, telegram_ids: List[int], channel_name: str,
+                                 start_date: datetime, end_date: datetime, reminder_date: datetime) -> List[int]:
+        async with self.transaction("prepare_gift_batch"):
+            self._insert_missing_users(telegram_ids)
+            # Как и в SQL (WHERE telegram_id = ANY(...)), порядок не гарантируется - берем по возрастанию
+            users_to_gift = sorted(
+                telegram_id for telegram_id in set(telegram_ids)
+                if not self.users[telegram_id].gift_received
+            )
+            for telegram_id in users_to_gift:
+                await self.create_subscription(telegram_id, channel_name, "gift", start_date, end_date)
+                await self.create_reminder(telegram_id, channel_name, reminder_date)
+        return users_to_gift
+
+    async def complete_gift_batch(self, job_id: int, gifted_ids: List[int], processed_rows: int,
+                                  imported: int, unresolved: int):
+        async with self.transaction("complete_gift_batch"):
+            for telegram_id in gifted_ids:
+                await self.mark_gift_received(telegram_id)
+            for key, job in self.import_jobs.items():
+                if job['id'] == job_id:
+                    self._set(self.import_jobs, key, dict(
+                        job, processed_rows=processed_rows, imported=job['imported'] + imported,
+                        gifted=job['gifted'] + len(gifted_ids), unresolved=job['unresolved'] + unresolved,
+                        updated_at=clock.now()
+                    ))
+
+    async def claim_import_job(self, file_unique_id: str, file_name: str, admin_id: int) -> dict:
+        job = self.import_jobs.get(file_unique_id)
+        now = clock.now()
+        if job is None:
+            job = {
+                'id': self._next_id('import_jobs'), 'file_unique_id': file_unique_id,
+                'file_name': file_name, 'admin_id': admin_id, 'status': 'running',
+                'processed_rows': 0, 'imported': 0, 'gifted': 0, 'unresolved': 0,
+                'created_at': now, 'updated_at': now,
+            }
+        elif job['status'] == 'failed' or (
+                job['status'] == 'running' and job['updated_at'] < now - timedelta(minutes=IMPORT_STALE_MINUTES)):
+            job = dict(job, status='running', updated_at=now)
+        else:
+            return dict(job, claimed=False)
+        self._set(self.import_jobs, file_unique_id, job)
+        return dict(job, claimed=True)
+
+    async def finish_import_job(self, job_id: int, status: str = "done"):
+        for key, job in self.import_jobs.items():
+            if job['id'] == job_id:
+                self._set(self.import_jobs, key, dict(job, status=status, updated_at=clock.now()))
+
+    # ---- subscriptions ----
+
+    async def create_subscription(self, telegram_id: int, channel_name: str, payment_method: str,
+                                  start_date: datetime, end_date: datetime, is_active: bool = True):
+        key = (telegram_id, channel_name)
+        now = clock.now()
+        old = self.subscriptions.get(key)
+        if old:
+            self._replace(self.subscriptions, key, is_active=is_active, payment_method=payment_method,
+                          start_date=start_date, end_date=end_date, updated_at=now)
+            delta = subscription_delta(old.is_active, old.payment_method, is_active, payment_method)
+        else:
+            self._check_user(telegram_id, "subscriptions")
+            self._set(self.subscriptions, key, Subscription(
+                self._next_id('subscriptions'), telegram_id, channel_name, is_active,
+                payment_method, start_date, end_date, now, now
+            ))
+            delta = subscription_delta(False, None, is_active, payment_method)
+        self._apply_stats(channel_name, delta)
+
+        if is_active:
+            self._after_commit(lambda: subscriber_index.add(telegram_id, channel_name, end_date))
+        else:
+            self._after_commit(lambda: subscriber_index.discard(telegram_id, channel_name))
+        return bool(old and old.is_active)
+
+    async def get_active_subscription(self, telegram_id: int, channel_name: str,
+                                      primary: bool = False) -> Optional[Subscription]:
+        subscription = self.subscriptions.get((telegram_id, channel_name))
+        return subscription if subscription and subscription.is_active else None
+
+    async def get_user_subscriptions(self, telegram_id: int) -> List[Subscription]:
+        subscriptions = [sub for sub in self.subscriptions.values() if sub.telegram_id == telegram_id]
+        return sorted(subscriptions, key=lambda sub: sub.end_date, reverse=True)
+
+    async def get_active_subscribers(self) -> List[Subscription]:
+        return [sub for sub in self.subscriptions.values() if sub.is_active]
+
+    async def deactivate_subscription(self, telegram_id: int, channel_name: str):
+        key = (telegram_id, channel_name)
+        if key in self.subscriptions:
+            old = self.subscriptions[key]
+            if old.is_active:
+                self._apply_stats(channel_name, subscription_delta(True, old.payment_method,
+                                                                   False, old.payment_method))
+            self._replace(self.subscriptions, key, is_active=False, updated_at=clock.now())
+        self._after_commit(lambda: subscriber_index.discard(telegram_id, channel_name))
+
+    async def has_ever_had_subscription(self, telegram_id: int, channel_name: str) -> bool:
+        return (telegram_id, channel_name) in self.subscriptions
+
+    async def get_expiring_subscriptions(self) -> List[Subscription]:
+        now = clock.now()
+        end_date = now + timedelta(days=3)
+        return [
+            sub for sub in self.subscriptions.values()
+            if sub.is_active and now <= sub.end_date <= end_date and sub.payment_method == 'gift'
+        ]
+
+    async def _iter_pages(self, select, batch_size: int):
+        # Как и в Database, страницы по id перечитываются по мере обхода
+        after_id = 0
+        while True:
+            page = sorted((row for row in select() if row.id > after_id), key=lambda row: row.id)[:batch_size]
+            for row in page:
+                yield row
+            if len(page) < batch_size:
+                break
+            after_id = page[-1].id
+
+    def iter_expired_subscriptions(self, batch_size: int = 500) -> AsyncIterator[Subscription]:
+        now = clock.now()
+        return self._iter_pages(
+            lambda: [sub for sub in self.subscriptions.values() if sub.is_active and sub.end_date < now], batch_size
+        )
+
+    async def get_subscriptions_page(self, after_id: int, limit: int) -> List[Subscription]:
+        page = sorted((sub for sub in self.subscriptions.values() if sub.id > after_id), key=lambda sub: sub.id)
+        return page[:limit]
+
+    async def get_changed_subscriptions_page(self, since: datetime, after_ts: datetime,
+                                             after_id: int, limit: int) -> List[Subscription]:
+        page = sorted(
+            (sub for sub in self.subscriptions.values()
+             if sub.updated_at >= since and (sub.updated_at, sub.id) > (after_ts, after_id)),
+            key=lambda sub: (sub.updated_at, sub.id)
+        )
+        return page[:limit]
+
+    # ---- payments ----
+
+    async def create_payment(self, telegram_id: int, channel_name: str, amount: int, payment_id: str, status: str = "pending"):
+        if payment_id in self.payments:
+            raise UniqueViolationError(
+                'duplicate key value violates unique constraint "payments_payment_id_key"'
+            )
+        self._check_user(telegram_id, "payments")
+        self._set(self.payments, payment_id, Payment(
+            self._next_id('payments'), telegram_id, channel_name, amount, payment_id, status, clock.now()
+        ))
+        if status == 'success':
+            self._apply_stats(channel_name, payment_delta(None, status, amount))
+
+    async def update_payment_status(self, payment_id: str, status: str):
+        payment = self.payments.get(payment_id)
+        if payment is None:
+            return
+        if (payment.status == 'success') != (status == 'success'):
+            self._apply_stats(payment.channel_name, payment_delta(payment.status, status, payment.amount))
+        self._replace(self.payments, payment_id, status=status)
+
+    async def confirm_payment(self, payment_id: str) -> Optional[Payment]:
+        payment = self.payments.get(payment_id)
+        if payment is None or payment.status == 'success':
+            return None
+        self._replace(self.payments, payment_id, status='success')
+        self._apply_stats(payment.channel_name, payment_delta(None, 'success', payment.amount))
+        return self.payments[payment_id]
+
+    async def expire_payment(self, payment_id: str) -> bool:
+        payment = self.payments.get(payment_id)
+        if payment is None or payment.status != 'pending':
+            return False
+        self._replace(self.payments, payment_id, status='expired')
+        return True
+
+    async def get_stale_pending_payments(self, created_before: datetime, after_id: int, limit: int) -> List[Payment]:
+        page = sorted(
+            (payment for payment in self.payments.values()
+             if payment.status == 'pending' and payment.created_at <= created_before and payment.id > after_id),
+            key=lambda payment: payment.id
+        )
+        return page[:limit]
+
+    async def get_payment(self, payment_id: str) -> Optional[Payment]:
+        return self.payments.get(payment_id)
+
+    async def get_stats(self, since: date) -> dict:
+        channels: Dict[str, dict] = {}
+        for channel_name, row in self.stats_channels.items():
+            channels.setdefault(channel_name, empty_delta()).update(row)
+        for (day, channel_name), row in self.stats_daily.items():
+            totals = channels.setdefault(channel_name, empty_delta())
+            for field in DAILY_FIELDS:
+                totals[field] += row[field]
+        daily = sorted(
+            (dict(row, day=day, channel_name=channel_name)
+             for (day, channel_name), row in self.stats_daily.items() if day >= since),
+            key=lambda row: (-row['day'].toordinal(), row['channel_name'])
+        )
+        return {'channels': channels, 'daily': daily}
+
+    async def export_csv(self, table: str, path: str, channel_name: str = None, status: str = None,
+                         since: datetime = None, until: datetime = None) -> int:
+        rows = self.payments.values() if table == "payments" else self.subscriptions.values()
+        if channel_name:
+            rows = [row for row in rows if row.channel_name == channel_name]
+        if status and table == "payments":
+            rows = [row for row in rows if row.status == status]
+        elif status:
+            rows = [row for row in rows if row.is_active == (status == "active")]
+        if since:
+            rows = [row for row in rows if row.created_at >= since]
+        if until:
+            rows = [row for row in rows if row.created_at < until]
+
+        columns = EXPORT_COLUMNS[table]
+        # Формат как у COPY ... CSV: булевы значения t/f, NULL - пустое поле
+        def value(row, column):
+            item = getattr(row, column)
+            if isinstance(item, bool):
+                return "t" if item else "f"
+            return "" if item is None else item
+
+        rows = sorted(rows, key=lambda row: row.id)
+        with open(path, "w", newline="", encoding="utf-8") as output:
+            writer = csv.writer(output, lineterminator="\n")
+            writer.writerow(columns)
+            writer.writerows([value(row, column) for column in columns] for row in rows)
+        return len(rows)
+
+    # ---- журнал событий ----
+
+    async def write_events(self, events: List[tuple]):
+        # Журнал вне транзакций: как и COPY, пачка пишется сразу
+        self.subscription_events.extend(events)
+
+    async def get_user_events(self, telegram_id: int, limit: int = 50) -> List[dict]:
+        events = [
+            {'occurred_at': occurred_at, 'channel_name': channel_name, 'event': event, 'details': details}
+            for occurred_at, user_id, channel_name, event, details in self.subscription_events
+            if user_id == telegram_id
+        ]
+        events.sort(key=lambda event: event['occurred_at'], reverse=True)
+        return events[:limit]
+
+    # ---- reminders ----
+
+    async def create_reminder(self, telegram_id: int, channel_name: str, reminder_date: datetime):
+        key = (telegram_id, channel_name)
+        if key in self.reminders:
+            self._replace(self.reminders, key, reminder_date=reminder_date, reminder_sent=False)
+        else:
+            self._check_user(telegram_id, "reminders")
+            self._set(self.reminders, key, Reminder(
+                self._next_id('reminders'), telegram_id, channel_name, False, reminder_date
+            ))
+
+    async def mark_reminder_sent(self, telegram_id: int, channel_name: str):
+        key = (telegram_id, channel_name)
+        if key in self.reminders:
+            self._replace(self.reminders, key, reminder_sent=True)
+
+    def _pending_reminders(self) -> List[Reminder]:
+        now = clock.now()
+        return [r for r in self.reminders.values() if not r.reminder_sent and r.reminder_date <= now]
+
+    async def get_pending_reminders(self) -> List[Reminder]:
+        return self._pending_reminders()
+
+    def iter_pending_reminders(self, batch_size: int = 500) -> AsyncIterator[Reminder]:
+        now = clock.now()
+        return self._iter_pages(
+            lambda: [r for r in self.reminders.values() if not r.reminder_sent and r.reminder_date <= now], batch_size
+        )
+
+    # ---- job checkpoints ----
+
+    async def get_checkpoint(self, job_name: str) -> Optional[dict]:
+        checkpoint = self.job_checkpoints.get(job_name)
+        return dict(checkpoint) if checkpoint else None
+
+    async def save_checkpoint(self, job_name: str, cursor_id: int, cursor_ts: Optional[datetime],
+                              watermark: Optional[datetime]):
+        self._set(self.job_checkpoints, job_name, {
+            'job_name': job_name, 'cursor_id': cursor_id, 'cursor_ts': cursor_ts,
+            'watermark': watermark, 'updated_at': clock.now(),
+        })
+
+    # ---- broadcasts ----
+
+    async def create_broadcast(self, admin_id: int, channel_name: str, text: str) -> dict:
+        total = sum(1 for sub in self.subscriptions.values() if sub.channel_name == channel_name and sub.is_active)
+        broadcast = {
+            'id': self._next_id('broadcasts'), 'admin_id': admin_id, 'channel_name': channel_name,
+            'text': text, 'status': 'running', 'progress_chat_id': None, 'progress_message_id': None,
+            'total': total, 'sent': 0, 'failed': 0, 'created_at': clock.now(), 'finished_at': None,
+        }
+        self._set(self.broadcasts, broadcast['id'], broadcast)
+        return dict(broadcast)
+
+    async def set_broadcast_progress_message(self, broadcast_id: int, chat_id: int, message_id: int):
+        broadcast = self.broadcasts[broadcast_id]
+        self._set(self.broadcasts, broadcast_id, dict(
+            broadcast, progress_chat_id=chat_id, progress_message_id=message_id
+        ))
+
+    async def get_running_broadcasts(self) -> List[dict]:
+        return [dict(b) for _, b in sorted(self.broadcasts.items()) if b['status'] == 'running']
+
+    async def iter_broadcast_recipients(self, broadcast_id: int, channel_name: str, batch_size: int):
+        # Как и в Database, страницы по telegram_id перечитываются по мере рассылки
+        def delivered(telegram_id: int) -> bool:
+            delivery = self.broadcast_deliveries.get((broadcast_id, telegram_id))
+            return delivery is not None and delivery['status'] != 'retry'
+
+        after_id = 0
+        while True:
+            page = sorted(
+                sub.telegram_id for sub in self.subscriptions.values()
+                if sub.channel_name == channel_name and sub.is_active and sub.telegram_id > after_id
+                and not delivered(sub.telegram_id)
+            )[:batch_size]
+            if not page:
+                break
+            yield page
+            if len(page) < batch_size:
+                break
+            after_id = page[-1]
+
+    async def record_broadcast_deliveries(self, broadcast_id: int, deliveries: List[tuple]):
+        sent = sum(1 for _, status, _ in deliveries if status == 'sent')
+        failed = sum(1 for _, status, _ in deliveries if status in ('blocked', 'failed'))
+        async with self.transaction("record_broadcast_deliveries"):
+            for telegram_id, status, error in deliveries:
+                key = (broadcast_id, telegram_id)
+                if self.broadcast_deliveries.get(key, {'status': 'retry'})['status'] == 'retry':
+                    self._set(self.broadcast_deliveries, key, {
+                        'broadcast_id': broadcast_id, 'telegram_id': telegram_id, 'status': status,
+                        'error': error, 'delivered_at': clock.now(),
+                    })
+            broadcast = self.broadcasts[broadcast_id]
+            self._set(self.broadcasts, broadcast_id, dict(
+                broadcast, sent=broadcast['sent'] + sent, failed=broadcast['failed'] + failed
+            ))
+
+    async def finish_broadcast(self, broadcast_id: int, status: str = "done"):
+        broadcast = self.broadcasts[broadcast_id]
+        self._set(self.broadcasts, broadcast_id, dict(broadcast, status=status, finished_at=clock.now()))
@@ -1,5 +1,6 @@
 from datetime import datetime, timedelta
-from config import FREE_TRIAL_DAYS, CHANNEL_1_PRICE, CHANNEL_2_PRICE
+from config import FREE_TRIAL_DAYS
+from tenants import current_tenant
 
 def format_date(date: datetime) -> str:
     """Format date for display"""
@@ -48,6 +49,12 @@ def get_payment_success_with_bonus_message(channel_start: datetime, channel_end:
 
 Доступ в Орден Демиургов активен: {format_date(bonus_start)} — {format_date(bonus_end)}"""
 
+def get_join_request_declined_message() -> str:
+    """Message when join request is declined (no active subscription)"""
+    return """Для вступления в канал нужна активная подписка.
+
+Оформите доступ, и заявка будет одобрена автоматически."""
+
 # Path 2: Regular users messages
 def get_start_message() -> str:
     """Start message for regular users"""
@@ -70,7 +77,7 @@ def get_channel_1_info_message() -> str:
 
 Если вы хотите чувствовать себя устойчивее и спокойнее в повседневной жизни — добро пожаловать.
 
-Цена: {CHANNEL_1_PRICE} руб
+Цена: {current_tenant().price("channel_1")} руб
 Продолжительность: 1 месяц
 Вы получаете доступ к частному каналу и чату.
  Доступ открывается сразу после оплаты 👇"""
@@ -88,7 +95,7 @@ def get_channel_2_info_message() -> str:
  — получить простые практики, которые реально работают в повседневной жизни
 Это пространство для тех, кто хочет быть опорой для ребёнка — и при этом не терять себя.
 
-Цена: {CHANNEL_2_PRICE} руб
+Цена: {current_tenant().price("channel_2")} руб
 Продолжительность: 1 месяц
 Вы получаете доступ к частному каналу и чату.
  Доступ открывается сразу после оплаты 👇"""
@@ -100,10 +107,10 @@ def get_subscriptions_message(subscriptions: list) -> str:
     
     message = ""
     for sub in subscriptions:
-        channel_name = "Орден Демиургов" if sub['channel_name'] == 'channel_1' else "Родители Демиурги"
-        status = "Активна" if sub['is_active'] else "Не активирована"
-        start_date = format_date(datetime.fromisoformat(sub['start_date'])) if sub['start_date'] else "—"
-        end_date = format_date(datetime.fromisoformat(sub['end_date'])) if sub['end_date'] else "—"
+        channel_name = "Орден Демиургов" if sub.channel_name == 'channel_1' else "Родители Демиурги"
+        status = "Активна" if sub.is_active else "Не активирована"
+        start_date = format_date(sub.start_date) if sub.start_date else "—"
+        end_date = format_date(sub.end_date) if sub.end_date else "—"
         
         message += f"""Канал: {channel_name}
 Статус подписки: {status}
@@ -0,0 +1,288 @@
+"""
+ВЕРСИОНИРОВАННЫЕ МИГРАЦИИ СХЕМЫ БД
+
+Каждая миграция - (версия, описание, список SQL-операторов).
+Примененные версии хранятся в таблице schema_migrations, поэтому при обычном
+перезапуске бота выполняется один SELECT вместо всех CREATE TABLE/INDEX.
+
+Новые изменения схемы добавляются ТОЛЬКО новой миграцией в конец списка.
+Операторы написаны с IF NOT EXISTS: базы, созданные до появления
+schema_migrations, проходят все миграции без ошибок.
+"""
+import asyncpg
+
+# Ключ advisory-блокировки, чтобы два процесса не применяли миграции одновременно
+MIGRATIONS_LOCK_ID = 724_001
+
+MIGRATIONS = [
+    (1, "base tables and indexes", [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            telegram_id BIGINT PRIMARY KEY,
+            username VARCHAR(255),
+            first_name VARCHAR(255),
+            last_name VARCHAR(255),
+            gift_received BOOLEAN DEFAULT FALSE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            id SERIAL PRIMARY KEY,
+            telegram_id BIGINT NOT NULL REFERENCES users(telegram_id) ON DELETE CASCADE,
+            channel_name VARCHAR(50) NOT NULL,
+            is_active BOOLEAN DEFAULT FALSE,
+            payment_method VARCHAR(50) NOT NULL,
+            start_date TIMESTAMP NOT NULL,
+            end_date TIMESTAMP NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(telegram_id, channel_name)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS payments (
+            id SERIAL PRIMARY KEY,
+            telegram_id BIGINT NOT NULL REFERENCES users(telegram_id) ON DELETE CASCADE,
+            channel_name VARCHAR(50) NOT NULL,
+            amount INTEGER NOT NULL,
+            payment_id VARCHAR(255) UNIQUE NOT NULL,
+            status VARCHAR(50) DEFAULT 'pending',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS reminders (
+            id SERIAL PRIMARY KEY,
+            telegram_id BIGINT NOT NULL REFERENCES users(telegram_id) ON DELETE CASCADE,
+            channel_name VARCHAR(50) NOT NULL,
+            reminder_sent BOOLEAN DEFAULT FALSE,
+            reminder_date TIMESTAMP NOT NULL,
+            UNIQUE(telegram_id, channel_name)
+        )
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_subscriptions_active
+        ON subscriptions(telegram_id, channel_name, is_active)
+        WHERE is_active = TRUE
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_subscriptions_end_date
+        ON subscriptions(end_date)
+        WHERE is_active = TRUE
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_payments_status
+        ON payments(status)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_payments_telegram_id
+        ON payments(telegram_id)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_reminders_pending
+        ON reminders(reminder_date, reminder_sent)
+        WHERE reminder_sent = FALSE
+        """,
+    ]),
+    (2, "import_jobs checkpoints", [
+        """
+        CREATE TABLE IF NOT EXISTS import_jobs (
+            id SERIAL PRIMARY KEY,
+            file_unique_id VARCHAR(255) UNIQUE NOT NULL,
+            file_name VARCHAR(255),
+            admin_id BIGINT NOT NULL,
+            status VARCHAR(50) DEFAULT 'running',
+            processed_rows INTEGER DEFAULT 0,
+            imported INTEGER DEFAULT 0,
+            gifted INTEGER DEFAULT 0,
+            unresolved INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ]),
+    (3, "case-insensitive username index", [
+        """
+        CREATE INDEX IF NOT EXISTS idx_users_username_lower
+        ON users(lower(username))
+        """,
+    ]),
+    (4, "broadcasts", [
+        """
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id SERIAL PRIMARY KEY,
+            admin_id BIGINT NOT NULL,
+            channel_name VARCHAR(50) NOT NULL,
+            text TEXT NOT NULL,
+            status VARCHAR(50) DEFAULT 'running',
+            progress_chat_id BIGINT,
+            progress_message_id BIGINT,
+            total INTEGER DEFAULT 0,
+            sent INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+            broadcast_id INTEGER NOT NULL REFERENCES broadcasts(id) ON DELETE CASCADE,
+            telegram_id BIGINT NOT NULL,
+            status VARCHAR(50) NOT NULL,
+            error TEXT,
+            delivered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (broadcast_id, telegram_id)
+        )
+        """,
+    ]),
+    (5, "membership reconciliation checkpoints", [
+        """
+        ALTER TABLE subscriptions
+        ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_subscriptions_updated_at
+        ON subscriptions(updated_at, id)
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS job_checkpoints (
+            job_name VARCHAR(100) PRIMARY KEY,
+            cursor_id INTEGER DEFAULT 0,
+            cursor_ts TIMESTAMP,
+            watermark TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ]),
+    (6, "pending payments index for reconciliation", [
+        """
+        CREATE INDEX IF NOT EXISTS idx_payments_pending
+        ON payments(id)
+        WHERE status = 'pending'
+        """,
+    ]),
+    (7, "stats rollup tables", [
+        """
+        CREATE TABLE IF NOT EXISTS stats_daily (
+            day DATE NOT NULL,
+            channel_name VARCHAR(50) NOT NULL,
+            new_subscriptions INTEGER NOT NULL DEFAULT 0,
+            new_trials INTEGER NOT NULL DEFAULT 0,
+            conversions INTEGER NOT NULL DEFAULT 0,
+            deactivations INTEGER NOT NULL DEFAULT 0,
+            payments INTEGER NOT NULL DEFAULT 0,
+            revenue BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, channel_name)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS stats_channels (
+            channel_name VARCHAR(50) PRIMARY KEY,
+            active_subscriptions INTEGER NOT NULL DEFAULT 0,
+            active_trials INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        # Начальное заполнение по существующим данным (дальше счетчики ведут методы Database).
+        # Конверсии прошлых периодов восстановить нельзя - они считаются с момента миграции
+        """
+        INSERT INTO stats_channels (channel_name, active_subscriptions, active_trials)
+        SELECT channel_name, COUNT(*), COUNT(*) FILTER (WHERE payment_method = 'gift')
+        FROM subscriptions
+        WHERE is_active = TRUE
+        GROUP BY channel_name
+        ON CONFLICT (channel_name) DO NOTHING
+        """,
+        """
+        INSERT INTO stats_daily (day, channel_name, new_subscriptions, new_trials, payments, revenue)
+        SELECT day, channel_name, SUM(new_subscriptions), SUM(new_trials), SUM(payments), SUM(revenue)
+        FROM (
+            SELECT created_at::date AS day, channel_name,
+                   COUNT(*) FILTER (WHERE payment_method <> 'gift') AS new_subscriptions,
+                   COUNT(*) FILTER (WHERE payment_method = 'gift') AS new_trials,
+                   0 AS payments, 0 AS revenue
+            FROM subscriptions
+            GROUP BY 1, 2
+            UNION ALL
+            SELECT created_at::date, channel_name, 0, 0, COUNT(*), SUM(amount)
+            FROM payments
+            WHERE status = 'success'
+            GROUP BY 1, 2
+        ) AS history
+        GROUP BY day, channel_name
+        ON CONFLICT (day, channel_name) DO NOTHING
+        """,
+    ]),
+    (8, "subscription events log", [
+        # Журнал только дополняется, поэтому без первичного ключа и внешних ключей:
+        # запись пачкой через COPY не поддерживает индекс первичного ключа и не проверяет
+        # ссылки на users (NOT NULL проверяется, два индекса ниже обновляются)
+        """
+        CREATE TABLE IF NOT EXISTS subscription_events (
+            occurred_at TIMESTAMP NOT NULL,
+            telegram_id BIGINT NOT NULL,
+            channel_name VARCHAR(50),
+            event VARCHAR(32) NOT NULL,
+            details JSONB
+        )
+        """,
+        # BRIN: строки пишутся в порядке времени, индекс по диапазонам занимает килобайты
+        """
+        CREATE INDEX IF NOT EXISTS idx_subscription_events_time
+        ON subscription_events USING BRIN (occurred_at)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_subscription_events_user
+        ON subscription_events(telegram_id, occurred_at)
+        """,
+    ]),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+async def get_schema_version(conn: asyncpg.Connection) -> int:
+    """Текущая версия схемы (0, если миграции еще не применялись)"""
+    try:
+        return await conn.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+    except asyncpg.UndefinedTableError:
+        return 0
+
+
+async def run_migrations(conn: asyncpg.Connection) -> list:
+    """
+    Применить недостающие миграции
+
+    Быстрый путь (схема актуальна) - один SELECT.
+    Иначе миграции применяются в одной транзакции под advisory-блокировкой.
+
+    Returns:
+        Список примененных версий
+    """
+    if await get_schema_version(conn) >= LATEST_VERSION:
+        return []
+
+    applied = []
+    async with conn.transaction():
+        await conn.execute("SELECT pg_advisory_xact_lock($1)", MIGRATIONS_LOCK_ID)
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                description VARCHAR(255) NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        # Перечитываем под блокировкой: другой процесс мог уже применить миграции
+        current = await conn.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+        for version, description, statements in MIGRATIONS:
+            if version <= current:
+                continue
+            for statement in statements:
+                await conn.execute(statement)
+            await conn.execute(
+                "INSERT INTO schema_migrations (version, description) VALUES ($1, $2)",
+                version, description
+            )
+            print(f"[DB] Applied migration {version}: {description}")
+            applied.append(version)
+    return applied
@@ -0,0 +1,128 @@
+"""
+КОМПАКТНЫЕ МОДЕЛИ СТРОК БАЗЫ ДАННЫХ
+
+Классы с __slots__ создаются напрямую из asyncpg.Record без промежуточного dict:
+меньше памяти на строку и нет повторного разбора дат у потребителей.
+Все даты приводятся к naive datetime в локальном времени - так же, как
+clock.now(), с которым их сравнивают планировщик и обработчики.
+"""
+from datetime import datetime
+from typing import Optional
+
+
+def normalize_datetime(value) -> Optional[datetime]:
+    """Привести дату из БД к naive datetime в локальном времени"""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if value.tzinfo is not None:
+        value = value.astimezone().replace(tzinfo=None)
+    return value
+
+
+class Row:
+    """Базовый класс модели строки"""
+
+    __slots__ = ()
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+    def __eq__(self, other) -> bool:
+        return type(self) is type(other) and self.to_dict() == other.to_dict()
+
+
+class User(Row):
+    __slots__ = ("telegram_id", "username", "first_name", "last_name", "gift_received", "created_at")
+
+    def __init__(self, telegram_id: int, username: str = None, first_name: str = None,
+                 last_name: str = None, gift_received: bool = False, created_at: datetime = None):
+        self.telegram_id = telegram_id
+        self.username = username
+        self.first_name = first_name
+        self.last_name = last_name
+        self.gift_received = bool(gift_received)
+        self.created_at = normalize_datetime(created_at)
+
+    @classmethod
+    def from_record(cls, record) -> "User":
+        return cls(
+            record["telegram_id"], record.get("username"), record.get("first_name"),
+            record.get("last_name"), record.get("gift_received"), record.get("created_at")
+        )
+
+
+class Subscription(Row):
+    __slots__ = ("id", "telegram_id", "channel_name", "is_active", "payment_method",
+                 "start_date", "end_date", "created_at", "updated_at")
+
+    def __init__(self, id: int, telegram_id: int, channel_name: str, is_active: bool,
+                 payment_method: str, start_date: datetime, end_date: datetime,
+                 created_at: datetime = None, updated_at: datetime = None):
+        self.id = id
+        self.telegram_id = telegram_id
+        self.channel_name = channel_name
+        self.is_active = bool(is_active)
+        self.payment_method = payment_method
+        self.start_date = normalize_datetime(start_date)
+        self.end_date = normalize_datetime(end_date)
+        self.created_at = normalize_datetime(created_at)
+        self.updated_at = normalize_datetime(updated_at)
+
+    @classmethod
+    def from_record(cls, record) -> "Subscription":
+        # Частичные выборки (например, telegram_id, channel_name, end_date) тоже допустимы
+        return cls(
+            record.get("id"), record["telegram_id"], record["channel_name"],
+            record.get("is_active", True), record.get("payment_method"),
+            record.get("start_date"), record.get("end_date"),
+            record.get("created_at"), record.get("updated_at")
+        )
+
+    def is_expired(self, now: datetime) -> bool:
+        return self.end_date is not None and self.end_date <= now
+
+
+class Payment(Row):
+    __slots__ = ("id", "telegram_id", "channel_name", "amount", "payment_id", "status", "created_at")
+
+    def __init__(self, id: int, telegram_id: int, channel_name: str, amount: int,
+                 payment_id: str, status: str = "pending", created_at: datetime = None):
+        self.id = id
+        self.telegram_id = telegram_id
+        self.channel_name = channel_name
+        self.amount = amount
+        self.payment_id = payment_id
+        self.status = status
+        self.created_at = normalize_datetime(created_at)
+
+    @classmethod
+    def from_record(cls, record) -> "Payment":
+        return cls(
+            record.get("id"), record["telegram_id"], record["channel_name"], record["amount"],
+            record["payment_id"], record.get("status"), record.get("created_at")
+        )
+
+
+class Reminder(Row):
+    __slots__ = ("id", "telegram_id", "channel_name", "reminder_sent", "reminder_date")
+
+    def __init__(self, id: int, telegram_id: int, channel_name: str,
+                 reminder_sent: bool, reminder_date: datetime):
+        self.id = id
+        self.telegram_id = telegram_id
+        self.channel_name = channel_name
+        self.reminder_sent = bool(reminder_sent)
+        self.reminder_date = normalize_datetime(reminder_date)
+
+    @classmethod
+    def from_record(cls, record) -> "Reminder":
+        return cls(
+            record.get("id"), record["telegram_id"], record["channel_name"],
+            record.get("reminder_sent"), record["reminder_date"]
+        )
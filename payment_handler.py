@@ -1,20 +1,54 @@
 from aiohttp import web
 from database import db
-from robokassa import verify_payment_signature
-from handlers import process_payment_success
-from config import (
-    ROBOKASSA_CHANNEL_1_PASSWORD_2,
-    ROBOKASSA_CHANNEL_2_PASSWORD_2
-)
+from robokassa import verify_payment_signature, get_channel_credentials
+from handlers import grant_paid_subscription, deliver_paid_subscription
+from admission import admission_middleware, admission_metrics_handler
+from events import event_log, PAYMENT_CONFIRMED
+from tenants import current_tenant, tenant_http_middleware
+from config import ADMIN_API_TOKEN
 from aiogram import Bot
 import os
 import logging
 
 logger = logging.getLogger(__name__)
 
+async def complete_payment(payment_id: str, bot: Bot) -> bool:
+    """
+    Подтвердить оплату и выдать доступ (ResultURL и сверка платежей)
+    
+    Статус меняется условным UPDATE (db.confirm_payment), поэтому из
+    одновременных уведомления и сверки доступ выдает только один.
+    
+    Подтверждение и выдача подписки - одна транзакция: если выдать подписку
+    не удалось, платеж остается 'pending', ResultURL получает ошибку, и
+    платеж подтвердит повторное уведомление или сверка платежей.
+    Ошибки Bot API после фиксации только пишутся в лог - доступ уже выдан.
+    
+    Returns:
+        True, если платеж подтвержден этим вызовом
+    """
+    async with db.transaction("complete_payment"):
+        payment = await db.confirm_payment(payment_id)
+        if payment is None:
+            return False
+        grant = await grant_paid_subscription(payment.telegram_id, payment.channel_name)
+    logger.info(f"[Robokassa] Payment status updated to 'success' for InvId={payment_id}")
+    event_log.record(PAYMENT_CONFIRMED, payment.telegram_id, payment.channel_name,
+                     payment_id=payment_id, amount=payment.amount)
+    
+    user_id = payment.telegram_id
+    try:
+        await deliver_paid_subscription(bot, user_id, payment.channel_name, grant)
+        logger.info(f"[Robokassa] Payment success processed for user {user_id}, channel {payment.channel_name}")
+    except Exception as e:
+        logger.error(f"[Robokassa] Error processing payment success: {e}", exc_info=True)
+    return True
+
 async def robokassa_result_handler(request):
-    """Handle Robokassa ResultURL (notification)"""
-    bot = request.app['bot']
+    """Handle Robokassa ResultURL (notification); /robokassa/{tenant}/result - for the tenant's payments"""
+    tenant = current_tenant()
+    tenant.metrics["webhooks"] += 1
+    bot = tenant.bot or request.app['bot']
     
     try:
         # Get parameters from request
@@ -51,12 +85,10 @@ async def robokassa_result_handler(request):
         logger.info(f"[Robokassa] Payment found: {payment}")
         
         # Select correct password based on channel
-        channel_name = payment['channel_name']
-        if channel_name == "channel_1":
-            password_2 = ROBOKASSA_CHANNEL_1_PASSWORD_2
-        elif channel_name == "channel_2":
-            password_2 = ROBOKASSA_CHANNEL_2_PASSWORD_2
-        else:
+        channel_name = payment.channel_name
+        try:
+            _, _, password_2 = get_channel_credentials(channel_name)
+        except ValueError:
             error_msg = f"ERROR: Unknown channel: {channel_name}"
             logger.error(f"[Robokassa] {error_msg}")
             return web.Response(text=error_msg)
@@ -72,24 +104,11 @@ async def robokassa_result_handler(request):
         
         logger.info(f"[Robokassa] Signature verified successfully for InvId={InvId}")
         
-        # Check if already processed
-        if payment['status'] == 'success':
+        # Подтверждение идемпотентно: повторное уведомление (или сверка) доступ не выдает
+        if not await complete_payment(InvId, bot):
             logger.info(f"[Robokassa] Payment {InvId} already processed, returning OK")
             return web.Response(text=f"OK{InvId}")
         
-        # Update payment status
-        await db.update_payment_status(InvId, 'success')
-        logger.info(f"[Robokassa] Payment status updated to 'success' for InvId={InvId}")
-        
-        # Process payment success
-        user_id = payment['telegram_id']
-        
-        try:
-            await process_payment_success(user_id, channel_name, bot)
-            logger.info(f"[Robokassa] Payment success processed for user {user_id}, channel {channel_name}")
-        except Exception as e:
-            logger.error(f"[Robokassa] Error processing payment success: {e}", exc_info=True)
-        
         logger.info(f"[Robokassa] Returning OK for InvId={InvId}")
         return web.Response(text=f"OK{InvId}")
         
@@ -122,8 +141,15 @@ async def robokassa_health_check(request):
 def setup_payment_routes(app: web.Application, bot: Bot):
     """Setup payment webhook routes"""
     app['bot'] = bot
+    # Арендатор запроса (tenants.py): /robokassa/{tenant}/result, ?tenant= для /admin/*
+    app.middlewares.append(tenant_http_middleware)
+    # Ограничение конкурентности маршрутов Robokassa (503 при перегрузке)
+    app.middlewares.append(admission_middleware)
     app.router.add_post('/robokassa/result', robokassa_result_handler)
+    app.router.add_post('/robokassa/{tenant}/result', robokassa_result_handler)
     app.router.add_get('/robokassa/success', robokassa_success_handler)
     app.router.add_get('/robokassa/fail', robokassa_fail_handler)
     app.router.add_get('/robokassa/health', robokassa_health_check)  # For testing accessibility
-
+    if ADMIN_API_TOKEN:
+        # Метрики admission control - с токеном, как /admin/stats
+        app.router.add_get('/robokassa/metrics', admission_metrics_handler)
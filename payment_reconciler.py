@@ -0,0 +1,136 @@
+"""
+СВЕРКА ЗАВИСШИХ ПЛАТЕЖЕЙ С ROBOKASSA (OpState)
+
+Если уведомление ResultURL не дошло, платеж остается 'pending', и пользователь
+не получает доступ. Задача планировщика раз в PAYMENT_RECONCILE_INTERVAL_MINUTES:
+- выбирает пачками платежи 'pending' старше PAYMENT_RECONCILE_MIN_AGE_MINUTES;
+- запрашивает их состояние в интерфейсе OpState через общую aiohttp-сессию
+  (не больше PAYMENT_RECONCILE_CONCURRENCY запросов одновременно);
+- оплаченные проводит через тот же идемпотентный путь, что и ResultURL
+  (payment_handler.complete_payment);
+- неоплаченные старше PAYMENT_RECONCILE_MAX_AGE_HOURS помечает 'expired'.
+
+Для локальной проверки: tools/robokassa_stub.py и
+ROBOKASSA_OPSTATE_URL=http://127.0.0.1:8081/Merchant/WebService/Service.asmx/OpStateExt
+"""
+import asyncio
+import logging
+from datetime import timedelta
+from decimal import Decimal, InvalidOperation
+from typing import Optional
+import aiohttp
+from aiogram import Bot
+from clock import clock
+from database import db
+from models import Payment
+from robokassa import (
+    build_opstate_params, parse_opstate_response,
+    OPSTATE_RESULT_OK, OPSTATE_RESULT_NOT_FOUND, OPSTATE_STATE_PAID, OPSTATE_UNPAID_STATES
+)
+from config import (
+    ROBOKASSA_OPSTATE_URL, PAYMENT_RECONCILE_MIN_AGE_MINUTES, PAYMENT_RECONCILE_MAX_AGE_HOURS,
+    PAYMENT_RECONCILE_BATCH_SIZE, PAYMENT_RECONCILE_CONCURRENCY
+)
+
+logger = logging.getLogger(__name__)
+
+# Таймаут одного запроса OpState (секунды)
+OPSTATE_TIMEOUT = 15
+
+_session: Optional[aiohttp.ClientSession] = None
+
+
+def get_session() -> aiohttp.ClientSession:
+    """Общая сессия с пулом keep-alive соединений к Robokassa"""
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=PAYMENT_RECONCILE_CONCURRENCY),
+            timeout=aiohttp.ClientTimeout(total=OPSTATE_TIMEOUT)
+        )
+    return _session
+
+
+async def close_session():
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+
+async def fetch_op_state(payment: Payment) -> dict:
+    """Запросить состояние операции по платежу (учетные данные канала платежа)"""
+    params = build_opstate_params(payment.payment_id, payment.channel_name)
+    async with get_session().get(ROBOKASSA_OPSTATE_URL, params=params) as response:
+        response.raise_for_status()
+        return parse_opstate_response(await response.text())
+
+
+def _amount_matches(payment: Payment, out_sum: Optional[str]) -> bool:
+    """Сумма оплаты не меньше суммы платежа (если Robokassa ее вернула)"""
+    if out_sum is None:
+        return True
+    try:
+        return Decimal(out_sum) >= Decimal(payment.amount)
+    except InvalidOperation:
+        return False
+
+
+async def reconcile_payment(bot: Bot, payment: Payment, report: dict, semaphore: asyncio.Semaphore):
+    """Проверить один платеж и провести/закрыть его по ответу OpState"""
+    from payment_handler import complete_payment
+
+    async with semaphore:
+        try:
+            state = await fetch_op_state(payment)
+        except Exception as e:
+            report['errors'] += 1
+            logger.warning(f"[PAYMENTS] OpState request failed for InvId={payment.payment_id}: {e}")
+            return
+
+    report['checked'] += 1
+    if state['result_code'] == OPSTATE_RESULT_OK and state['state_code'] == OPSTATE_STATE_PAID:
+        if not _amount_matches(payment, state['out_sum']):
+            report['errors'] += 1
+            logger.error(
+                f"[PAYMENTS] InvId={payment.payment_id} paid {state['out_sum']}, expected {payment.amount} - skipped"
+            )
+            return
+        try:
+            confirmed = await complete_payment(payment.payment_id, bot)
+        except Exception as e:
+            # Платеж остался 'pending' - повторим на следующем проходе
+            report['errors'] += 1
+            logger.error(f"[PAYMENTS] Could not complete InvId={payment.payment_id}: {e}", exc_info=True)
+            return
+        if confirmed:
+            report['confirmed'] += 1
+            logger.info(f"[PAYMENTS] InvId={payment.payment_id} confirmed by OpState (ResultURL was missed)")
+        return
+
+    unpaid = (state['result_code'] == OPSTATE_RESULT_NOT_FOUND
+              or (state['result_code'] == OPSTATE_RESULT_OK and state['state_code'] in OPSTATE_UNPAID_STATES))
+    expired = payment.created_at <= clock.now() - timedelta(hours=PAYMENT_RECONCILE_MAX_AGE_HOURS)
+    if unpaid and expired and await db.expire_payment(payment.payment_id):
+        report['expired'] += 1
+    else:
+        report['pending'] += 1
+
+
+async def reconcile_pending_payments(bot: Bot) -> dict:
+    """Один проход сверки всех зависших платежей (keyset-пагинация по id)"""
+    report = {'checked': 0, 'confirmed': 0, 'expired': 0, 'pending': 0, 'errors': 0}
+    semaphore = asyncio.Semaphore(PAYMENT_RECONCILE_CONCURRENCY)
+    created_before = clock.now() - timedelta(minutes=PAYMENT_RECONCILE_MIN_AGE_MINUTES)
+    after_id = 0
+
+    while True:
+        page = await db.get_stale_pending_payments(created_before, after_id, PAYMENT_RECONCILE_BATCH_SIZE)
+        if not page:
+            break
+        await asyncio.gather(*(reconcile_payment(bot, payment, report, semaphore) for payment in page))
+        after_id = page[-1].id
+
+    if report['checked'] or report['errors']:
+        logger.info(f"[PAYMENTS] Pending payments reconciliation: {report}")
+    return report
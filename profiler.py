@@ -0,0 +1,224 @@
+"""
+СЭМПЛИРУЮЩИЙ ПРОФИЛИРОВЩИК ОБРАБОТЧИКОВ И ЗАДАЧ ПЛАНИРОВЩИКА
+
+Профилируется только доля выполнений (PROFILE_SAMPLE_RATE). Пока выбранное
+выполнение активно, фоновый поток раз в PROFILE_INTERVAL_MS снимает стек
+потока event loop (sys._current_frames) и, если сейчас выполняется задача
+asyncio выбранного выполнения и в стеке есть функция обработчика, засчитывает
+стек этому обработчику. Одновременные невыбранные выполнения того же
+обработчика идут в других задачах и не засчитываются. Трассировки вызовов нет,
+поэтому накладные расходы малы; учитывается только время на CPU - пока
+обработчик ждет сеть или БД, его кадров в стеке нет.
+
+Стеки хранятся в свернутом формате flamegraph.pl / speedscope:
+    обработчик;функция (файл:строка);... количество_сэмплов
+
+Включение и выключение - без перезапуска: команда /profile (handlers.py)
+или POST /debug/profile?action=on (setup_profile_routes).
+"""
+import asyncio
+import asyncio.tasks
+import functools
+import hmac
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, Optional
+from aiogram import BaseMiddleware
+from aiohttp import web
+from config import PROFILE_ENABLED, PROFILE_SAMPLE_RATE, PROFILE_INTERVAL_MS, PROFILE_TOKEN
+
+# Текущая задача каждого event loop (то же, что asyncio.current_task(), но читается
+# из потока сэмплирования); без него профилировщик не снимает стеки
+_current_tasks = getattr(asyncio.tasks, "_current_tasks", None)
+
+
+class SamplingProfiler:
+    """Сбор стеков выбранных выполнений обработчиков (свернутые стеки по имени обработчика)"""
+
+    def __init__(self, sample_rate: float, interval_ms: float, enabled: bool = False):
+        self.sample_rate = sample_rate
+        self.interval = interval_ms / 1000
+        self.enabled = False
+        # Счетчики по обработчику: calls (всего), sampled (профилировалось), samples (стеков снято)
+        self.stats: Dict[str, Counter] = {}
+        self.stacks: Dict[str, Counter] = {}
+        # Активные профилируемые выполнения: задача asyncio -> (обработчик, код функции)
+        self._active: Dict[asyncio.Task, tuple] = {}
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._target_thread: Optional[int] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        if enabled:
+            self.enable()
+
+    def enable(self, sample_rate: float = None):
+        if sample_rate is not None:
+            self.sample_rate = min(max(sample_rate, 0.0), 1.0)
+        self.enabled = True
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="profiler-sampler", daemon=True)
+            self._thread.start()
+
+    def disable(self):
+        # Поток сэмплирования завершится на следующем шаге
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self.stats = {}
+            self.stacks = {}
+
+    def should_sample(self, label: str) -> bool:
+        """Учесть выполнение и решить, профилировать ли его"""
+        sampled = self.enabled and random.random() < self.sample_rate
+        with self._lock:
+            stats = self.stats.setdefault(label, Counter())
+            stats["calls"] += 1
+            stats["sampled"] += sampled
+        return sampled
+
+    @contextmanager
+    def profile(self, label: str, code):
+        """Профилировать выполнение в текущей задаче: стеки с кадром code засчитываются label"""
+        task = asyncio.current_task()
+        self._target_thread = threading.get_ident()
+        self._loop = task.get_loop()
+        with self._lock:
+            self._active[task] = (label, code)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._active.pop(task, None)
+
+    def _run(self):
+        while self.enabled:
+            time.sleep(self.interval)
+            if not self._active or self._target_thread is None or _current_tasks is None:
+                continue
+            # Задача читается до стека: сэмпл засчитывается, только если event loop
+            # сейчас выполняет выбранное выполнение
+            entry = self._active.get(_current_tasks.get(self._loop))
+            if entry is None:
+                continue
+            frame = sys._current_frames().get(self._target_thread)
+            if frame is not None:
+                self._sample(frame, *entry)
+
+    def _sample(self, frame, label: str, target):
+        names = []
+        depth = None
+        while frame is not None:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            if code is target:
+                # Самый внешний кадр обработчика - корень стека
+                depth = len(names)
+            frame = frame.f_back
+        if depth is None:
+            return
+        with self._lock:
+            self.stacks.setdefault(label, Counter())[";".join(reversed(names[:depth]))] += 1
+            self.stats.setdefault(label, Counter())["samples"] += 1
+
+    def collapsed(self, label: str = None) -> str:
+        """Стеки в свернутом формате (вход для flamegraph.pl / speedscope)"""
+        with self._lock:
+            lines = [
+                f"{name};{stack} {count}"
+                for name, stacks in sorted(self.stacks.items())
+                if label is None or name == label
+                for stack, count in stacks.most_common()
+            ]
+        return "\n".join(lines)
+
+    def summary(self) -> str:
+        """Краткая сводка по обработчикам: выполнения, профилировано, сэмплы, оценка CPU"""
+        state = f"включен, доля {self.sample_rate:g}" if self.enabled else "выключен"
+        lines = [f"Профилировщик {state}, интервал {self.interval * 1000:g} мс"]
+        ranked = sorted(self.stats.items(), key=lambda item: item[1]["samples"], reverse=True)
+        for label, stats in ranked:
+            cpu_ms = stats["samples"] * self.interval * 1000
+            lines.append(
+                f"{label}: вызовов {stats['calls']}, профилировано {stats['sampled']}, "
+                f"сэмплов {stats['samples']} (~{cpu_ms:.0f} мс CPU)"
+            )
+        return "\n".join(lines)
+
+
+class ProfilingMiddleware(BaseMiddleware):
+    """Middleware роутера: профилирует выбранные выполнения обработчиков"""
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get("handler")
+        if handler_object is None:
+            return await handler(event, data)
+        callback = handler_object.callback
+        if not profiler.should_sample(callback.__name__):
+            return await handler(event, data)
+        with profiler.profile(callback.__name__, callback.__code__):
+            return await handler(event, data)
+
+
+def profiled_job(job):
+    """Обертка задачи планировщика: выполнения учитываются как job:<имя>"""
+    label = f"job:{job.__name__}"
+
+    @functools.wraps(job)
+    async def wrapper(*args, **kwargs):
+        if not profiler.should_sample(label):
+            return await job(*args, **kwargs)
+        with profiler.profile(label, job.__code__):
+            return await job(*args, **kwargs)
+    return wrapper
+
+
+async def debug_profile_handler(request):
+    """
+    GET  /debug/profile[?label=...&format=summary] - свернутые стеки (или сводка)
+    POST /debug/profile?action=on|off|reset[&rate=0.1] - управление профилировщиком
+    Токен: заголовок X-Profile-Token или параметр token.
+    """
+    token = request.headers.get("X-Profile-Token") or request.query.get("token", "")
+    if not hmac.compare_digest(token, PROFILE_TOKEN):
+        return web.Response(status=403, text="Forbidden")
+
+    if request.method == "POST":
+        action = request.query.get("action")
+        if action == "on":
+            rate = request.query.get("rate")
+            try:
+                sample_rate = float(rate) if rate else None
+            except ValueError:
+                return web.Response(status=400, text="rate must be a number from 0 to 1")
+            if sample_rate is not None and not 0.0 <= sample_rate <= 1.0:
+                return web.Response(status=400, text="rate must be a number from 0 to 1")
+            profiler.enable(sample_rate)
+        elif action == "off":
+            profiler.disable()
+        elif action == "reset":
+            profiler.reset()
+        else:
+            return web.Response(status=400, text="action must be on, off or reset")
+        return web.Response(text=profiler.summary())
+
+    if request.query.get("format") == "summary":
+        return web.Response(text=profiler.summary())
+    return web.Response(text=profiler.collapsed(request.query.get("label")), content_type="text/plain")
+
+
+def setup_profile_routes(app: web.Application):
+    """Маршрут /debug/profile (только если задан PROFILE_TOKEN)"""
+    if not PROFILE_TOKEN:
+        return
+    app.router.add_get('/debug/profile', debug_profile_handler)
+    app.router.add_post('/debug/profile', debug_profile_handler)
+
+
+# Глобальный профилировщик
+profiler = SamplingProfiler(PROFILE_SAMPLE_RATE, PROFILE_INTERVAL_MS, enabled=PROFILE_ENABLED)
@@ -0,0 +1,172 @@
+import asyncio
+from clock import clock
+from aiogram import Bot
+from database import db
+from models import Subscription
+from throttling import telegram_limiter, call_with_retry
+from events import event_log, BANNED
+from config import RECONCILE_BATCH_SIZE, RECONCILE_CONCURRENCY
+from tenants import current_tenant
+from jobs import job_progress
+
+FULL_JOB = "reconcile_full"
+INCREMENTAL_JOB = "reconcile_incremental"
+
+# Статусы участника канала в Bot API
+MEMBER_STATUSES = ("member", "restricted")
+PRIVILEGED_STATUSES = ("creator", "administrator")
+
+# Сколько ID показывать в отчете
+MAX_REPORTED_USERS = 50
+
+
+def new_report(mode: str) -> dict:
+    return {
+        "mode": mode,
+        "checked": 0,
+        "banned": 0,
+        "renewed": 0,
+        "never_joined": 0,
+        "never_joined_ids": [],
+        "errors": 0,
+    }
+
+
+async def reconcile_subscription(bot: Bot, subscription: Subscription, report: dict, semaphore: asyncio.Semaphore):
+    """
+    Сверить одну подписку с реальным членством в канале
+
+    - Участник канала без активной подписки -> бан (если подписка не продлена,
+      пока ждали очереди к Bot API: перед баном она перечитывается с основного сервера)
+    - Оплаченная активная подписка, но пользователь не в канале -> в отчет
+    """
+    channel = current_tenant().channels.get(subscription.channel_name)
+    if channel is None:
+        return
+    channel_id = channel.channel_id
+    user_id = subscription.telegram_id
+    is_active = subscription.is_active and not subscription.is_expired(clock.now())
+
+    async with semaphore:
+        try:
+            member = await call_with_retry(
+                telegram_limiter, lambda: bot.get_chat_member(chat_id=channel_id, user_id=user_id)
+            )
+        except Exception as e:
+            print(f"[RECONCILE] Error checking user {user_id} in {subscription.channel_name}: {e}")
+            report["errors"] += 1
+            return
+        report["checked"] += 1
+
+        if member.status in PRIVILEGED_STATUSES:
+            return
+        is_member = member.status in MEMBER_STATUSES
+
+        if is_member and not is_active:
+            async def ban_unless_renewed() -> bool:
+                current = await db.get_active_subscription(user_id, subscription.channel_name, primary=True)
+                if current is not None and not current.is_expired(clock.now()):
+                    return False
+                await bot.ban_chat_member(chat_id=channel_id, user_id=user_id)
+                return True
+
+            try:
+                if not await call_with_retry(telegram_limiter, ban_unless_renewed):
+                    report["renewed"] += 1
+                    print(f"[RECONCILE] Skipped ban of user {user_id} in {subscription.channel_name}: subscription renewed")
+                    return
+                report["banned"] += 1
+                event_log.record(BANNED, user_id, subscription.channel_name, reason="reconciliation")
+                print(f"[RECONCILE] ✅ Banned user {user_id} from {subscription.channel_name} (no active subscription)")
+            except Exception as e:
+                report["errors"] += 1
+                print(f"[RECONCILE] ❌ Error banning user {user_id} from {subscription.channel_name}: {e}")
+        elif not is_member and is_active and subscription.payment_method == 'paid':
+            report["never_joined"] += 1
+            if len(report["never_joined_ids"]) < MAX_REPORTED_USERS:
+                report["never_joined_ids"].append(user_id)
+
+
+async def _reconcile_batch(bot: Bot, subscriptions: list, report: dict, semaphore: asyncio.Semaphore):
+    await asyncio.gather(*[
+        reconcile_subscription(bot, subscription, report, semaphore) for subscription in subscriptions
+    ])
+
+
+async def run_full_reconciliation(bot: Bot) -> dict:
+    """
+    Полная сверка: обход всех подписок страницами по id
+
+    Чекпоинт сохраняется после каждой страницы - прерванный проход
+    продолжается с последней обработанной подписки.
+    """
+    report = new_report("full")
+    semaphore = asyncio.Semaphore(RECONCILE_CONCURRENCY)
+    checkpoint = await db.get_checkpoint(FULL_JOB)
+    after_id = checkpoint['cursor_id'] if checkpoint else 0
+    # Начало прохода - граница для следующих инкрементальных сверок
+    pass_started = (checkpoint['cursor_ts'] if checkpoint and after_id else None) or clock.now()
+
+    print(f"[RECONCILE] Full reconciliation started (from id {after_id})")
+    while True:
+        page = await db.get_subscriptions_page(after_id, RECONCILE_BATCH_SIZE)
+        if not page:
+            break
+        await _reconcile_batch(bot, page, report, semaphore)
+        job_progress(report["checked"])
+        after_id = page[-1].id
+        await db.save_checkpoint(FULL_JOB, after_id, pass_started, None)
+
+    # Проход завершен: сбрасываем курсор, инкрементальная сверка начнется с начала прохода
+    await db.save_checkpoint(FULL_JOB, 0, None, None)
+    await db.save_checkpoint(INCREMENTAL_JOB, 0, None, pass_started)
+    print(f"[RECONCILE] Full reconciliation finished: {report}")
+    return report
+
+
+async def run_incremental_reconciliation(bot: Bot) -> dict:
+    """
+    Инкрементальная сверка: только подписки, измененные с прошлой сверки
+
+    Если полной сверки еще не было, выполняется полная.
+    """
+    checkpoint = await db.get_checkpoint(INCREMENTAL_JOB)
+    if not checkpoint or checkpoint['watermark'] is None:
+        return await run_full_reconciliation(bot)
+
+    report = new_report("incremental")
+    semaphore = asyncio.Semaphore(RECONCILE_CONCURRENCY)
+    since = checkpoint['watermark']
+    after_ts = checkpoint['cursor_ts'] or since
+    after_id = checkpoint['cursor_id'] or 0
+    run_started = clock.now()
+
+    print(f"[RECONCILE] Incremental reconciliation started (changes since {since})")
+    while True:
+        page = await db.get_changed_subscriptions_page(since, after_ts, after_id, RECONCILE_BATCH_SIZE)
+        if not page:
+            break
+        await _reconcile_batch(bot, page, report, semaphore)
+        job_progress(report["checked"])
+        after_ts, after_id = page[-1].updated_at, page[-1].id
+        await db.save_checkpoint(INCREMENTAL_JOB, after_id, after_ts, since)
+
+    await db.save_checkpoint(INCREMENTAL_JOB, 0, None, run_started)
+    print(f"[RECONCILE] Incremental reconciliation finished: {report}")
+    return report
+
+
+def format_report(report: dict) -> str:
+    """Текст отчета сверки для администратора"""
+    mode = "Полная" if report["mode"] == "full" else "Инкрементальная"
+    text = (
+        f"{mode} сверка завершена.\n"
+        f"Проверено: {report['checked']}\n"
+        f"Забанено (в канале без подписки): {report['banned']}\n"
+        f"Не забанено (подписка продлена во время сверки): {report['renewed']}\n"
+        f"Оплатили, но не вступили в канал: {report['never_joined']}\n"
+        f"Ошибок: {report['errors']}"
+    )
+    if report["never_joined_ids"]:
+        text += "\n\nНе вступили: " + ", ".join(str(user_id) for user_id in report["never_joined_ids"])
+    return text
@@ -0,0 +1,90 @@
+"""
+КЭШ ОТРИСОВАННЫХ СООБЩЕНИЙ
+
+Кнопки меню редактируют сообщение, на котором нажаты (edit_text). Повторное
+нажатие той же кнопки отправляет тот же текст, и Telegram отвечает ошибкой
+"message is not modified" - лишнее обращение к API и исключение в обработчике.
+
+RenderCache помнит хэш текста и клавиатуры последних RENDER_CACHE_SIZE
+сообщений (LRU по (арендатор, chat_id, message_id)). edit_if_changed()
+пропускает редактирование, если сообщение уже показывает то же самое;
+обработчику остается только callback.answer().
+
+Все редактирования сообщений с меню идут через edit_if_changed(), иначе кэш
+не узнает о новом содержимом и пропустит нужное редактирование.
+"""
+import hashlib
+from collections import OrderedDict
+from typing import Hashable, Optional
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import InlineKeyboardMarkup, Message
+from config import RENDER_CACHE_SIZE
+from tenants import current_tenant
+
+
+def render_digest(text: str, reply_markup: Optional[InlineKeyboardMarkup]) -> bytes:
+    """Хэш текста и клавиатуры сообщения"""
+    markup = reply_markup.model_dump_json(exclude_none=True) if reply_markup else ""
+    return hashlib.blake2b(f"{text}\0{markup}".encode("utf-8"), digest_size=16).digest()
+
+
+class RenderCache:
+    """LRU: сообщение -> хэш последнего отрисованного содержимого"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._digests: "OrderedDict[Hashable, bytes]" = OrderedDict()
+        self.edits = 0
+        self.skipped = 0
+        self.not_modified = 0
+        self.evicted = 0
+
+    def is_current(self, key: Hashable, digest: bytes) -> bool:
+        if self._digests.get(key) != digest:
+            return False
+        self._digests.move_to_end(key)
+        return True
+
+    def remember(self, key: Hashable, digest: bytes):
+        self._digests[key] = digest
+        self._digests.move_to_end(key)
+        if len(self._digests) > self.max_size:
+            self._digests.popitem(last=False)
+            self.evicted += 1
+
+    def summary(self) -> str:
+        return (
+            f"Кэш сообщений: {len(self._digests)} из {self.max_size}, редактирований {self.edits}, "
+            f"пропущено без изменений {self.skipped}, отклонено Telegram как неизмененные {self.not_modified}, "
+            f"вытеснено {self.evicted}"
+        )
+
+
+async def edit_if_changed(message: Message, text: str,
+                          reply_markup: Optional[InlineKeyboardMarkup] = None) -> bool:
+    """
+    Отредактировать сообщение, если его содержимое отличается от text/reply_markup
+
+    Возвращает True, если запрос editMessageText был отправлен.
+    """
+    key = (current_tenant().name, message.chat.id, message.message_id)
+    digest = render_digest(text, reply_markup)
+    if render_cache.is_current(key, digest):
+        render_cache.skipped += 1
+        return False
+
+    try:
+        await message.edit_text(text, reply_markup=reply_markup)
+    except TelegramBadRequest as e:
+        # Сообщение уже такое (отрисовано до запуска бота или вытеснено из кэша)
+        if "message is not modified" not in str(e):
+            raise
+        render_cache.not_modified += 1
+    else:
+        render_cache.edits += 1
+    render_cache.remember(key, digest)
+    return True
+
+
+# Глобальный кэш сообщений всех ботов процесса
+render_cache = RenderCache(RENDER_CACHE_SIZE)
@@ -2,16 +2,12 @@ import hashlib
 import time
 import random
 from urllib.parse import urlencode
+import xml.etree.ElementTree as ET
 from config import (
-    ROBOKASSA_CHANNEL_1_MERCHANT_LOGIN,
-    ROBOKASSA_CHANNEL_1_PASSWORD_1,
-    ROBOKASSA_CHANNEL_1_PASSWORD_2,
-    ROBOKASSA_CHANNEL_2_MERCHANT_LOGIN,
-    ROBOKASSA_CHANNEL_2_PASSWORD_1,
-    ROBOKASSA_CHANNEL_2_PASSWORD_2,
     ROBOKASSA_BASE_URL,
     ROBOKASSA_TEST_MODE
 )
+from tenants import current_tenant
 
 def generate_payment_url(amount: float, description: str, invoice_id: str = None, user_id: int = None, channel_name: str = None) -> tuple:
     """
@@ -27,15 +23,8 @@ def generate_payment_url(amount: float, description: str, invoice_id: str = None
     Returns:
         Payment URL and invoice_id
     """
-    # Select credentials based on channel
-    if channel_name == "channel_1":
-        merchant_login = ROBOKASSA_CHANNEL_1_MERCHANT_LOGIN
-        password_1 = ROBOKASSA_CHANNEL_1_PASSWORD_1
-    elif channel_name == "channel_2":
-        merchant_login = ROBOKASSA_CHANNEL_2_MERCHANT_LOGIN
-        password_1 = ROBOKASSA_CHANNEL_2_PASSWORD_1
-    else:
-        raise ValueError(f"Unknown channel_name: {channel_name}. Must be 'channel_1' or 'channel_2'")
+    # Select credentials based on channel (of the current tenant)
+    merchant_login, password_1, _ = get_channel_credentials(channel_name)
     
     if invoice_id is None:
         # Generate unique integer ID (Robokassa requires integer from 1 to 9223372036854775807)
@@ -122,3 +111,60 @@ def get_result_url_signature(amount: str, invoice_id: str, password: str) -> str
     signature_string = f"{amount}:{invoice_id}:{password}"
     return hashlib.md5(signature_string.encode()).hexdigest()
 
+# OpState: коды результата запроса и состояния операции
+OPSTATE_RESULT_OK = 0
+OPSTATE_RESULT_NOT_FOUND = 3  # операция с таким InvoiceID не найдена (счет не оплачивался)
+OPSTATE_STATE_PAID = 100  # платеж проведен успешно
+OPSTATE_UNPAID_STATES = (5, 10)  # счет выставлен, но не оплачен / оплата отменена
+
+def get_channel_credentials(channel_name: str) -> tuple:
+    """
+    Get Robokassa credentials for channel of the current tenant
+    
+    Returns:
+        (merchant_login, password_1, password_2)
+    
+    Raises:
+        ValueError: unknown channel_name
+    """
+    channel = current_tenant().channel(channel_name)
+    return channel.merchant_login, channel.password_1, channel.password_2
+
+def get_opstate_signature(merchant_login: str, invoice_id: str, password: str) -> str:
+    """
+    Generate signature for OpState request
+    
+    Formula: MerchantLogin:InvoiceID:Password2
+    """
+    signature_string = f"{merchant_login}:{invoice_id}:{password}"
+    return hashlib.md5(signature_string.encode()).hexdigest()
+
+def build_opstate_params(invoice_id: str, channel_name: str) -> dict:
+    """Query parameters for OpState request with channel-specific credentials"""
+    merchant_login, _, password_2 = get_channel_credentials(channel_name)
+    return {
+        'MerchantLogin': merchant_login,
+        'InvoiceID': invoice_id,
+        'Signature': get_opstate_signature(merchant_login, invoice_id, password_2),
+    }
+
+def parse_opstate_response(xml_text: str) -> dict:
+    """
+    Parse OpState XML response
+    
+    Returns:
+        {'result_code': int, 'state_code': int or None, 'out_sum': str or None}
+    """
+    root = ET.fromstring(xml_text)
+    # Теги ответа в пространстве имен Robokassa - сравниваем без него
+    elements = {}
+    for parent in root.iter():
+        for child in parent:
+            path = f"{parent.tag.rsplit('}', 1)[-1]}/{child.tag.rsplit('}', 1)[-1]}"
+            elements.setdefault(path, (child.text or '').strip())
+    state_code = elements.get('State/Code')
+    return {
+        'result_code': int(elements.get('Result/Code') or -1),
+        'state_code': int(state_code) if state_code else None,
+        'out_sum': elements.get('Info/OutSum') or None,
+    }
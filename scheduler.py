@@ -1,63 +1,65 @@
+import functools
+import time
+from collections import Counter
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.interval import IntervalTrigger
-from datetime import datetime, timedelta
+from clock import clock
 from database import db
-from keyboards import get_reminder_keyboard, get_expired_keyboard, get_payment_keyboard
+from keyboards import get_reminder_keyboard, get_expired_keyboard
 from messages import get_reminder_message, get_expired_message
-from config import CHANNEL_1_ID, CHANNEL_2_ID, FREE_TRIAL_DAYS
+from config import RECONCILE_INTERVAL_HOURS, PAYMENT_RECONCILE_INTERVAL_MINUTES
 from aiogram import Bot
+from profiler import profiled_job
+from jobs import job_runner, job_progress
+from events import event_log, REMINDED, EXPIRED, BANNED
+from tenants import TENANTS, current_tenant, tenant_context
 
 scheduler = AsyncIOScheduler()
 
+# Как часто (в подписках) печатать прогресс обработки истекших подписок
+EXPIRED_PROGRESS_EVERY = 100
+
 async def check_reminders(bot: Bot):
     """Check and send reminders"""
-    reminders = await db.get_pending_reminders()
-    
-    for reminder in reminders:
-        user_id = reminder['telegram_id']
-        channel_name = reminder['channel_name']
+    async for reminder in db.iter_pending_reminders():
+        user_id = reminder.telegram_id
+        channel_name = reminder.channel_name
         
         # Get subscription to get end date
         subscription = await db.get_active_subscription(user_id, channel_name)
         if subscription:
-            end_date = datetime.fromisoformat(subscription['end_date'])
-            
             # Send reminder
             try:
                 await bot.send_message(
                     user_id,
-                    get_reminder_message(end_date),
+                    get_reminder_message(subscription.end_date),
                     reply_markup=get_reminder_keyboard(channel_name)
                 )
                 await db.mark_reminder_sent(user_id, channel_name)
+                event_log.record(REMINDED, user_id, channel_name, end_date=subscription.end_date)
             except Exception as e:
                 print(f"Error sending reminder to {user_id}: {e}")
 
 async def check_expired_subscriptions(bot: Bot):
     """Check and deactivate expired subscriptions"""
-    print(f"[SCHEDULER] Checking expired subscriptions at {datetime.now()}")
-    expired = await db.get_expired_subscriptions()
-    
-    if not expired:
-        print("[SCHEDULER] No expired subscriptions found")
-        return  # Нет истекших подписок
-    
-    print(f"[SCHEDULER] Found {len(expired)} expired subscriptions")
+    print(f"[SCHEDULER] Checking expired subscriptions at {clock.now()}")
+    processed = 0
     
-    for subscription in expired:
-        user_id = subscription['telegram_id']
-        channel_name = subscription['channel_name']
-        end_date = subscription['end_date']
+    # Подписки читаются потоково: объем памяти не зависит от количества истекших
+    async for subscription in db.iter_expired_subscriptions():
+        processed += 1
+        job_progress(processed)
+        # Прогресс для больших объемов (например, догоняющая проверка при запуске)
+        if processed % EXPIRED_PROGRESS_EVERY == 0:
+            print(f"[SCHEDULER] Progress: {processed} expired subscriptions processed")
         
-        # Проверяем, что подписка действительно истекла
-        if isinstance(end_date, str):
-            end_date = datetime.fromisoformat(end_date.replace('Z', '+00:00'))
-        elif hasattr(end_date, 'replace'):
-            # Если это datetime с timezone, конвертируем в naive
-            end_date = end_date.replace(tzinfo=None)
+        user_id = subscription.telegram_id
+        channel_name = subscription.channel_name
+        end_date = subscription.end_date
         
-        now = datetime.now()
-        if end_date > now:
+        # Проверяем, что подписка действительно истекла
+        now = clock.now()
+        if not subscription.is_expired(now):
             print(f"[SCHEDULER] Skipping user {user_id}: end_date {end_date} > now {now}")
             continue  # Пропускаем, если еще не истекла
         
@@ -66,6 +68,7 @@ async def check_expired_subscriptions(bot: Bot):
         # Deactivate subscription
         try:
             await db.deactivate_subscription(user_id, channel_name)
+            event_log.record(EXPIRED, user_id, channel_name, end_date=end_date)
             print(f"[SCHEDULER] Deactivated subscription for user {user_id}")
         except Exception as e:
             print(f"[SCHEDULER] Error deactivating subscription for user {user_id}: {e}")
@@ -74,10 +77,12 @@ async def check_expired_subscriptions(bot: Bot):
         # Remove from channel (ban user)
         try:
             if channel_name == "channel_1":
-                await bot.ban_chat_member(chat_id=CHANNEL_1_ID, user_id=user_id)
+                await bot.ban_chat_member(chat_id=current_tenant().channel_id("channel_1"), user_id=user_id)
+                event_log.record(BANNED, user_id, channel_name, reason="expired")
                 print(f"[SCHEDULER] ✅ Banned user {user_id} from channel_1")
             elif channel_name == "channel_2":
-                await bot.ban_chat_member(chat_id=CHANNEL_2_ID, user_id=user_id)
+                await bot.ban_chat_member(chat_id=current_tenant().channel_id("channel_2"), user_id=user_id)
+                event_log.record(BANNED, user_id, channel_name, reason="expired")
                 print(f"[SCHEDULER] ✅ Banned user {user_id} from channel_2")
             else:
                 print(f"[SCHEDULER] Unknown channel_name: {channel_name}")
@@ -95,27 +100,98 @@ async def check_expired_subscriptions(bot: Bot):
             print(f"[SCHEDULER] Sent expiration message to user {user_id}")
         except Exception as e:
             print(f"[SCHEDULER] Error sending expiration message to {user_id}: {e}")
+    
+    if processed:
+        print(f"[SCHEDULER] Processed {processed} expired subscriptions")
+    else:
+        print("[SCHEDULER] No expired subscriptions found")
+
+async def reconcile_memberships(bot: Bot, full: bool = False) -> dict:
+    """
+    Reconciliation of channel membership with subscriptions (incremental by default)
+    
+    Одна задача job_runner и для планировщика, и для /reconcile [full]: обе
+    сверки работают с одними чекпоинтами и не должны идти одновременно.
+    Ошибка попадает в итог запуска (/jobs) и в метрики арендатора.
+    """
+    from reconciliation import run_full_reconciliation, run_incremental_reconciliation
+    if full:
+        return await run_full_reconciliation(bot)
+    return await run_incremental_reconciliation(bot)
+
+async def reconcile_payments(bot: Bot):
+    """Pending payments reconciliation with Robokassa OpState"""
+    from payment_reconciler import reconcile_pending_payments
+    try:
+        await reconcile_pending_payments(bot)
+    except Exception as e:
+        print(f"[SCHEDULER] Error in payments reconciliation: {e}")
 
-def setup_scheduler(bot: Bot):
-    """Setup scheduled tasks"""
+# Номер запуска каждой задачи: с него начинается обход арендаторов
+_job_runs = Counter()
+
+def for_each_tenant(job):
+    """
+    Задача планировщика для всех арендаторов (tenants.py)
+    
+    Арендаторы обходятся по очереди на общем пуле соединений; каждый запуск
+    начинается со следующего арендатора, чтобы медленный арендатор не задерживал
+    всегда одних и тех же. Ошибка одного арендатора не мешает остальным.
+    
+    Задача выполняется через job_runner (jobs.py): если она уже идет у
+    арендатора (запуск при старте или /check_expired), планировщик ждет
+    следующего запуска, а не начинает второй параллельно.
+    """
+    @functools.wraps(job)
+    async def run_for_tenants():
+        first = _job_runs[job.__name__] % len(TENANTS)
+        _job_runs[job.__name__] += 1
+        for tenant in TENANTS[first:] + TENANTS[:first]:
+            started = time.perf_counter()
+            with tenant_context(tenant):
+                try:
+                    await job_runner.run(job, tenant.bot, trigger="scheduler")
+                except Exception as e:
+                    tenant.metrics["job_errors"] += 1
+                    print(f"[SCHEDULER] Job {job.__name__} failed for tenant {tenant.name}: {e}")
+            tenant.metrics["jobs"] += 1
+            tenant.metrics["job_ms"] += (time.perf_counter() - started) * 1000
+    return run_for_tenants
+
+def setup_scheduler():
+    """Setup scheduled tasks (one set of jobs for all tenants, see for_each_tenant)"""
     # Check reminders every hour
     scheduler.add_job(
-        check_reminders,
+        for_each_tenant(profiled_job(check_reminders)),
         trigger=IntervalTrigger(hours=1),
-        args=[bot],
         id='check_reminders',
         replace_existing=True
     )
     
     # Check expired subscriptions every hour (для более точной проверки истечения)
     scheduler.add_job(
-        check_expired_subscriptions,
+        for_each_tenant(profiled_job(check_expired_subscriptions)),
         trigger=IntervalTrigger(hours=1),
-        args=[bot],
         id='check_expired',
         replace_existing=True
     )
     
+    # Incremental channel membership reconciliation
+    scheduler.add_job(
+        for_each_tenant(profiled_job(reconcile_memberships)),
+        trigger=IntervalTrigger(hours=RECONCILE_INTERVAL_HOURS),
+        id='reconcile_memberships',
+        replace_existing=True
+    )
+    
+    # Pending payments whose ResultURL notification was missed
+    scheduler.add_job(
+        for_each_tenant(profiled_job(reconcile_payments)),
+        trigger=IntervalTrigger(minutes=PAYMENT_RECONCILE_INTERVAL_MINUTES),
+        id='reconcile_payments',
+        replace_existing=True
+    )
+    
     scheduler.start()
     print("[SCHEDULER] Планировщик запущен. Проверка истекших подписок будет выполняться каждый час.")
 
@@ -0,0 +1,553 @@
+"""
+РЕЕСТР ЗАПРОСОВ БАЗЫ ДАННЫХ
+
+Каждый постоянный SQL-запрос Database объявляется здесь один раз под именем:
+    GET_USER = statement("get_user", "SELECT * FROM users WHERE telegram_id = $1")
+statement() возвращает сам текст запроса, поэтому он выполняется как обычно:
+    await conn.fetchrow(GET_USER, telegram_id)
+
+PreparedConnection (connection_class пула) подготавливает весь реестр при
+открытии соединения (хук init пула) через conn.prepare() и хранит
+подготовленные операторы на соединении. fetch/fetchrow/fetchval/execute/
+executemany выполняют запрос реестра его оператором, поэтому первый запрос
+пользователя на новом соединении не тратит лишнее обращение к серверу на
+разбор. Остальные запросы (и запросы реестра, не подготовленные при открытии
+соединения) asyncpg подготавливает при первом выполнении и хранит в своем
+кэше соединения (DB_STATEMENT_CACHE_SIZE).
+
+В режиме PgBouncer (DB_PGBOUNCER) кэш выключен и реестр не подготавливается:
+в режиме транзакций подготовленный запрос остается на серверном соединении,
+которое при следующей транзакции может достаться другому клиенту.
+
+Динамические запросы (выгрузка CSV, миграции, SET search_path) в реестр
+не входят.
+"""
+import weakref
+from collections import Counter
+from textwrap import dedent
+from typing import Dict
+import asyncpg
+from asyncpg.prepared_stmt import PreparedStatement
+
+
+# Имя -> текст запроса, в порядке объявления
+STATEMENTS: Dict[str, str] = {}
+
+
+def statement(name: str, sql: str) -> str:
+    """Объявить запрос в реестре (имя уникально) и вернуть его текст"""
+    if name in STATEMENTS:
+        raise ValueError(f"Statement {name} is already declared")
+    STATEMENTS[name] = dedent(sql).strip()
+    return STATEMENTS[name]
+
+
+# Счетчики: connections (соединений с реестром), prepared (запросов подготовлено), prepare_errors
+stats = Counter()
+# Открытые соединения пулов - для числа подготовленных запросов в /dbstats
+_connections = weakref.WeakSet()
+
+
+class PreparedConnection(asyncpg.Connection):
+    """
+    Соединение пула с подготовленными запросами реестра
+
+    Запрос реестра выполняется подготовленным оператором соединения, если он
+    есть. Оператор, устаревший после изменения схемы (миграция), забывается,
+    и запрос выполняется как обычно - asyncpg подготовит его заново.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Текст запроса -> подготовленный оператор
+        self._prepared: Dict[str, PreparedStatement] = {}
+
+    async def prepare_registry(self) -> int:
+        """
+        Подготовить запросы реестра, которых еще нет на соединении; вернуть их число
+
+        Если таблиц еще нет (пул открывается до миграций), подготовка
+        прекращается - запросы подготовятся при первом выполнении.
+        """
+        if self not in _connections:
+            _connections.add(self)
+            stats["connections"] += 1
+        prepared = 0
+        for name, query in STATEMENTS.items():
+            if query in self._prepared:
+                continue
+            try:
+                self._prepared[query] = await self.prepare(query)
+                prepared += 1
+            except asyncpg.UndefinedTableError:
+                stats["prepare_errors"] += 1
+                break
+            except asyncpg.PostgresError as e:
+                stats["prepare_errors"] += 1
+                print(f"[DB] Could not prepare statement {name}: {e}")
+        stats["prepared"] += prepared
+        return prepared
+
+    def prepared_statements(self) -> int:
+        """Число подготовленных запросов реестра на соединении"""
+        return len(self._prepared)
+
+    def _outdated(self, query: str, error: Exception):
+        """Забыть устаревший оператор (в транзакции повтор невозможен - ошибка пробрасывается)"""
+        del self._prepared[query]
+        if self.is_in_transaction():
+            raise error
+
+    async def fetch(self, query, *args, timeout=None, record_class=None):
+        stmt = self._prepared.get(query)
+        if stmt is not None and record_class is None:
+            try:
+                return await stmt.fetch(*args, timeout=timeout)
+            except asyncpg.InvalidCachedStatementError as e:
+                self._outdated(query, e)
+        return await super().fetch(query, *args, timeout=timeout, record_class=record_class)
+
+    async def fetchrow(self, query, *args, timeout=None, record_class=None):
+        stmt = self._prepared.get(query)
+        if stmt is not None and record_class is None:
+            try:
+                return await stmt.fetchrow(*args, timeout=timeout)
+            except asyncpg.InvalidCachedStatementError as e:
+                self._outdated(query, e)
+        return await super().fetchrow(query, *args, timeout=timeout, record_class=record_class)
+
+    async def fetchval(self, query, *args, column=0, timeout=None):
+        stmt = self._prepared.get(query)
+        if stmt is not None:
+            try:
+                return await stmt.fetchval(*args, column=column, timeout=timeout)
+            except asyncpg.InvalidCachedStatementError as e:
+                self._outdated(query, e)
+        return await super().fetchval(query, *args, column=column, timeout=timeout)
+
+    async def execute(self, query: str, *args, timeout: float = None) -> str:
+        stmt = self._prepared.get(query)
+        if stmt is not None:
+            try:
+                await stmt.fetch(*args, timeout=timeout)
+                return stmt.get_statusmsg()
+            except asyncpg.InvalidCachedStatementError as e:
+                self._outdated(query, e)
+        return await super().execute(query, *args, timeout=timeout)
+
+    async def executemany(self, command: str, args, *, timeout: float = None):
+        stmt = self._prepared.get(command)
+        if stmt is not None:
+            try:
+                return await stmt.executemany(args, timeout=timeout)
+            except asyncpg.InvalidCachedStatementError as e:
+                self._outdated(command, e)
+        return await super().executemany(command, args, timeout=timeout)
+
+
+def cache_usage() -> Dict[str, int]:
+    """Подготовленные запросы реестра на открытых соединениях: connections, min, max"""
+    sizes = [conn.prepared_statements() for conn in list(_connections) if not conn.is_closed()]
+    return {
+        "connections": len(sizes),
+        "min": min(sizes, default=0),
+        "max": max(sizes, default=0),
+    }
+
+
+# ---- users ----
+
+UPSERT_USER = statement("upsert_user", """
+    INSERT INTO users (telegram_id, username, first_name, last_name)
+    VALUES ($1, $2, $3, $4)
+    ON CONFLICT (telegram_id)
+    DO UPDATE SET
+        username = EXCLUDED.username,
+        first_name = EXCLUDED.first_name,
+        last_name = EXCLUDED.last_name
+""")
+
+GET_USER = statement("get_user", "SELECT * FROM users WHERE telegram_id = $1")
+
+GET_USER_IDS_BY_USERNAMES = statement("get_user_ids_by_usernames", """
+    SELECT lower(username) AS username, telegram_id FROM users
+    WHERE lower(username) = ANY($1::text[])
+""")
+
+INSERT_MISSING_USERS = statement("insert_missing_users", """
+    INSERT INTO users (telegram_id)
+    SELECT DISTINCT unnest($1::bigint[])
+    ON CONFLICT (telegram_id) DO NOTHING
+""")
+
+GET_NOT_GIFTED_USERS = statement("get_not_gifted_users", """
+    SELECT telegram_id FROM users
+    WHERE telegram_id = ANY($1::bigint[]) AND gift_received = FALSE
+""")
+
+MARK_GIFT_RECEIVED = statement("mark_gift_received", """
+    UPDATE users SET gift_received = TRUE WHERE telegram_id = $1
+""")
+
+MARK_GIFTS_RECEIVED = statement("mark_gifts_received", """
+    UPDATE users SET gift_received = TRUE WHERE telegram_id = ANY($1::bigint[])
+""")
+
+# ---- import_jobs ----
+
+# Захват импорта файла: строка возвращается, только если импорт новый, прерван
+# ошибкой или завис без прогресса дольше $4 минут (иначе он выполняется сейчас или завершен)
+CLAIM_IMPORT_JOB = statement("claim_import_job", """
+    INSERT INTO import_jobs (file_unique_id, file_name, admin_id)
+    VALUES ($1, $2, $3)
+    ON CONFLICT (file_unique_id)
+    DO UPDATE SET status = 'running', updated_at = CURRENT_TIMESTAMP
+    WHERE import_jobs.status = 'failed'
+    OR (import_jobs.status = 'running'
+        AND import_jobs.updated_at < CURRENT_TIMESTAMP - make_interval(mins => $4))
+    RETURNING *
+""")
+
+GET_IMPORT_JOB = statement("get_import_job", "SELECT * FROM import_jobs WHERE file_unique_id = $1")
+
+UPDATE_IMPORT_JOB_PROGRESS = statement("update_import_job_progress", """
+    UPDATE import_jobs
+    SET processed_rows = $2, imported = imported + $3,
+        gifted = gifted + $4, unresolved = unresolved + $5,
+        updated_at = CURRENT_TIMESTAMP
+    WHERE id = $1
+""")
+
+FINISH_IMPORT_JOB = statement("finish_import_job", """
+    UPDATE import_jobs SET status = $2, updated_at = CURRENT_TIMESTAMP WHERE id = $1
+""")
+
+# ---- subscriptions ----
+
+LOCK_SUBSCRIPTION = statement("lock_subscription", """
+    SELECT id, is_active, payment_method FROM subscriptions
+    WHERE telegram_id = $1 AND channel_name = $2
+    FOR UPDATE
+""")
+
+LOCK_SUBSCRIPTIONS = statement("lock_subscriptions", """
+    SELECT is_active, payment_method FROM subscriptions
+    WHERE telegram_id = ANY($1::bigint[]) AND channel_name = $2
+    FOR UPDATE
+""")
+
+UPDATE_SUBSCRIPTION = statement("update_subscription", """
+    UPDATE subscriptions
+    SET is_active = $1, payment_method = $2, start_date = $3, end_date = $4,
+        updated_at = $7
+    WHERE telegram_id = $5 AND channel_name = $6
+""")
+
+INSERT_SUBSCRIPTION = statement("insert_subscription", """
+    INSERT INTO subscriptions (telegram_id, channel_name, is_active, payment_method,
+                               start_date, end_date, created_at, updated_at)
+    VALUES ($1, $2, $3, $4, $5, $6, $7, $7)
+""")
+
+UPSERT_GIFT_SUBSCRIPTIONS = statement("upsert_gift_subscriptions", """
+    INSERT INTO subscriptions (telegram_id, channel_name, is_active, payment_method,
+                               start_date, end_date, created_at, updated_at)
+    SELECT unnest($1::bigint[]), $2, TRUE, 'gift', $3, $4, $5, $5
+    ON CONFLICT (telegram_id, channel_name)
+    DO UPDATE SET
+        is_active = EXCLUDED.is_active,
+        payment_method = EXCLUDED.payment_method,
+        start_date = EXCLUDED.start_date,
+        end_date = EXCLUDED.end_date,
+        updated_at = EXCLUDED.updated_at
+""")
+
+GET_ACTIVE_SUBSCRIPTION = statement("get_active_subscription", """
+    SELECT * FROM subscriptions
+    WHERE telegram_id = $1 AND channel_name = $2 AND is_active = TRUE
+    ORDER BY end_date DESC LIMIT 1
+""")
+
+GET_USER_SUBSCRIPTIONS = statement("get_user_subscriptions", """
+    SELECT * FROM subscriptions
+    WHERE telegram_id = $1
+    ORDER BY end_date DESC
+""")
+
+GET_ACTIVE_SUBSCRIBERS = statement("get_active_subscribers", """
+    SELECT telegram_id, channel_name, end_date FROM subscriptions
+    WHERE is_active = TRUE
+""")
+
+DEACTIVATE_SUBSCRIPTION = statement("deactivate_subscription", """
+    WITH old AS (
+        SELECT id, is_active, payment_method FROM subscriptions
+        WHERE telegram_id = $1 AND channel_name = $2
+        FOR UPDATE
+    )
+    UPDATE subscriptions
+    SET is_active = FALSE, updated_at = $3
+    FROM old
+    WHERE subscriptions.id = old.id
+    RETURNING old.is_active, old.payment_method
+""")
+
+COUNT_USER_SUBSCRIPTIONS = statement("count_user_subscriptions", """
+    SELECT COUNT(*) FROM subscriptions
+    WHERE telegram_id = $1 AND channel_name = $2
+""")
+
+GET_EXPIRING_GIFT_SUBSCRIPTIONS = statement("get_expiring_gift_subscriptions", """
+    SELECT * FROM subscriptions
+    WHERE is_active = TRUE
+    AND end_date BETWEEN $1 AND $2
+    AND payment_method = 'gift'
+""")
+
+# Страница истекших подписок по id (iter_expired_subscriptions): $1 - текущее время
+GET_EXPIRED_SUBSCRIPTIONS_PAGE = statement("get_expired_subscriptions_page", """
+    SELECT * FROM subscriptions
+    WHERE is_active = TRUE
+    AND end_date < $1
+    AND id > $2
+    ORDER BY id
+    LIMIT $3
+""")
+
+GET_SUBSCRIPTIONS_PAGE = statement("get_subscriptions_page", """
+    SELECT * FROM subscriptions
+    WHERE id > $1
+    ORDER BY id
+    LIMIT $2
+""")
+
+GET_CHANGED_SUBSCRIPTIONS_PAGE = statement("get_changed_subscriptions_page", """
+    SELECT * FROM subscriptions
+    WHERE updated_at >= $1 AND (updated_at, id) > ($2, $3)
+    ORDER BY updated_at, id
+    LIMIT $4
+""")
+
+# ---- payments ----
+
+INSERT_PAYMENT = statement("insert_payment", """
+    INSERT INTO payments (telegram_id, channel_name, amount, payment_id, status, created_at)
+    VALUES ($1, $2, $3, $4, $5, $6)
+""")
+
+UPDATE_PAYMENT_STATUS = statement("update_payment_status", """
+    WITH old AS (
+        SELECT id, status FROM payments WHERE payment_id = $2 FOR UPDATE
+    )
+    UPDATE payments SET status = $1
+    FROM old
+    WHERE payments.id = old.id
+    RETURNING old.status AS old_status, payments.channel_name, payments.amount
+""")
+
+CONFIRM_PAYMENT = statement("confirm_payment", """
+    UPDATE payments SET status = 'success'
+    WHERE payment_id = $1 AND status <> 'success'
+    RETURNING *
+""")
+
+EXPIRE_PAYMENT = statement("expire_payment", """
+    UPDATE payments SET status = 'expired'
+    WHERE payment_id = $1 AND status = 'pending'
+""")
+
+GET_STALE_PENDING_PAYMENTS = statement("get_stale_pending_payments", """
+    SELECT * FROM payments
+    WHERE status = 'pending' AND created_at <= $1 AND id > $2
+    ORDER BY id
+    LIMIT $3
+""")
+
+GET_PAYMENT = statement("get_payment", "SELECT * FROM payments WHERE payment_id = $1")
+
+# ---- статистика (stats.py) ----
+
+ADD_DAILY_STATS = statement("add_daily_stats", """
+    INSERT INTO stats_daily (day, channel_name, new_subscriptions, new_trials, conversions,
+                             deactivations, payments, revenue)
+    VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
+    ON CONFLICT (day, channel_name)
+    DO UPDATE SET
+        new_subscriptions = stats_daily.new_subscriptions + EXCLUDED.new_subscriptions,
+        new_trials = stats_daily.new_trials + EXCLUDED.new_trials,
+        conversions = stats_daily.conversions + EXCLUDED.conversions,
+        deactivations = stats_daily.deactivations + EXCLUDED.deactivations,
+        payments = stats_daily.payments + EXCLUDED.payments,
+        revenue = stats_daily.revenue + EXCLUDED.revenue
+""")
+
+ADD_CHANNEL_STATS = statement("add_channel_stats", """
+    INSERT INTO stats_channels (channel_name, active_subscriptions, active_trials, updated_at)
+    VALUES ($1, $2, $3, $4)
+    ON CONFLICT (channel_name)
+    DO UPDATE SET
+        active_subscriptions = stats_channels.active_subscriptions + EXCLUDED.active_subscriptions,
+        active_trials = stats_channels.active_trials + EXCLUDED.active_trials,
+        updated_at = EXCLUDED.updated_at
+""")
+
+GET_CHANNEL_STATS = statement("get_channel_stats", "SELECT * FROM stats_channels")
+
+GET_STATS_TOTALS = statement("get_stats_totals", """
+    SELECT channel_name,
+           SUM(new_subscriptions)::bigint AS new_subscriptions,
+           SUM(new_trials)::bigint AS new_trials,
+           SUM(conversions)::bigint AS conversions,
+           SUM(deactivations)::bigint AS deactivations,
+           SUM(payments)::bigint AS payments,
+           SUM(revenue)::bigint AS revenue
+    FROM stats_daily
+    GROUP BY channel_name
+""")
+
+GET_DAILY_STATS = statement("get_daily_stats", """
+    SELECT * FROM stats_daily
+    WHERE day >= $1
+    ORDER BY day DESC, channel_name
+""")
+
+# ---- subscription_events ----
+
+GET_USER_EVENTS = statement("get_user_events", """
+    SELECT occurred_at, channel_name, event, details FROM subscription_events
+    WHERE telegram_id = $1
+    ORDER BY occurred_at DESC
+    LIMIT $2
+""")
+
+# ---- reminders ----
+
+UPSERT_REMINDER = statement("upsert_reminder", """
+    INSERT INTO reminders (telegram_id, channel_name, reminder_date, reminder_sent)
+    VALUES ($1, $2, $3, FALSE)
+    ON CONFLICT (telegram_id, channel_name)
+    DO UPDATE SET reminder_date = EXCLUDED.reminder_date, reminder_sent = FALSE
+""")
+
+UPSERT_GIFT_REMINDERS = statement("upsert_gift_reminders", """
+    INSERT INTO reminders (telegram_id, channel_name, reminder_date, reminder_sent)
+    SELECT unnest($1::bigint[]), $2, $3, FALSE
+    ON CONFLICT (telegram_id, channel_name)
+    DO UPDATE SET reminder_date = EXCLUDED.reminder_date, reminder_sent = FALSE
+""")
+
+MARK_REMINDER_SENT = statement("mark_reminder_sent", """
+    UPDATE reminders SET reminder_sent = TRUE
+    WHERE telegram_id = $1 AND channel_name = $2
+""")
+
+GET_PENDING_REMINDERS = statement("get_pending_reminders", """
+    SELECT * FROM reminders
+    WHERE reminder_sent = FALSE AND reminder_date <= $1
+""")
+
+GET_PENDING_REMINDERS_PAGE = statement("get_pending_reminders_page", """
+    SELECT * FROM reminders
+    WHERE reminder_sent = FALSE AND reminder_date <= $1
+    AND id > $2
+    ORDER BY id
+    LIMIT $3
+""")
+
+# ---- job_checkpoints ----
+
+GET_CHECKPOINT = statement("get_checkpoint", "SELECT * FROM job_checkpoints WHERE job_name = $1")
+
+SAVE_CHECKPOINT = statement("save_checkpoint", """
+    INSERT INTO job_checkpoints (job_name, cursor_id, cursor_ts, watermark)
+    VALUES ($1, $2, $3, $4)
+    ON CONFLICT (job_name)
+    DO UPDATE SET
+        cursor_id = EXCLUDED.cursor_id,
+        cursor_ts = EXCLUDED.cursor_ts,
+        watermark = EXCLUDED.watermark,
+        updated_at = CURRENT_TIMESTAMP
+""")
+
+# ---- broadcasts ----
+
+CREATE_BROADCAST = statement("create_broadcast", """
+    INSERT INTO broadcasts (admin_id, channel_name, text, total)
+    SELECT $1, $2, $3, COUNT(*) FROM subscriptions
+    WHERE channel_name = $2 AND is_active = TRUE
+    RETURNING *
+""")
+
+SET_BROADCAST_PROGRESS_MESSAGE = statement("set_broadcast_progress_message", """
+    UPDATE broadcasts SET progress_chat_id = $2, progress_message_id = $3 WHERE id = $1
+""")
+
+GET_RUNNING_BROADCASTS = statement("get_running_broadcasts", """
+    SELECT * FROM broadcasts WHERE status = 'running' ORDER BY id
+""")
+
+# Страница получателей по telegram_id: $3 - последний получатель предыдущей страницы.
+# Доставки со статусом 'retry' (временная ошибка) не исключают получателя - отправка повторяется
+GET_BROADCAST_RECIPIENTS = statement("get_broadcast_recipients", """
+    SELECT s.telegram_id FROM subscriptions s
+    WHERE s.channel_name = $1 AND s.is_active = TRUE
+    AND s.telegram_id > $3
+    AND NOT EXISTS (
+        SELECT 1 FROM broadcast_deliveries d
+        WHERE d.broadcast_id = $2 AND d.telegram_id = s.telegram_id AND d.status <> 'retry'
+    )
+    ORDER BY s.telegram_id
+    LIMIT $4
+""")
+
+INSERT_BROADCAST_DELIVERY = statement("insert_broadcast_delivery", """
+    INSERT INTO broadcast_deliveries (broadcast_id, telegram_id, status, error)
+    VALUES ($1, $2, $3, $4)
+    ON CONFLICT (broadcast_id, telegram_id) DO UPDATE
+    SET status = EXCLUDED.status, error = EXCLUDED.error, delivered_at = CURRENT_TIMESTAMP
+    WHERE broadcast_deliveries.status = 'retry'
+""")
+
+ADD_BROADCAST_COUNTERS = statement("add_broadcast_counters", """
+    UPDATE broadcasts SET sent = sent + $2, failed = failed + $3 WHERE id = $1
+""")
+
+FINISH_BROADCAST = statement("finish_broadcast", """
+    UPDATE broadcasts SET status = $2, finished_at = CURRENT_TIMESTAMP WHERE id = $1
+""")
+
+# ---- реплика ----
+
+REPLICA_LAG = statement("replica_lag", """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+""")
+
+
+def format_pool_stats(pool_stats: dict) -> str:
+    """Текст /dbstats: пулы соединений и кэш подготовленных запросов"""
+    if pool_stats.get("backend") == "memory":
+        return "Хранилище в памяти (DB_BACKEND=memory): пула соединений нет."
+    lines = [f"Режим: {'PgBouncer (без кэша запросов)' if pool_stats['pgbouncer'] else 'прямое подключение'}"]
+    for title, pool in (("Основной пул", pool_stats["pool"]), ("Пул реплики", pool_stats.get("replica_pool"))):
+        if pool is None:
+            continue
+        lines.append(
+            f"{title}: соединений {pool['size']} (свободно {pool['idle']}), "
+            f"границы {pool['min_size']}-{pool['max_size']}"
+        )
+    cache = pool_stats["statement_cache"]
+    lines += [
+        f"Тайм-аут запроса: {pool_stats['command_timeout']:.0f} с, "
+        f"закрытие простаивающих: {pool_stats['max_inactive_lifetime']:.0f} с",
+        "",
+        f"Запросов в реестре: {pool_stats['statements']}, размер кэша на соединение: {cache['size']}",
+        f"Подготовлено при открытии: {cache['prepared']} на {cache['prepared_connections']} соединениях, "
+        f"ошибок {cache['prepare_errors']}",
+        f"Подготовлено реестра на открытых соединениях: от {cache['min']} до {cache['max']} запросов "
+        f"({cache['connections']} соединений)",
+    ]
+    return "\n".join(lines)
@@ -0,0 +1,155 @@
+"""
+СТАТИСТИКА ДЛЯ АДМИНИСТРАТОРА (/stats, GET /admin/stats)
+
+Статистика не считается COUNT(*) по subscriptions и payments: методы записи
+Database в той же транзакции обновляют сводные таблицы (миграция 7):
+- stats_daily (день, канал) - новые подписки, пробные периоды, конверсии
+  из пробного периода в оплату, отключения, оплаты и выручка за день;
+- stats_channels (канал) - текущее число активных подписок и пробных.
+Поэтому запрос статистики читает O(дней) строк, а не O(подписок).
+
+Пробный период - подписка с payment_method='gift'. Конверсия - оплаченная
+подписка пользователя, у которого подписка на этот канал была пробной.
+"""
+import hmac
+from datetime import date, timedelta
+from typing import Dict, Optional
+from aiohttp import web
+from clock import clock
+from config import ADMIN_API_TOKEN
+
+TRIAL_METHOD = "gift"
+
+# Счетчики stats_daily (суммируются за день) и stats_channels (текущие значения)
+DAILY_FIELDS = ("new_subscriptions", "new_trials", "conversions", "deactivations", "payments", "revenue")
+GAUGE_FIELDS = ("active_subscriptions", "active_trials")
+
+# Глубина истории по умолчанию и максимальная для /stats и /admin/stats
+DEFAULT_DAYS = 7
+MAX_DAYS = 366
+# Ограничение длины сообщения Telegram (с запасом на строку "…")
+MESSAGE_LIMIT = 4000
+
+
+def empty_delta() -> Dict[str, int]:
+    return dict.fromkeys(DAILY_FIELDS + GAUGE_FIELDS, 0)
+
+
+def subscription_delta(old_active: bool, old_method: Optional[str],
+                       is_active: bool, payment_method: str) -> Dict[str, int]:
+    """
+    Изменение счетчиков при записи подписки
+
+    old_active/old_method - прежнее состояние строки (False/None, если ее не было).
+    Новой считается только подписка, которая стала активной (продление активной
+    подписки - не новая подписка, как и в начальном заполнении миграции 7).
+    """
+    delta = empty_delta()
+    if old_active:
+        delta["active_subscriptions"] -= 1
+        if old_method == TRIAL_METHOD:
+            delta["active_trials"] -= 1
+        if not is_active:
+            delta["deactivations"] += 1
+    if is_active:
+        delta["active_subscriptions"] += 1
+        if payment_method == TRIAL_METHOD:
+            delta["active_trials"] += 1
+            if not old_active:
+                delta["new_trials"] += 1
+        else:
+            if not old_active:
+                delta["new_subscriptions"] += 1
+            if old_method == TRIAL_METHOD:
+                delta["conversions"] += 1
+    return delta
+
+
+def payment_delta(old_status: Optional[str], status: str, amount: int) -> Dict[str, int]:
+    """Изменение счетчиков при смене статуса платежа (учитываются только 'success')"""
+    delta = empty_delta()
+    sign = (status == "success") - (old_status == "success")
+    delta["payments"] = sign
+    delta["revenue"] = sign * amount
+    return delta
+
+
+def merge_delta(total: Dict[str, int], delta: Dict[str, int]) -> Dict[str, int]:
+    for field, value in delta.items():
+        total[field] += value
+    return total
+
+
+def stats_since(days: int) -> date:
+    """Первый день истории за последние days дней (включая сегодня)"""
+    return clock.now().date() - timedelta(days=days - 1)
+
+
+def format_stats(stats: dict, days: int) -> str:
+    """Текст /stats для администратора"""
+    lines = ["📊 Статистика"]
+    for channel_name, channel in sorted(stats["channels"].items()):
+        trials = channel["new_trials"]
+        conversion = f" ({channel['conversions'] / trials:.0%})" if trials else ""
+        lines += [
+            "",
+            f"{channel_name}:",
+            f"Активных подписок: {channel['active_subscriptions']} (пробных: {channel['active_trials']})",
+            f"Пробных периодов выдано: {trials}",
+            f"Конверсий в оплату: {channel['conversions']}{conversion}",
+            f"Оплат: {channel['payments']}, выручка: {channel['revenue']} ₽",
+        ]
+
+    lines += ["", f"По дням (последние {days}):"]
+    if not stats["daily"]:
+        lines.append("нет данных")
+    length = sum(len(line) + 1 for line in lines)
+    for row in stats["daily"]:
+        line = (
+            f"{row['day']:%d.%m} {row['channel_name']}: +{row['new_trials']} пробных, "
+            f"+{row['new_subscriptions']} оплаченных, {row['conversions']} конв., "
+            f"-{row['deactivations']} откл., {row['revenue']} ₽"
+        )
+        length += len(line) + 1
+        if length > MESSAGE_LIMIT:
+            lines.append("… (полная история - GET /admin/stats)")
+            break
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def parse_days(value: Optional[str]) -> int:
+    """Глубина истории из аргумента: число от 1 до MAX_DAYS (ValueError иначе)"""
+    if not value:
+        return DEFAULT_DAYS
+    days = int(value)
+    if not 1 <= days <= MAX_DAYS:
+        raise ValueError(f"days must be between 1 and {MAX_DAYS}")
+    return days
+
+
+async def stats_json_handler(request):
+    """
+    GET /admin/stats[?days=7] - статистика в JSON
+    Токен: заголовок X-Admin-Token или параметр token.
+    """
+    token = request.headers.get("X-Admin-Token") or request.query.get("token", "")
+    if not hmac.compare_digest(token, ADMIN_API_TOKEN):
+        return web.Response(status=403, text="Forbidden")
+    try:
+        days = parse_days(request.query.get("days"))
+    except ValueError:
+        return web.Response(status=400, text=f"days must be a number between 1 and {MAX_DAYS}")
+
+    from database import db
+    stats = await db.get_stats(stats_since(days))
+    for row in stats["daily"]:
+        row["day"] = row["day"].isoformat()
+    return web.json_response(stats)
+
+
+def setup_stats_routes(app: web.Application):
+    """Маршрут /admin/stats (только если задан ADMIN_API_TOKEN)"""
+    if not ADMIN_API_TOKEN:
+        return
+    app.router.add_get('/admin/stats', stats_json_handler)
@@ -0,0 +1,90 @@
+"""
+ИНТЕРФЕЙС ХРАНИЛИЩА
+
+Storage описывает методы, которыми обработчики, планировщик и фоновые задачи
+пользуются через глобальный db. Реализации:
+- database.Database - PostgreSQL (asyncpg), используется в работе бота
+- memory_storage.MemoryDatabase - в памяти, для бенчмарков (DB_BACKEND=memory)
+
+Новый метод хранилища добавляется в обе реализации и сюда.
+"""
+from datetime import date, datetime
+from typing import Optional, List, Dict, AsyncIterator, AsyncContextManager, Protocol
+from models import User, Subscription, Payment, Reminder
+
+
+class Storage(Protocol):
+    transaction_stats: Dict[str, dict]
+
+    async def init_db(self): ...
+    async def close(self): ...
+    def pool_stats(self) -> dict: ...
+    def transaction(self, name: str = "transaction") -> AsyncContextManager: ...
+
+    # users / импорт
+    async def add_user(self, telegram_id: int, username: str = None, first_name: str = None,
+                       last_name: str = None): ...
+    async def get_user(self, telegram_id: int) -> Optional[User]: ...
+    async def get_user_ids_by_usernames(self, usernames: List[str]) -> Dict[str, int]: ...
+    async def import_users_from_masterclass(self, telegram_ids: List[int]) -> List[int]: ...
+    async def mark_gift_received(self, telegram_id: int): ...
+    async def prepare_gift_batch(self, telegram_ids: List[int], channel_name: str, start_date: datetime,
+                                 end_date: datetime, reminder_date: datetime) -> List[int]: ...
+    async def complete_gift_batch(self, job_id: int, gifted_ids: List[int], processed_rows: int,
+                                  imported: int, unresolved: int): ...
+    async def claim_import_job(self, file_unique_id: str, file_name: str, admin_id: int) -> dict: ...
+    async def finish_import_job(self, job_id: int, status: str = "done"): ...
+
+    # subscriptions
+    async def create_subscription(self, telegram_id: int, channel_name: str, payment_method: str,
+                                  start_date: datetime, end_date: datetime, is_active: bool = True) -> bool: ...
+    async def get_active_subscription(self, telegram_id: int, channel_name: str,
+                                      primary: bool = False) -> Optional[Subscription]: ...
+    async def get_user_subscriptions(self, telegram_id: int) -> List[Subscription]: ...
+    async def get_active_subscribers(self) -> List[Subscription]: ...
+    async def deactivate_subscription(self, telegram_id: int, channel_name: str): ...
+    async def has_ever_had_subscription(self, telegram_id: int, channel_name: str) -> bool: ...
+    async def get_expiring_subscriptions(self) -> List[Subscription]: ...
+    def iter_expired_subscriptions(self, batch_size: int = 500) -> AsyncIterator[Subscription]: ...
+    async def get_subscriptions_page(self, after_id: int, limit: int) -> List[Subscription]: ...
+    async def get_changed_subscriptions_page(self, since: datetime, after_ts: datetime,
+                                             after_id: int, limit: int) -> List[Subscription]: ...
+
+    # payments
+    async def create_payment(self, telegram_id: int, channel_name: str, amount: int, payment_id: str,
+                             status: str = "pending"): ...
+    async def update_payment_status(self, payment_id: str, status: str): ...
+    async def get_payment(self, payment_id: str) -> Optional[Payment]: ...
+    async def confirm_payment(self, payment_id: str) -> Optional[Payment]: ...
+    async def expire_payment(self, payment_id: str) -> bool: ...
+    async def get_stale_pending_payments(self, created_before: datetime, after_id: int,
+                                         limit: int) -> List[Payment]: ...
+
+    # статистика (сводные таблицы, stats.py) и выгрузки (export.py)
+    async def get_stats(self, since: date) -> dict: ...
+    async def export_csv(self, table: str, path: str, channel_name: str = None, status: str = None,
+                         since: datetime = None, until: datetime = None) -> int: ...
+
+    # журнал событий (events.py)
+    async def write_events(self, events: List[tuple]): ...
+    async def get_user_events(self, telegram_id: int, limit: int = 50) -> List[dict]: ...
+
+    # reminders
+    async def create_reminder(self, telegram_id: int, channel_name: str, reminder_date: datetime): ...
+    async def mark_reminder_sent(self, telegram_id: int, channel_name: str): ...
+    async def get_pending_reminders(self) -> List[Reminder]: ...
+    def iter_pending_reminders(self, batch_size: int = 500) -> AsyncIterator[Reminder]: ...
+
+    # job checkpoints
+    async def get_checkpoint(self, job_name: str) -> Optional[dict]: ...
+    async def save_checkpoint(self, job_name: str, cursor_id: int, cursor_ts: Optional[datetime],
+                              watermark: Optional[datetime]): ...
+
+    # broadcasts
+    async def create_broadcast(self, admin_id: int, channel_name: str, text: str) -> dict: ...
+    async def set_broadcast_progress_message(self, broadcast_id: int, chat_id: int, message_id: int): ...
+    async def get_running_broadcasts(self) -> List[dict]: ...
+    def iter_broadcast_recipients(self, broadcast_id: int, channel_name: str,
+                                  batch_size: int) -> AsyncIterator[List[int]]: ...
+    async def record_broadcast_deliveries(self, broadcast_id: int, deliveries: List[tuple]): ...
+    async def finish_broadcast(self, broadcast_id: int, status: str = "done"): ...
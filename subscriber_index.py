@@ -0,0 +1,69 @@
+from datetime import datetime
+from clock import clock
+from typing import Dict, Iterable, List, Optional, Tuple
+from models import Subscription
+from tenants import TenantLocal
+
+
+class ActiveSubscriberIndex:
+    """
+    Индекс активных подписчиков в памяти: channel_name -> {telegram_id: end_date}
+
+    Загружается из subscriptions при запуске бота и обновляется при каждом
+    создании/деактивации подписки в Database, поэтому решение по заявке
+    на вступление в канал принимается без запроса к БД.
+
+    Загрузка идет в фоне, пока бот уже принимает оплаты: изменения, сделанные
+    между begin_load() и load(), записываются и повторяются поверх снимка,
+    иначе снимок, прочитанный раньше, затер бы их.
+    """
+
+    def __init__(self):
+        self._channels: Dict[str, Dict[int, datetime]] = {}
+        self.loaded = False
+        # Изменения во время загрузки: (telegram_id, channel_name, end_date или None)
+        self._changes: Optional[List[Tuple[int, str, Optional[datetime]]]] = None
+
+    def begin_load(self):
+        """Начать загрузку: вызывается до чтения активных подписок из БД"""
+        self._changes = []
+
+    def cancel_load(self):
+        """Загрузка не удалась: перестать записывать изменения"""
+        self._changes = None
+
+    def load(self, subscriptions: Iterable[Subscription]):
+        """Заполнить индекс активными подписками и повторить изменения, сделанные во время загрузки"""
+        channels: Dict[str, Dict[int, datetime]] = {}
+        for sub in subscriptions:
+            channels.setdefault(sub.channel_name, {})[sub.telegram_id] = sub.end_date
+        self._channels = channels
+        changes, self._changes = self._changes or [], None
+        for telegram_id, channel_name, end_date in changes:
+            if end_date is None:
+                self.discard(telegram_id, channel_name)
+            else:
+                self.add(telegram_id, channel_name, end_date)
+        self.loaded = True
+
+    def add(self, telegram_id: int, channel_name: str, end_date: datetime):
+        self._channels.setdefault(channel_name, {})[telegram_id] = end_date
+        if self._changes is not None:
+            self._changes.append((telegram_id, channel_name, end_date))
+
+    def discard(self, telegram_id: int, channel_name: str):
+        self._channels.get(channel_name, {}).pop(telegram_id, None)
+        if self._changes is not None:
+            self._changes.append((telegram_id, channel_name, None))
+
+    def is_active(self, telegram_id: int, channel_name: str) -> bool:
+        """Есть ли у пользователя действующая подписка на канал"""
+        end_date = self._channels.get(channel_name, {}).get(telegram_id)
+        return end_date is not None and end_date > clock.now()
+
+    def count(self, channel_name: str) -> int:
+        return len(self._channels.get(channel_name, {}))
+
+
+# Глобальный индекс (свой у каждого арендатора), обновляется из database.py
+subscriber_index = TenantLocal(ActiveSubscriberIndex)
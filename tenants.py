@@ -0,0 +1,251 @@
+"""
+НЕСКОЛЬКО БОТОВ В ОДНОМ ПРОЦЕССЕ (АРЕНДАТОРЫ)
+
+Арендатор - бот сообщества со своим токеном, каналами, ценами, учетными
+данными Robokassa и администраторами. Все арендаторы работают в одном
+процессе: один Dispatcher опрашивает всех ботов, один пул соединений,
+один планировщик, один сервер webhook'ов.
+
+Данные арендатора хранятся в отдельной схеме PostgreSQL с теми же таблицами
+(миграции применяются в каждой схеме). Схема текущего арендатора ставится в
+search_path при выдаче соединения из пула (Database._setup_connection), поэтому
+SQL в database.py не меняется. Текущий арендатор - contextvar:
+- апдейты: TenantMiddleware по боту, получившему апдейт;
+- HTTP: tenant_http_middleware по /robokassa/{tenant}/result или ?tenant=;
+- задачи планировщика: for_each_tenant (scheduler.py).
+Задачи asyncio наследуют арендатора, в контексте которого созданы.
+
+Без TENANTS_FILE арендатор один - из переменных окружения (BOT_TOKEN,
+CHANNEL_1_ID, ...), схема public: однобот работает как раньше.
+
+Формат TENANTS_FILE (JSON, первый арендатор - по умолчанию):
+    [{"name": "demiurg", "bot_token": "...", "schema": "public", "admin_ids": [1],
+      "channels": {
+        "channel_1": {"id": "-100...", "price": 1990, "merchant_login": "...",
+                      "password_1": "...", "password_2": "...", "join_link": null},
+        "channel_2": {...}}}]
+"""
+import json
+import re
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+from aiogram import BaseMiddleware
+from aiohttp import web
+from config import (
+    BOT_TOKEN, ADMIN_IDS, CHANNEL_1_ID, CHANNEL_2_ID, CHANNEL_1_PRICE, CHANNEL_2_PRICE,
+    CHANNEL_1_JOIN_LINK, CHANNEL_2_JOIN_LINK,
+    ROBOKASSA_CHANNEL_1_MERCHANT_LOGIN, ROBOKASSA_CHANNEL_1_PASSWORD_1, ROBOKASSA_CHANNEL_1_PASSWORD_2,
+    ROBOKASSA_CHANNEL_2_MERCHANT_LOGIN, ROBOKASSA_CHANNEL_2_PASSWORD_1, ROBOKASSA_CHANNEL_2_PASSWORD_2,
+    TENANTS_FILE
+)
+
+DEFAULT_SCHEMA = "public"
+SCHEMA_PATTERN = re.compile(r"^[a-z_][a-z0-9_]{0,62}$")
+CHANNEL_NAMES = ("channel_1", "channel_2")
+
+
+@dataclass(frozen=True)
+class ChannelConfig:
+    """Канал арендатора и учетные данные Robokassa для его оплаты"""
+    channel_id: str
+    price: int
+    merchant_login: Optional[str]
+    password_1: Optional[str]
+    password_2: Optional[str]
+    join_link: Optional[str] = None
+
+
+@dataclass(eq=False)
+class Tenant:
+    """Бот сообщества: конфигурация, aiogram.Bot (создается в main.py) и метрики"""
+    name: str
+    bot_token: Optional[str]
+    schema: str
+    channels: Dict[str, ChannelConfig]
+    admin_ids: List[int]
+    bot: Any = None
+    # updates, update_errors, update_ms, webhooks, jobs, job_errors, job_ms, db_acquires
+    metrics: Counter = field(default_factory=Counter)
+
+    def channel(self, channel_name: str) -> ChannelConfig:
+        if channel_name not in self.channels:
+            raise ValueError(f"Unknown channel_name: {channel_name}. Must be 'channel_1' or 'channel_2'")
+        return self.channels[channel_name]
+
+    def channel_id(self, channel_name: str) -> str:
+        return self.channel(channel_name).channel_id
+
+    def price(self, channel_name: str) -> int:
+        return self.channel(channel_name).price
+
+    def channel_name_by_id(self, chat_id) -> Optional[str]:
+        """Имя канала арендатора по id чата (None - чужой чат)"""
+        return next((name for name, channel in self.channels.items()
+                     if str(channel.channel_id) == str(chat_id)), None)
+
+    def is_admin(self, telegram_id: int) -> bool:
+        return telegram_id in self.admin_ids
+
+
+def default_tenant_from_env() -> Tenant:
+    """Единственный арендатор из переменных окружения (без TENANTS_FILE)"""
+    return Tenant(
+        name="default",
+        bot_token=BOT_TOKEN,
+        schema=DEFAULT_SCHEMA,
+        admin_ids=ADMIN_IDS,
+        channels={
+            "channel_1": ChannelConfig(CHANNEL_1_ID, CHANNEL_1_PRICE, ROBOKASSA_CHANNEL_1_MERCHANT_LOGIN,
+                                       ROBOKASSA_CHANNEL_1_PASSWORD_1, ROBOKASSA_CHANNEL_1_PASSWORD_2,
+                                       CHANNEL_1_JOIN_LINK),
+            "channel_2": ChannelConfig(CHANNEL_2_ID, CHANNEL_2_PRICE, ROBOKASSA_CHANNEL_2_MERCHANT_LOGIN,
+                                       ROBOKASSA_CHANNEL_2_PASSWORD_1, ROBOKASSA_CHANNEL_2_PASSWORD_2,
+                                       CHANNEL_2_JOIN_LINK),
+        },
+    )
+
+
+def parse_tenants(entries: List[dict]) -> List[Tenant]:
+    """
+    Арендаторы из содержимого TENANTS_FILE
+
+    Raises:
+        ValueError: нет арендаторов, повтор имени или схемы, неверная схема или набор каналов
+    """
+    if not entries:
+        raise ValueError("TENANTS_FILE must list at least one tenant")
+    tenants = []
+    for entry in entries:
+        schema = entry.get("schema", entry["name"])
+        if not SCHEMA_PATTERN.match(schema):
+            raise ValueError(f"Tenant {entry['name']}: schema must match {SCHEMA_PATTERN.pattern}")
+        if set(entry["channels"]) != set(CHANNEL_NAMES):
+            raise ValueError(f"Tenant {entry['name']}: channels must be {', '.join(CHANNEL_NAMES)}")
+        tenants.append(Tenant(
+            name=entry["name"],
+            bot_token=entry["bot_token"],
+            schema=schema,
+            admin_ids=[int(admin_id) for admin_id in entry.get("admin_ids", [])],
+            channels={
+                name: ChannelConfig(str(channel["id"]), int(channel["price"]), channel.get("merchant_login"),
+                                    channel.get("password_1"), channel.get("password_2"), channel.get("join_link"))
+                for name, channel in entry["channels"].items()
+            },
+        ))
+    for attribute in ("name", "schema", "bot_token"):
+        values = [getattr(tenant, attribute) for tenant in tenants]
+        if len(set(values)) != len(values):
+            raise ValueError(f"Tenants must have distinct {attribute}")
+    return tenants
+
+
+def load_tenants() -> List[Tenant]:
+    if not TENANTS_FILE:
+        return [default_tenant_from_env()]
+    with open(TENANTS_FILE, encoding="utf-8") as tenants_file:
+        return parse_tenants(json.load(tenants_file))
+
+
+# Все арендаторы процесса; первый - арендатор по умолчанию
+TENANTS: List[Tenant] = load_tenants()
+_by_name = {tenant.name: tenant for tenant in TENANTS}
+_current_tenant: ContextVar[Optional[Tenant]] = ContextVar("current_tenant", default=None)
+
+
+def current_tenant() -> Tenant:
+    """Арендатор текущего апдейта, запроса или задачи (вне контекста - по умолчанию)"""
+    return _current_tenant.get() or TENANTS[0]
+
+
+def get_tenant(name: str) -> Optional[Tenant]:
+    return _by_name.get(name)
+
+
+@contextmanager
+def tenant_context(tenant: Tenant):
+    """Выполнить блок от имени арендатора"""
+    token = _current_tenant.set(tenant)
+    try:
+        yield tenant
+    finally:
+        _current_tenant.reset(token)
+
+
+class TenantLocal:
+    """
+    Отдельный экземпляр на каждого арендатора
+
+    Обращения к атрибутам передаются экземпляру текущего арендатора
+    (создается factory() при первом обращении):
+        subscriber_index = TenantLocal(ActiveSubscriberIndex)
+    """
+
+    def __init__(self, factory: Callable[[], Any]):
+        self._factory = factory
+        self._instances: Dict[str, Any] = {}
+
+    def get(self) -> Any:
+        tenant = current_tenant()
+        instance = self._instances.get(tenant.name)
+        if instance is None:
+            instance = self._instances[tenant.name] = self._factory()
+        return instance
+
+    def __getattr__(self, name: str):
+        return getattr(self.get(), name)
+
+
+class TenantMiddleware(BaseMiddleware):
+    """Outer middleware Dispatcher: арендатор по боту, получившему апдейт, и его метрики"""
+
+    def __init__(self, tenants: List[Tenant]):
+        self._by_bot_id = {tenant.bot.id: tenant for tenant in tenants}
+
+    async def __call__(self, handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]], event: Any,
+                       data: Dict[str, Any]) -> Any:
+        tenant = self._by_bot_id.get(data["bot"].id, TENANTS[0])
+        tenant.metrics["updates"] += 1
+        started = time.perf_counter()
+        try:
+            with tenant_context(tenant):
+                return await handler(event, data)
+        except Exception:
+            tenant.metrics["update_errors"] += 1
+            raise
+        finally:
+            tenant.metrics["update_ms"] += (time.perf_counter() - started) * 1000
+
+
+@web.middleware
+async def tenant_http_middleware(request, handler):
+    """Арендатор HTTP-запроса: /robokassa/{tenant}/result или параметр tenant (иначе - по умолчанию)"""
+    name = request.match_info.get("tenant") or request.query.get("tenant")
+    if not name:
+        return await handler(request)
+    tenant = get_tenant(name)
+    if tenant is None:
+        return web.Response(status=404, text=f"Unknown tenant: {name}")
+    with tenant_context(tenant):
+        return await handler(request)
+
+
+def format_tenant_metrics() -> str:
+    """Текст /tenants: нагрузка по арендаторам с запуска"""
+    lines = ["Арендаторы:"]
+    for tenant in TENANTS:
+        metrics = tenant.metrics
+        updates, jobs = metrics["updates"], metrics["jobs"]
+        update_avg = f"{metrics['update_ms'] / updates:.1f} мс" if updates else "-"
+        lines += [
+            "",
+            f"{tenant.name} (схема {tenant.schema}):",
+            f"Апдейтов: {updates}, ошибок: {metrics['update_errors']}, в среднем {update_avg}",
+            f"Webhook'ов Robokassa: {metrics['webhooks']}",
+            f"Запусков задач: {jobs}, ошибок: {metrics['job_errors']}, всего {metrics['job_ms'] / 1000:.1f} с",
+            f"Соединений из пула выдано: {metrics['db_acquires']}",
+        ]
+    return "\n".join(lines)
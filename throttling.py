@@ -0,0 +1,61 @@
+import asyncio
+import time
+from typing import Awaitable, Callable, TypeVar
+from aiogram.exceptions import TelegramRetryAfter
+from config import TELEGRAM_RATE_LIMIT
+from tenants import TenantLocal
+
+T = TypeVar("T")
+
+
+class RateLimiter:
+    """
+    Ограничитель частоты запросов (token bucket).
+
+    Разрешает не более `rate` вызовов в секунду с допустимым всплеском `burst`.
+    Один экземпляр разделяется всеми массовыми рассылками, чтобы они вместе
+    укладывались в лимит Telegram Bot API.
+    """
+
+    def __init__(self, rate: float, burst: int = None):
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Дождаться свободного слота"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+async def call_with_retry(limiter: RateLimiter, call: Callable[[], Awaitable[T]], attempts: int = 3) -> T:
+    """
+    Выполнить вызов Bot API через ограничитель с повтором при flood control.
+
+    `call` - фабрика корутины (например, lambda: bot.send_message(...)),
+    так как корутину нельзя await'ить повторно.
+    Остальные ошибки Telegram пробрасываются вызывающему коду.
+    """
+    for attempt in range(attempts):
+        await limiter.acquire()
+        try:
+            return await call()
+        except TelegramRetryAfter as e:
+            if attempt == attempts - 1:
+                raise
+            print(f"[THROTTLING] Flood control, повтор через {e.retry_after} сек.")
+            await asyncio.sleep(e.retry_after)
+
+
+# Общий ограничитель для всех массовых операций бота (лимит Telegram - на каждого бота,
+# поэтому у каждого арендатора свой)
+telegram_limiter = TenantLocal(lambda: RateLimiter(TELEGRAM_RATE_LIMIT))
@@ -0,0 +1 @@
+"""Утилиты разработки: бенчмарки и заглушки Telegram (не используются ботом)"""
@@ -0,0 +1,128 @@
+"""
+МИКРОБЕНЧМАРК ОБРАБОТЧИКОВ И ЗАДАЧ ПЛАНИРОВЩИКА
+
+Обработчики из handlers.py и задачи scheduler.py вызываются напрямую
+с in-memory хранилищем (DB_BACKEND=memory) и FakeBot - измеряются только
+накладные расходы Python на одно обновление / одну подписку, без PostgreSQL
+и Telegram.
+
+Запуск из корня проекта:
+    python -m tools.bench_handlers
+    python -m tools.bench_handlers --iterations 5000 --expired 20000
+"""
+from tools.fakes import configure_offline_environment
+
+# Хранилище выбирается при импорте database, поэтому окружение задается до импортов бота
+configure_offline_environment()
+
+import argparse
+import asyncio
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from asyncpg.exceptions import UniqueViolationError
+
+import handlers
+import scheduler
+from database import db
+from tools.fakes import FakeBot, FakeMessage, FakeCallbackQuery, silence_stdout
+
+# Первый telegram_id пользователей бенчмарка
+BASE_USER_ID = 10_000_000
+
+
+async def measure(name: str, iterations: int, make_call) -> dict:
+    """Выполнить make_call(i) iterations раз и вернуть время на операцию"""
+    errors = Counter()
+    with silence_stdout():
+        started = time.perf_counter()
+        for i in range(iterations):
+            try:
+                await make_call(i)
+            except UniqueViolationError:
+                errors["unique_violation"] += 1
+        elapsed = time.perf_counter() - started
+    return {"name": name, "ops": iterations, "us_per_op": elapsed / max(iterations, 1) * 1e6, "errors": dict(errors)}
+
+
+async def seed_expired(count: int) -> int:
+    """Создать count активных подписок с прошедшей end_date"""
+    start = datetime.now() - timedelta(days=40)
+    end = datetime.now() - timedelta(days=1)
+    for i in range(count):
+        user_id = BASE_USER_ID + 1_000_000 + i
+        await db.add_user(user_id)
+        await db.create_subscription(user_id, "channel_1", "paid", start, end, is_active=True)
+    return count
+
+
+async def seed_reminders(count: int) -> int:
+    """Создать count наступивших напоминаний с активной подпиской"""
+    start = datetime.now() - timedelta(days=1)
+    end = datetime.now() + timedelta(days=3)
+    for i in range(count):
+        user_id = BASE_USER_ID + 2_000_000 + i
+        await db.add_user(user_id)
+        await db.create_subscription(user_id, "channel_1", "gift", start, end, is_active=True)
+        await db.create_reminder(user_id, "channel_1", datetime.now() - timedelta(minutes=1))
+    return count
+
+
+async def run(iterations: int, expired: int) -> tuple:
+    bot = FakeBot()
+    results = []
+
+    async def start(i):
+        await handlers.cmd_start(FakeMessage(bot, BASE_USER_ID + i, "/start"), bot)
+    results.append(await measure("cmd_start", iterations, start))
+
+    for data, handler in (
+        ("main_menu", handlers.callback_main_menu),
+        ("channel_1_info", handlers.callback_channel_1_info),
+        ("my_subscriptions", handlers.callback_my_subscriptions),
+    ):
+        async def callback(i, data=data, handler=handler):
+            await handler(FakeCallbackQuery(bot, BASE_USER_ID + i, data))
+        results.append(await measure(f"callback {data}", iterations, callback))
+
+    async def payment(i):
+        await handlers.callback_payment(FakeCallbackQuery(bot, BASE_USER_ID + i, "pay_channel_2"), bot)
+    results.append(await measure("callback_payment", iterations, payment))
+
+    async def payment_success(i):
+        await handlers.process_payment_success(BASE_USER_ID + i, "channel_2", bot)
+    results.append(await measure("process_payment_success", iterations, payment_success))
+
+    # Задачи планировщика: время на одну обработанную запись
+    for name, seed, job in (
+        ("check_expired_subscriptions", seed_expired, scheduler.check_expired_subscriptions),
+        ("check_reminders", seed_reminders, scheduler.check_reminders),
+    ):
+        seeded = await seed(expired)
+        result = await measure(name, 1, lambda i, job=job: job(bot))
+        result["us_per_op"] /= max(seeded, 1)
+        result["ops"] = seeded
+        results.append(result)
+
+    return results, bot.calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Микробенчмарк обработчиков на in-memory хранилище")
+    parser.add_argument("--iterations", type=int, default=2000, help="вызовов каждого обработчика")
+    parser.add_argument("--expired", type=int, default=5000, help="записей для задач планировщика")
+    args = parser.parse_args()
+
+    results, calls = asyncio.run(run(args.iterations, args.expired))
+
+    print(f"{'benchmark':<36}{'ops':>8}{'µs/op':>12}")
+    for result in results:
+        line = f"{result['name']:<36}{result['ops']:>8}{result['us_per_op']:>12.1f}"
+        if result["errors"]:
+            line += f"   errors: {result['errors']}"
+        print(line)
+    print("Bot API calls:", dict(calls))
+
+
+if __name__ == "__main__":
+    main()
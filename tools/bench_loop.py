@@ -0,0 +1,148 @@
+"""
+СРАВНЕНИЕ РЕАЛИЗАЦИЙ EVENT LOOP НА СМЕСИ АПДЕЙТОВ БОТА
+
+Каждая реализация (asyncio, uvloop) запускается в отдельном процессе.
+Смесь нагрузки выполняется конкурентно (--concurrency задач одновременно):
+- апдейты: /start, callback'и меню, выбор оплаты, успешная оплата
+  (handlers.py, in-memory хранилище, FakeBot);
+- webhook'и: HTTP-запросы к серверу Robokassa (aiohttp, loopback).
+Выводятся пропускная способность и задержка event loop (LoopLagMonitor).
+
+Запуск из корня проекта:
+    python -m tools.bench_loop
+    python -m tools.bench_loop --updates 20000 --requests 5000 --concurrency 200
+"""
+from tools.fakes import configure_offline_environment
+
+# Хранилище выбирается при импорте database, поэтому окружение задается до импортов бота
+configure_offline_environment()
+
+import argparse
+import asyncio
+import json
+import subprocess
+import sys
+import time
+
+import aiohttp
+from aiohttp import web
+
+import handlers
+from event_loop import select_event_loop, LoopLagMonitor
+from payment_handler import setup_payment_routes
+from tools.fakes import FakeBot, FakeMessage, FakeCallbackQuery, silence_stdout
+
+LOOPS = ("asyncio", "uvloop")
+BASE_USER_ID = 30_000_000
+BENCH_PORT = 18080
+
+
+def update_for(i: int, bot: FakeBot):
+    """i-й апдейт смеси: пользователь проходит меню, выбирает оплату и платит"""
+    user_id = BASE_USER_ID + i // 5
+    step = i % 5
+    if step == 0:
+        return handlers.cmd_start(FakeMessage(bot, user_id, "/start"), bot)
+    if step == 1:
+        return handlers.callback_channel_2_info(FakeCallbackQuery(bot, user_id, "channel_2_info"))
+    if step == 2:
+        return handlers.callback_payment(FakeCallbackQuery(bot, user_id, "pay_channel_2"), bot)
+    if step == 3:
+        return handlers.process_payment_success(user_id, "channel_2", bot)
+    return handlers.callback_my_subscriptions(FakeCallbackQuery(bot, user_id, "my_subscriptions"))
+
+
+async def run_limited(count: int, concurrency: int, make_call) -> int:
+    """Выполнить count вызовов, не более concurrency одновременно; вернуть число ошибок"""
+    semaphore = asyncio.Semaphore(concurrency)
+    errors = 0
+
+    async def one(i):
+        nonlocal errors
+        async with semaphore:
+            try:
+                await make_call(i)
+            except Exception:
+                errors += 1
+
+    await asyncio.gather(*(one(i) for i in range(count)))
+    return errors
+
+
+async def run_mix(args) -> dict:
+    bot = FakeBot()
+    monitor = LoopLagMonitor(interval_ms=10, threshold_ms=10_000)
+    monitor.start()
+
+    app = web.Application()
+    setup_payment_routes(app, bot)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", BENCH_PORT).start()
+    url = f"http://127.0.0.1:{BENCH_PORT}/robokassa/health"
+
+    try:
+        async with aiohttp.ClientSession() as session:
+            async def request(i):
+                async with session.get(url) as response:
+                    await response.read()
+
+            with silence_stdout():
+                started = time.perf_counter()
+                errors = await run_limited(args.updates, args.concurrency, lambda i: update_for(i, bot))
+                updates_s = time.perf_counter() - started
+
+                started = time.perf_counter()
+                errors += await run_limited(args.requests, args.concurrency, request)
+                requests_s = time.perf_counter() - started
+    finally:
+        monitor.stop()
+        await runner.cleanup()
+
+    return {
+        "updates_per_s": args.updates / updates_s,
+        "requests_per_s": args.requests / requests_s,
+        "lag_p99_ms": monitor.percentile(0.99) * 1000,
+        "lag_max_ms": monitor.max_lag * 1000,
+        "errors": errors,
+    }
+
+
+def run_in_subprocess(loop: str, args) -> dict:
+    command = [
+        sys.executable, "-m", "tools.bench_loop", "--loop", loop, "--json",
+        "--updates", str(args.updates), "--requests", str(args.requests),
+        "--concurrency", str(args.concurrency),
+    ]
+    output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сравнение asyncio и uvloop на смеси апдейтов бота")
+    parser.add_argument("--loop", choices=LOOPS, help="одна реализация (по умолчанию - все, в отдельных процессах)")
+    parser.add_argument("--updates", type=int, default=10000)
+    parser.add_argument("--requests", type=int, default=3000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--json", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.loop:
+        used = select_event_loop(args.loop)
+        result = asyncio.run(run_mix(args))
+        result["loop"] = used
+        print(json.dumps(result) if args.json else result)
+        return
+
+    print(f"{'loop':<10}{'updates/s':>12}{'requests/s':>12}{'lag p99 ms':>12}{'lag max ms':>12}{'errors':>8}")
+    for loop in LOOPS:
+        result = run_in_subprocess(loop, args)
+        if result["loop"] != loop:
+            print(f"{loop:<10}  не установлен, пропущен")
+            continue
+        print(f"{loop:<10}{result['updates_per_s']:>12.0f}{result['requests_per_s']:>12.0f}"
+              f"{result['lag_p99_ms']:>12.1f}{result['lag_max_ms']:>12.1f}{result['errors']:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,347 @@
+"""
+БЕНЧМАРК ПЛАНОВ ЗАПРОСОВ НА БОЛЬШОЙ БАЗЕ
+
+1. Наполняет отдельную базу PostgreSQL реалистичными данными (миллионы
+   пользователей, подписок и платежей) запросами INSERT ... SELECT
+   generate_series - строки создаются на сервере, без передачи из Python.
+2. Выполняет запросы методов Database через EXPLAIN (ANALYZE, BUFFERS)
+   с разными параметрами и печатает медианное время, буферы и форму плана.
+   Запросы записи выполняются в транзакции, которая откатывается.
+3. Завершается с кодом 1, если запрос перешел на Seq Scan по большой таблице
+   или медианное время превысило бюджет (--budget-scale для медленных машин).
+
+Запросы методов Database берутся из реестра statements.py, поэтому
+бенчмарк проверяет ровно те тексты, которые выполняет бот.
+
+ТОЛЬКО для отдельной базы: --reseed очищает таблицы бота.
+Запуск из корня проекта:
+    createdb orden_bench
+    python -m tools.bench_queries --dsn postgresql://localhost/orden_bench --users 2000000
+    python -m tools.bench_queries --dsn ... --output plans.json   # сохранить результаты
+"""
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import sys
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Callable, List
+
+import asyncpg
+
+from migrations import run_migrations
+from statements import (
+    GET_USER, GET_USER_IDS_BY_USERNAMES, GET_ACTIVE_SUBSCRIPTION, GET_USER_SUBSCRIPTIONS,
+    COUNT_USER_SUBSCRIPTIONS, GET_EXPIRING_GIFT_SUBSCRIPTIONS,
+    GET_ACTIVE_SUBSCRIBERS, GET_PENDING_REMINDERS, GET_SUBSCRIPTIONS_PAGE,
+    GET_CHANGED_SUBSCRIPTIONS_PAGE, GET_PAYMENT, GET_STALE_PENDING_PAYMENTS, GET_USER_EVENTS,
+    GET_DAILY_STATS, CONFIRM_PAYMENT, DEACTIVATE_SUBSCRIPTION, MARK_REMINDER_SENT,
+    GET_EXPIRED_SUBSCRIPTIONS_PAGE, GET_PENDING_REMINDERS_PAGE
+)
+
+# Первый telegram_id пользователей бенчмарка
+BASE_USER_ID = 1_000_000_000
+# Таблицы, в которых Seq Scan допустим всегда (несколько строк)
+SMALL_TABLES = ("stats_channels", "job_checkpoints", "schema_migrations")
+BOT_TABLES = (
+    "subscription_events", "stats_daily", "stats_channels", "broadcast_deliveries", "broadcasts",
+    "job_checkpoints", "import_jobs", "reminders", "payments", "subscriptions", "users",
+)
+
+
+@dataclass
+class QueryCase:
+    """Запрос метода Database, параметры и ожидания к плану"""
+    name: str
+    sql: str
+    params: Callable[["Dataset"], tuple]
+    budget_ms: float
+    # Запрос по смыслу читает большую часть таблицы - Seq Scan не считается регрессией
+    seq_scan_ok: bool = False
+    # Запрос изменяет данные - выполняется в транзакции с откатом
+    write: bool = False
+
+
+@dataclass
+class Dataset:
+    users: int
+    payments: int
+    now: datetime
+    rng: random.Random
+
+    def user_id(self) -> int:
+        return BASE_USER_ID + self.rng.randrange(self.users)
+
+    def payment_id(self) -> str:
+        return f"bench-{self.rng.randrange(1, self.payments + 1)}"
+
+
+SEED_STATEMENTS = [
+    # Пользователи: 60% с username, 40% уже получали подарок
+    """
+    INSERT INTO users (telegram_id, username, first_name, gift_received, created_at)
+    SELECT $1::bigint + g,
+           CASE WHEN random() < 0.6 THEN 'user_' || g END,
+           'User ' || g,
+           random() < 0.4,
+           $3::timestamp - random() * interval '365 days'
+    FROM generate_series(0, $2::int - 1) AS g
+    """,
+    # Подписки: channel_1 у 80% пользователей, channel_2 у 40%; активна каждая четвертая,
+    # 0.2% активных уже истекли (их снимает ближайшая проверка планировщика)
+    """
+    INSERT INTO subscriptions (telegram_id, channel_name, is_active, payment_method,
+                               start_date, end_date, created_at, updated_at)
+    SELECT telegram_id, channel_name, r < 0.25, payment_method,
+           end_date - interval '30 days', end_date, end_date - interval '30 days', end_date - interval '30 days'
+    FROM (
+        SELECT telegram_id, channel_name, r,
+               CASE WHEN random() < 0.55 THEN 'gift' ELSE 'paid' END AS payment_method,
+               CASE
+                   WHEN r < 0.0005 THEN $3::timestamp - random() * interval '2 hours'
+                   WHEN r < 0.25 THEN $3::timestamp + random() * interval '30 days'
+                   ELSE $3::timestamp - random() * interval '300 days'
+               END AS end_date
+        FROM (
+            SELECT $1::bigint + g AS telegram_id, channel_name, share, random() AS r, random() AS pick
+            FROM generate_series(0, $2::int - 1) AS g
+            CROSS JOIN (VALUES ('channel_1', 0.8), ('channel_2', 0.4)) AS c(channel_name, share)
+        ) AS raw
+        WHERE pick < share
+    ) AS s
+    """,
+    # Напоминания для пробных подписок (за 3 дня до конца; прошедшие уже отправлены)
+    """
+    INSERT INTO reminders (telegram_id, channel_name, reminder_date, reminder_sent)
+    SELECT telegram_id, channel_name, end_date - interval '3 days',
+           end_date - interval '3 days' < $1::timestamp - interval '1 hour'
+    FROM subscriptions
+    WHERE payment_method = 'gift'
+    """,
+    # Платежи: 88% success, 9% expired, 3% pending (pending - за последние 3 дня)
+    """
+    INSERT INTO payments (telegram_id, channel_name, amount, payment_id, status, created_at)
+    SELECT telegram_id, channel_name, amount, payment_id, status,
+           CASE WHEN status = 'pending' THEN $4::timestamp - random() * interval '3 days'
+                ELSE $4::timestamp - random() * interval '365 days' END
+    FROM (
+        SELECT $1::bigint + floor(random() * $2::int)::bigint AS telegram_id,
+               CASE WHEN random() < 0.6 THEN 'channel_1' ELSE 'channel_2' END AS channel_name,
+               CASE WHEN random() < 0.6 THEN 1990 ELSE 2990 END AS amount,
+               'bench-' || g AS payment_id,
+               CASE WHEN r < 0.88 THEN 'success' WHEN r < 0.97 THEN 'expired' ELSE 'pending' END AS status
+        FROM (SELECT g, random() AS r FROM generate_series(1, $3::int) AS g) AS raw
+    ) AS p
+    """,
+    # Журнал событий: в порядке времени, как его пишет events.py
+    """
+    INSERT INTO subscription_events (occurred_at, telegram_id, channel_name, event, details)
+    SELECT $4::timestamp - interval '365 days' + (g::float / $3::int) * interval '365 days',
+           $1::bigint + floor(random() * $2::int)::bigint,
+           CASE WHEN random() < 0.6 THEN 'channel_1' ELSE 'channel_2' END,
+           (ARRAY['granted', 'renewed', 'reminded', 'expired', 'banned', 'payment_confirmed'])
+               [1 + floor(random() * 6)::int],
+           NULL
+    FROM generate_series(1, $3::int) AS g
+    """,
+    # Сводная статистика за год
+    """
+    INSERT INTO stats_daily (day, channel_name, new_subscriptions, new_trials, conversions,
+                             deactivations, payments, revenue)
+    SELECT d::date, channel_name, 50, 80, 10, 60, 55, 55 * 1990
+    FROM generate_series($1::timestamp - interval '365 days', $1::timestamp, interval '1 day') AS d
+    CROSS JOIN (VALUES ('channel_1'), ('channel_2')) AS c(channel_name)
+    """,
+]
+
+
+CASES: List[QueryCase] = [
+    QueryCase("get_user", GET_USER,
+              lambda d: (d.user_id(),), budget_ms=2),
+    QueryCase("get_user_ids_by_usernames", GET_USER_IDS_BY_USERNAMES,
+              lambda d: ([f"user_{d.rng.randrange(d.users)}" for _ in range(100)],), budget_ms=10),
+    QueryCase("get_active_subscription", GET_ACTIVE_SUBSCRIPTION,
+              lambda d: (d.user_id(), "channel_1"), budget_ms=2),
+    QueryCase("get_user_subscriptions", GET_USER_SUBSCRIPTIONS,
+              lambda d: (d.user_id(),), budget_ms=2),
+    QueryCase("has_ever_had_subscription", COUNT_USER_SUBSCRIPTIONS,
+              lambda d: (d.user_id(), "channel_1"), budget_ms=2),
+    QueryCase("get_expiring_subscriptions", GET_EXPIRING_GIFT_SUBSCRIPTIONS,
+              lambda d: (d.now, d.now + timedelta(days=3)), budget_ms=100),
+    QueryCase("iter_expired_subscriptions", GET_EXPIRED_SUBSCRIPTIONS_PAGE,
+              lambda d: (d.now, 0, 500), budget_ms=20),
+    QueryCase("get_active_subscribers", GET_ACTIVE_SUBSCRIBERS,
+              lambda d: (), budget_ms=2000, seq_scan_ok=True),
+    QueryCase("get_pending_reminders", GET_PENDING_REMINDERS,
+              lambda d: (d.now,), budget_ms=20),
+    QueryCase("iter_pending_reminders", GET_PENDING_REMINDERS_PAGE,
+              lambda d: (d.now, 0, 500), budget_ms=20),
+    QueryCase("get_subscriptions_page", GET_SUBSCRIPTIONS_PAGE,
+              lambda d: (d.rng.randrange(d.users), 500), budget_ms=5),
+    QueryCase("get_changed_subscriptions_page", GET_CHANGED_SUBSCRIPTIONS_PAGE,
+              lambda d: (d.now - timedelta(hours=1), d.now - timedelta(hours=1), 0, 500), budget_ms=5),
+    QueryCase("get_payment", GET_PAYMENT,
+              lambda d: (d.payment_id(),), budget_ms=2),
+    QueryCase("get_stale_pending_payments", GET_STALE_PENDING_PAYMENTS,
+              lambda d: (d.now - timedelta(minutes=15), 0, 100), budget_ms=10),
+    QueryCase("get_user_events", GET_USER_EVENTS,
+              lambda d: (d.user_id(), 50), budget_ms=5),
+    QueryCase("subscription_events:time_range", """
+        SELECT event, COUNT(*) FROM subscription_events
+        WHERE occurred_at >= $1 AND occurred_at < $2
+        GROUP BY event
+    """, lambda d: (d.now - timedelta(days=2), d.now - timedelta(days=1)), budget_ms=100),
+    QueryCase("get_stats:daily", GET_DAILY_STATS,
+              lambda d: (d.now.date() - timedelta(days=6),), budget_ms=5),
+    QueryCase("confirm_payment", CONFIRM_PAYMENT,
+              lambda d: (d.payment_id(),), budget_ms=5, write=True),
+    QueryCase("deactivate_subscription", DEACTIVATE_SUBSCRIPTION,
+              lambda d: (d.user_id(), "channel_1", d.now), budget_ms=5, write=True),
+    QueryCase("mark_reminder_sent", MARK_REMINDER_SENT,
+              lambda d: (d.user_id(), "channel_1"), budget_ms=5, write=True),
+]
+
+
+async def seed(conn: asyncpg.Connection, users: int, payments_per_user: float,
+               events_per_user: float, now: datetime):
+    """Наполнить базу (если она еще не наполнена для этого числа пользователей)"""
+    last_user = await conn.fetchval("SELECT 1 FROM users WHERE telegram_id = $1", BASE_USER_ID + users - 1)
+    if last_user:
+        print(f"Данные для {users} пользователей уже есть - наполнение пропущено (--reseed для повтора)")
+        return
+
+    payments = int(users * payments_per_user)
+    events = int(users * events_per_user)
+    args = [
+        (BASE_USER_ID, users, now),
+        (BASE_USER_ID, users, now),
+        (now,),
+        (BASE_USER_ID, users, payments, now),
+        (BASE_USER_ID, users, events, now),
+        (now,),
+    ]
+    await conn.execute("SELECT setseed(0.42)")
+    for statement, statement_args in zip(SEED_STATEMENTS, args):
+        started = asyncio.get_running_loop().time()
+        status = await conn.execute(statement, *statement_args)
+        table = statement.split("INSERT INTO", 1)[1].split()[0]
+        print(f"  {table:<22}{status.split()[-1]:>12} строк  {asyncio.get_running_loop().time() - started:7.1f} с")
+    await conn.execute("ANALYZE")
+
+
+def walk(node: dict):
+    yield node
+    for child in node.get("Plans", []):
+        yield from walk(child)
+
+
+def plan_shape(node: dict) -> str:
+    """Форма плана: 'Limit → Index Scan(idx_payments_pending)'"""
+    label = node["Node Type"]
+    target = node.get("Index Name") or node.get("Relation Name")
+    if target:
+        label += f"({target})"
+    children = node.get("Plans", [])
+    if len(children) == 1:
+        return f"{label} → {plan_shape(children[0])}"
+    if children:
+        return f"{label} → [{'; '.join(plan_shape(child) for child in children)}]"
+    return label
+
+
+async def explain(conn: asyncpg.Connection, case: QueryCase, params: tuple) -> dict:
+    query = f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {case.sql}"
+    if not case.write:
+        return json.loads(await conn.fetchval(query, *params))[0]
+    transaction = conn.transaction()
+    await transaction.start()
+    try:
+        return json.loads(await conn.fetchval(query, *params))[0]
+    finally:
+        await transaction.rollback()
+
+
+async def run_case(conn: asyncpg.Connection, case: QueryCase, dataset: Dataset,
+                   repeat: int, budget_scale: float) -> dict:
+    await explain(conn, case, case.params(dataset))  # прогрев кэша
+    plans = [await explain(conn, case, case.params(dataset)) for _ in range(repeat)]
+    times = [plan["Execution Time"] for plan in plans]
+    root = plans[-1]["Plan"]
+    seq_scans = sorted({
+        node["Relation Name"] for node in walk(root)
+        if node["Node Type"] == "Seq Scan" and node["Relation Name"] not in SMALL_TABLES
+    })
+
+    result = {
+        "name": case.name,
+        "median_ms": statistics.median(times),
+        "max_ms": max(times),
+        "planning_ms": statistics.median(plan["Planning Time"] for plan in plans),
+        "shared_hit": root.get("Shared Hit Blocks", 0),
+        "shared_read": root.get("Shared Read Blocks", 0),
+        "rows": root.get("Actual Rows", 0),
+        "plan": plan_shape(root),
+        "budget_ms": case.budget_ms * budget_scale,
+        "problems": [],
+    }
+    if seq_scans and not case.seq_scan_ok:
+        result["problems"].append(f"Seq Scan on {', '.join(seq_scans)}")
+    if result["median_ms"] > result["budget_ms"]:
+        result["problems"].append(f"{result['median_ms']:.1f} ms > budget {result['budget_ms']:.0f} ms")
+    return result
+
+
+async def run(args) -> List[dict]:
+    conn = await asyncpg.connect(args.dsn)
+    try:
+        await run_migrations(conn)
+        if args.reseed:
+            await conn.execute(f"TRUNCATE {', '.join(BOT_TABLES)} RESTART IDENTITY CASCADE")
+        now = datetime.now().replace(microsecond=0)
+        print(f"Наполнение: {args.users} пользователей")
+        await seed(conn, args.users, args.payments_per_user, args.events_per_user, now)
+
+        dataset = Dataset(args.users, int(args.users * args.payments_per_user), now, random.Random(42))
+        cases = [case for case in CASES if not args.only or case.name in args.only]
+        return [await run_case(conn, case, dataset, args.repeat, args.budget_scale) for case in cases]
+    finally:
+        await conn.close()
+
+
+def print_results(results: List[dict]):
+    print(f"\n{'query':<40}{'median ms':>10}{'max ms':>9}{'hit':>8}{'read':>8}{'rows':>9}  plan")
+    for result in results:
+        marker = "  ❌ " + "; ".join(result["problems"]) if result["problems"] else ""
+        print(f"{result['name']:<40}{result['median_ms']:>10.2f}{result['max_ms']:>9.2f}"
+              f"{result['shared_hit']:>8}{result['shared_read']:>8}{result['rows']:>9}  {result['plan']}{marker}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Планы и время запросов Database на большой базе")
+    parser.add_argument("--dsn", required=True, help="отдельная база для бенчмарка (не рабочая!)")
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--payments-per-user", type=float, default=1.5)
+    parser.add_argument("--events-per-user", type=float, default=4)
+    parser.add_argument("--repeat", type=int, default=20, help="выполнений каждого запроса")
+    parser.add_argument("--budget-scale", type=float, default=1.0, help="множитель бюджетов времени")
+    parser.add_argument("--only", nargs="*", help="только указанные запросы")
+    parser.add_argument("--reseed", action="store_true", help="очистить таблицы и наполнить заново")
+    parser.add_argument("--output", help="сохранить результаты в JSON")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    print_results(results)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            json.dump(results, output, ensure_ascii=False, indent=2)
+
+    failed = [result["name"] for result in results if result["problems"]]
+    if failed:
+        print(f"\nРегрессии: {', '.join(failed)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""
+ЗАГЛУШКИ TELEGRAM И ОКРУЖЕНИЕ ДЛЯ БЕНЧМАРКОВ И СИМУЛЯЦИИ
+
+FakeBot повторяет методы aiogram.Bot, которыми пользуются обработчики и
+фоновые задачи, без сетевых запросов: каждый вызов только считается.
+FakeMessage / FakeCallbackQuery - минимальные Message и CallbackQuery
+для прямого вызова обработчиков из handlers.py.
+"""
+import contextlib
+import functools
+import io
+import os
+from collections import Counter
+from itertools import count
+from types import SimpleNamespace
+
+
+def configure_offline_environment():
+    """
+    Переменные окружения для запуска без PostgreSQL и Telegram
+
+    Вызывается ДО импорта модулей бота: хранилище выбирается при импорте database.
+    """
+    os.environ["DB_BACKEND"] = "memory"
+    os.environ.setdefault("BOT_TOKEN", "123456:offline")
+    os.environ.setdefault("TELEGRAM_RATE_LIMIT", "1000000")
+    for channel in ("1", "2"):
+        os.environ.setdefault(f"ROBOKASSA_CHANNEL_{channel}_MERCHANT_LOGIN", "offline")
+        os.environ.setdefault(f"ROBOKASSA_CHANNEL_{channel}_PASSWORD_1", "offline")
+        os.environ.setdefault(f"ROBOKASSA_CHANNEL_{channel}_PASSWORD_2", "offline")
+
+
+def count_storage_calls(storage) -> Counter:
+    """
+    Считать вызовы методов хранилища (по имени метода)
+
+    Методы оборачиваются на экземпляре, поэтому вызовы через db из любого
+    модуля попадают в счетчик. Внутренние вызовы хранилища (например,
+    create_subscription внутри prepare_gift_batch) тоже считаются.
+    """
+    calls = Counter()
+    for name in dir(type(storage)):
+        method = getattr(storage, name)
+        if name.startswith("_") or not callable(method) or name == "transaction":
+            continue
+
+        def wrap(method=method, name=name):
+            @functools.wraps(method)
+            def counted(*args, **kwargs):
+                calls[name] += 1
+                return method(*args, **kwargs)
+            return counted
+        setattr(storage, name, wrap())
+    return calls
+
+
+class _NullWriter(io.TextIOBase):
+    def write(self, text):
+        return len(text)
+
+
+def silence_stdout():
+    """Подавить print модулей бота: строки форматируются (это часть измеряемой работы), но не выводятся"""
+    return contextlib.redirect_stdout(_NullWriter())
+
+
+class FakeBot:
+    """Бот без сети: считает вызовы API по имени метода"""
+
+    def __init__(self, member_status: str = "member"):
+        self.calls = Counter()
+        self.member_status = member_status
+        self._message_ids = count(1)
+
+    def _record(self, method: str):
+        self.calls[method] += 1
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self._record("send_message")
+        return SimpleNamespace(message_id=next(self._message_ids), chat=SimpleNamespace(id=chat_id), text=text)
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        self._record("edit_message_text")
+        return True
+
+    async def ban_chat_member(self, chat_id, user_id, **kwargs):
+        self._record("ban_chat_member")
+        return True
+
+    async def unban_chat_member(self, chat_id, user_id, **kwargs):
+        self._record("unban_chat_member")
+        return True
+
+    async def create_chat_invite_link(self, chat_id, **kwargs):
+        self._record("create_chat_invite_link")
+        return SimpleNamespace(invite_link=f"https://t.me/+fake{abs(hash(chat_id))}")
+
+    async def get_chat(self, chat_id):
+        self._record("get_chat")
+        return SimpleNamespace(id=abs(hash(chat_id)) % 10 ** 9)
+
+    async def get_chat_member(self, chat_id, user_id):
+        self._record("get_chat_member")
+        return SimpleNamespace(status=self.member_status, user=SimpleNamespace(id=user_id))
+
+
+def fake_user(user_id: int, username: str = None):
+    return SimpleNamespace(id=user_id, username=username or f"user{user_id}",
+                           first_name="Test", last_name=None)
+
+
+class FakeMessage:
+    """Сообщение пользователя: answer/edit_text считаются в боте"""
+
+    def __init__(self, bot: FakeBot, user_id: int, text: str = ""):
+        self.bot = bot
+        self.from_user = fake_user(user_id)
+        self.chat = SimpleNamespace(id=user_id)
+        self.text = text
+        self.html_text = text
+        self.document = None
+        self.message_id = 1
+
+    async def answer(self, text, **kwargs):
+        return await self.bot.send_message(self.chat.id, text, **kwargs)
+
+    async def edit_text(self, text, **kwargs):
+        return await self.bot.edit_message_text(text, chat_id=self.chat.id, message_id=self.message_id, **kwargs)
+
+
+class FakeCallbackQuery:
+    """Нажатие inline-кнопки под сообщением бота"""
+
+    def __init__(self, bot: FakeBot, user_id: int, data: str):
+        self.bot = bot
+        self.from_user = fake_user(user_id)
+        self.data = data
+        self.message = FakeMessage(bot, user_id)
+
+    async def answer(self, text: str = None, **kwargs):
+        self.bot._record("answer_callback_query")
+        return True
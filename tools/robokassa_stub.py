@@ -0,0 +1,149 @@
+"""
+ЛОКАЛЬНАЯ ЗАГЛУШКА ИНТЕРФЕЙСА ROBOKASSA OpState
+
+Отвечает на запросы OpStateExt так же, как Robokassa: проверяет подпись
+MerchantLogin:InvoiceID:Password2 (учетные данные каналов из config.py) и
+возвращает XML с состоянием операции.
+
+Состояния счетов задаются:
+- при запуске: --default-state (для всех неизвестных счетов);
+- во время работы: POST /stub/state?InvoiceID=...&State=100[&OutSum=1990].
+
+Запуск заглушки (бот направляется на нее через ROBOKASSA_OPSTATE_URL):
+    python -m tools.robokassa_stub --port 8081 --default-state 100
+
+Проверка сверки платежей против заглушки (in-memory хранилище, FakeBot):
+    python -m tools.robokassa_stub --demo
+"""
+import argparse
+import asyncio
+import os
+from typing import Dict, Optional, Tuple
+from aiohttp import web
+
+OPSTATE_PATH = "/Merchant/WebService/Service.asmx/OpStateExt"
+NAMESPACE = "http://merchant.roboxchange.com/WebService/"
+
+# Коды результата Robokassa
+RESULT_OK = 0
+RESULT_BAD_SIGNATURE = 1
+RESULT_NOT_FOUND = 3
+
+
+def opstate_xml(result_code: int, state_code: int = None, out_sum: str = None) -> str:
+    parts = [f'<?xml version="1.0" encoding="utf-8"?>\n<OperationStateResponse xmlns="{NAMESPACE}">',
+             f"<Result><Code>{result_code}</Code></Result>"]
+    if state_code is not None:
+        parts.append(f"<State><Code>{state_code}</Code></State>")
+    if out_sum is not None:
+        parts.append(f"<Info><OutSum>{out_sum}</OutSum></Info>")
+    parts.append("</OperationStateResponse>")
+    return "".join(parts)
+
+
+def create_stub_app(default_state: Optional[int] = None, default_out_sum: str = None) -> web.Application:
+    """
+    Приложение-заглушка
+
+    app['states']: InvoiceID -> (код состояния, OutSum); app['stats']['requests']: число запросов OpState
+    """
+    from robokassa import get_channel_credentials, get_opstate_signature
+
+    app = web.Application()
+    states: Dict[str, Tuple[int, Optional[str]]] = {}
+    app['states'] = states
+    app['stats'] = {'requests': 0}
+
+    def signature_valid(login: str, invoice_id: str, signature: str) -> bool:
+        for channel_name in ("channel_1", "channel_2"):
+            merchant_login, _, password_2 = get_channel_credentials(channel_name)
+            if login == merchant_login and signature.lower() == get_opstate_signature(
+                    merchant_login, invoice_id, password_2):
+                return True
+        return False
+
+    async def op_state(request):
+        app['stats']['requests'] += 1
+        params = request.query if request.method == "GET" else await request.post()
+        invoice_id = params.get("InvoiceID", "")
+        if not signature_valid(params.get("MerchantLogin", ""), invoice_id, params.get("Signature", "")):
+            return web.Response(text=opstate_xml(RESULT_BAD_SIGNATURE), content_type="text/xml")
+        if invoice_id in states:
+            state_code, out_sum = states[invoice_id]
+        elif default_state is not None:
+            state_code, out_sum = default_state, default_out_sum
+        else:
+            return web.Response(text=opstate_xml(RESULT_NOT_FOUND), content_type="text/xml")
+        return web.Response(text=opstate_xml(RESULT_OK, state_code, out_sum), content_type="text/xml")
+
+    async def set_state(request):
+        invoice_id = request.query["InvoiceID"]
+        states[invoice_id] = (int(request.query["State"]), request.query.get("OutSum"))
+        return web.Response(text="OK")
+
+    app.router.add_get(OPSTATE_PATH, op_state)
+    app.router.add_post(OPSTATE_PATH, op_state)
+    app.router.add_post("/stub/state", set_state)
+    return app
+
+
+async def run_demo(port: int):
+    """Зависшие платежи в in-memory хранилище -> сверка через заглушку"""
+    from tools.fakes import configure_offline_environment, FakeBot, silence_stdout
+    configure_offline_environment()
+    os.environ["ROBOKASSA_OPSTATE_URL"] = f"http://127.0.0.1:{port}{OPSTATE_PATH}"
+
+    from datetime import timedelta
+    from clock import clock
+    from database import db
+    from payment_reconciler import reconcile_pending_payments, close_session
+
+    app = create_stub_app()
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+
+    # Платежи созданы 2 часа и 4 дня назад: оплаченные, неоплаченные, не найденные
+    bot = FakeBot()
+    clock.set(clock.now() - timedelta(days=4))
+    for i in range(30):
+        if i == 15:
+            clock.advance(timedelta(days=4) - timedelta(hours=2))
+        user_id, payment_id = 70_000_000 + i, f"stub-{i}"
+        await db.add_user(user_id)
+        await db.create_payment(user_id, "channel_1", 1990, payment_id, "pending")
+        if i % 3 == 0:
+            app['states'][payment_id] = (100, "1990.000000")
+        elif i % 3 == 1:
+            app['states'][payment_id] = (5, None)
+    clock.reset()
+
+    try:
+        with silence_stdout():
+            first = await reconcile_pending_payments(bot)
+            second = await reconcile_pending_payments(bot)
+    finally:
+        await close_session()
+        await runner.cleanup()
+
+    print(f"first pass:  {first}")
+    print(f"second pass: {second}  (оплаченные не проводятся повторно)")
+    print(f"OpState requests: {app['stats']['requests']}, Bot API calls: {dict(bot.calls)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Заглушка Robokassa OpState")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--default-state", type=int, help="состояние неизвестных счетов (например, 100 или 5)")
+    parser.add_argument("--out-sum", help="OutSum для --default-state")
+    parser.add_argument("--demo", action="store_true", help="проверить сверку платежей против заглушки")
+    args = parser.parse_args()
+
+    if args.demo:
+        asyncio.run(run_demo(args.port))
+        return
+    web.run_app(create_stub_app(args.default_state, args.out_sum), host="127.0.0.1", port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""
+СИМУЛЯЦИЯ РАБОТЫ ПЛАНИРОВЩИКА В ВИРТУАЛЬНОМ ВРЕМЕНИ
+
+N пользователей приходят в течение первых --join-days дней: часть получает
+пробную подписку (подарок, как через /import_users), часть сразу оплачивает.
+Часть пробных пользователей оплачивает после окончания подарка, часть платных -
+продлевает. Часы (clock) переводятся в виртуальный режим и сдвигаются шагом
+--step-hours; на каждом шаге выполняются check_reminders и
+check_expired_subscriptions - так же, как их запускает scheduler раз в час.
+
+По каждому виртуальному дню выводятся: сколько напоминаний отправлено и
+подписок истекло, сколько вызовов хранилища и Bot API сделали задачи
+планировщика и сколько реального времени они заняли.
+
+Запуск из корня проекта (in-memory хранилище, FakeBot):
+    python -m tools.simulate --users 10000 --days 60
+"""
+from tools.fakes import configure_offline_environment
+
+# Хранилище выбирается при импорте database, поэтому окружение задается до импортов бота
+configure_offline_environment()
+
+import argparse
+import asyncio
+import heapq
+import random
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+import handlers
+import scheduler
+from clock import clock
+from config import FREE_TRIAL_DAYS, PAID_SUBSCRIPTION_DAYS, REMINDER_DAYS_BEFORE
+from database import db
+from subscriber_index import subscriber_index
+from tools.fakes import FakeBot, count_storage_calls, silence_stdout
+
+# Начало виртуального времени
+SIMULATION_START = datetime(2026, 1, 1, 9, 0)
+BASE_USER_ID = 50_000_000
+
+
+def plan_events(users: int, join_days: int, paid_share: float, convert_share: float,
+                renew_share: float, rng: random.Random) -> list:
+    """Расписание действий пользователей: куча (время, порядковый номер, действие, telegram_id)"""
+    events = []
+    for i in range(users):
+        user_id = BASE_USER_ID + i
+        joined = SIMULATION_START + timedelta(seconds=rng.uniform(0, join_days * 86400))
+        if rng.random() < paid_share:
+            events.append((joined, i, "pay", user_id))
+            if rng.random() < renew_share:
+                renewal = joined + timedelta(days=PAID_SUBSCRIPTION_DAYS, hours=rng.uniform(1, 48))
+                events.append((renewal, users + i, "pay", user_id))
+        else:
+            events.append((joined, i, "gift", user_id))
+            if rng.random() < convert_share:
+                conversion = joined + timedelta(days=FREE_TRIAL_DAYS, hours=rng.uniform(1, 72))
+                events.append((conversion, users + i, "pay", user_id))
+    heapq.heapify(events)
+    return events
+
+
+async def give_gift(user_id: int):
+    """Пробная подписка на channel_1 - те же операции, что и в cmd_import_users"""
+    start_date = clock.now()
+    end_date = start_date + timedelta(days=FREE_TRIAL_DAYS)
+    await db.add_user(user_id)
+    async with db.transaction("import_gift"):
+        await db.create_subscription(user_id, "channel_1", "gift", start_date, end_date, is_active=True)
+        await db.mark_gift_received(user_id)
+        await db.create_reminder(user_id, "channel_1", start_date + timedelta(days=FREE_TRIAL_DAYS - REMINDER_DAYS_BEFORE))
+
+
+async def pay(user_id: int, bot: FakeBot):
+    await db.add_user(user_id)
+    await handlers.process_payment_success(user_id, "channel_2", bot)
+
+
+async def run(args) -> list:
+    rng = random.Random(args.seed)
+    bot = FakeBot()
+    db_calls = count_storage_calls(db)
+    events = plan_events(args.users, args.join_days, args.paid_share, args.convert_share,
+                         args.renew_share, rng)
+    step = timedelta(hours=args.step_hours)
+    steps_per_day = max(1, round(24 / args.step_hours))
+
+    clock.set(SIMULATION_START)
+    subscriber_index.load([])
+    days = []
+    try:
+        for day in range(1, args.days + 1):
+            stats = Counter()
+            for _ in range(steps_per_day):
+                clock.advance(step)
+
+                # Действия пользователей за шаг (не входят в измерение задач планировщика)
+                with silence_stdout():
+                    while events and events[0][0] <= clock.now():
+                        _, _, action, user_id = heapq.heappop(events)
+                        if action == "gift":
+                            await give_gift(user_id)
+                        else:
+                            await pay(user_id, bot)
+                        stats[action] += 1
+
+                # Задачи планировщика: вызовы хранилища и Bot API, реальное время
+                db_before, bot_before = Counter(db_calls), Counter(bot.calls)
+                started = time.perf_counter()
+                with silence_stdout():
+                    await scheduler.check_reminders(bot)
+                    await scheduler.check_expired_subscriptions(bot)
+                stats["job_ms"] += (time.perf_counter() - started) * 1000
+                job_db = db_calls - db_before
+                stats["db_calls"] += sum(job_db.values())
+                stats["api_calls"] += sum((bot.calls - bot_before).values())
+                stats["reminders"] += job_db["mark_reminder_sent"]
+                stats["expired"] += job_db["deactivate_subscription"]
+
+            stats["active"] = subscriber_index.count("channel_1") + subscriber_index.count("channel_2")
+            days.append((day, stats))
+    finally:
+        clock.reset()
+    return days
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Симуляция подписок и планировщика в виртуальном времени")
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--days", type=int, default=60, help="длительность симуляции в днях")
+    parser.add_argument("--join-days", type=int, default=14, help="за сколько дней приходят все пользователи")
+    parser.add_argument("--paid-share", type=float, default=0.3, help="доля пользователей, сразу оплативших")
+    parser.add_argument("--convert-share", type=float, default=0.2, help="доля пробных, оплативших после подарка")
+    parser.add_argument("--renew-share", type=float, default=0.5, help="доля платных, продливших подписку")
+    parser.add_argument("--step-hours", type=float, default=1, help="шаг виртуального времени (как интервал задач)")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    days = asyncio.run(run(args))
+    elapsed = time.perf_counter() - started
+
+    print(f"{'day':>4}{'gifts':>7}{'pays':>7}{'active':>8}{'remind':>8}{'expired':>8}"
+          f"{'db calls':>10}{'api calls':>10}{'jobs ms':>10}{'µs/row':>9}")
+    for day, stats in days:
+        rows = stats["reminders"] + stats["expired"]
+        per_row = stats["job_ms"] * 1000 / rows if rows else 0
+        print(f"{day:>4}{stats['gift']:>7}{stats['pay']:>7}{stats['active']:>8}{stats['reminders']:>8}"
+              f"{stats['expired']:>8}{stats['db_calls']:>10}{stats['api_calls']:>10}"
+              f"{stats['job_ms']:>10.1f}{per_row:>9.1f}")
+    print(f"Simulated {args.days} days for {args.users} users in {elapsed:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,538 @@
+"""
+ДЛИТЕЛЬНЫЙ ПРОГОН (SOAK) С ПОИСКОМ УТЕЧЕК ПАМЯТИ
+
+Бот работает часами против локальных заглушек, как в продакшене:
+- апдейты (/start, меню, выбор оплаты, заявки на вступление, /stats и
+  /history администратора) проходят через Dispatcher и middleware aiogram;
+  запросы к Bot API уходят настоящим aiogram.Bot на tools/telegram_stub.py;
+- webhook'и Robokassa - HTTP-запросы с подписью к серверу платежей
+  (payment_handler.py); часть "потерянных" оплат подтверждает сверка через
+  tools/robokassa_stub.py, часть счетов остается неоплаченной;
+- задачи планировщика (напоминания, истечение, сверка участников и платежей)
+  выполняются каждый раунд, виртуальное время сдвигается на --tick-minutes,
+  поэтому подписки выдаются, истекают и продлеваются по кругу.
+
+Каждые --snapshot-seconds снимается снимок tracemalloc (после gc.collect())
+и сравнивается с базовым, снятым после прогрева (--warmup-seconds):
+- места с наибольшим ростом памяти (файл:строка);
+- число объектов aiogram, asyncpg, aiohttp, задач asyncio и моделей бота;
+- размер пула соединений (при --dsn), буфера журнала событий, индекса подписчиков.
+
+Утечка - место или тип объектов, которые росли на каждом из последних
+--window снимков и выросли не меньше порога. Место относится к компоненту
+(handlers, scheduler, database, ...) по ближайшему кадру кода бота в стеке
+выделения. Рост данных in-memory хранилища (memory_storage.py) ожидаем -
+оно и есть база данных - и утечкой не считается; чтобы проверить слой
+Database и пул asyncpg, прогон запускается на PostgreSQL (--dsn, отдельная
+пустая база: миграции применяются при запуске).
+
+tracemalloc замедляет обработку в разы: прогон ищет рост памяти, а не
+измеряет пропускную способность (для нее - tools/bench_loop.py).
+
+Код выхода 1, если найдены утечки. Ctrl+C завершает прогон досрочно с отчетом.
+
+Запуск из корня проекта:
+    python -m tools.soak --hours 4
+    python -m tools.soak --minutes 10 --warmup-seconds 60 --snapshot-seconds 30
+    python -m tools.soak --hours 2 --dsn postgresql://postgres@localhost/soak_bot
+"""
+from tools.fakes import configure_offline_environment
+
+import argparse
+import asyncio
+import gc
+import hashlib
+import json
+import os
+import random
+import resource
+import signal
+import sys
+import time
+import tracemalloc
+from collections import Counter, deque
+from datetime import timedelta
+from typing import Dict, List, Optional
+
+import aiohttp
+from aiohttp import web
+
+from tools.robokassa_stub import OPSTATE_PATH
+
+BASE_USER_ID = 80_000_000
+ADMIN_ID = 79_999_999
+# Порты заглушек и сервера платежей: --port, --port+1, --port+2
+DEFAULT_PORT = 18090
+
+# Компоненты бота по файлам (для отнесения мест роста памяти)
+COMPONENTS = {
+    "handlers.py": "handlers",
+    "keyboards.py": "handlers",
+    "messages.py": "handlers",
+    "scheduler.py": "scheduler",
+    "reconciliation.py": "scheduler",
+    "payment_reconciler.py": "scheduler",
+    "database.py": "database",
+    "migrations.py": "database",
+    "memory_storage.py": "storage",
+}
+# Рост в этих компонентах - данные, а не утечка
+DATA_COMPONENTS = {"storage"}
+
+# Пакеты, объекты которых считаются по типам
+TRACKED_PACKAGES = ("aiogram", "asyncpg", "aiohttp", "models")
+TRACKED_TYPES = ("_asyncio.Task", "_asyncio.Future")
+
+IGNORED_TRACES = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+    tracemalloc.Filter(False, __file__),
+)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def component_of(filename: str) -> Optional[str]:
+    """Компонент бота по файлу (None - библиотека, tools, стандартная библиотека или сгенерированный код)"""
+    if not os.path.isabs(filename) or os.path.dirname(filename) != ROOT:
+        return None
+    return COMPONENTS.get(os.path.basename(filename), "bot")
+
+
+def count_objects() -> Counter:
+    """Число живых объектов отслеживаемых типов: 'модуль.Тип' -> количество"""
+    counts = Counter()
+    for obj in gc.get_objects():
+        cls = type(obj)
+        module = cls.__module__ if isinstance(cls.__module__, str) else ""
+        name = f"{module}.{cls.__qualname__}"
+        if module.split(".")[0] in TRACKED_PACKAGES or name in TRACKED_TYPES:
+            counts[name] += 1
+    return counts
+
+
+def steady_growth(series: List[int], threshold: int) -> bool:
+    """Значение росло на каждом шаге окна и выросло не меньше threshold"""
+    return (len(series) >= 2 and all(b > a for a, b in zip(series, series[1:]))
+            and series[-1] - series[0] >= threshold)
+
+
+# ---------------------------------------------------------------------------
+# Нагрузка
+# ---------------------------------------------------------------------------
+
+class Workload:
+    """Смесь апдейтов, webhook'ов Robokassa и тиков планировщика"""
+
+    def __init__(self, args, bot, dispatcher, http: aiohttp.ClientSession, robokassa_app: web.Application):
+        self.args = args
+        self.bot = bot
+        self.dispatcher = dispatcher
+        self.http = http
+        self.robokassa_app = robokassa_app
+        self.rng = random.Random(args.seed)
+        self.result_url = f"http://127.0.0.1:{args.port + 2}/robokassa/result"
+        self.update_ids = iter(range(1, sys.maxsize))
+        self.payments_after_id = 0
+        self.started_users = set()
+        self.counts = Counter()
+
+    def _user(self, user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": "Soak", "username": f"soak{user_id}"}
+
+    def _message(self, user_id: int, text: str) -> dict:
+        return {
+            "message_id": self.rng.randint(1, 10 ** 6),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id),
+            "text": text,
+        }
+
+    def update_for(self, user_id: int) -> dict:
+        """Случайный апдейт пользователя: команды, кнопки меню, оплата, заявка в канал"""
+        from config import CHANNEL_2_ID
+
+        update = {"update_id": next(self.update_ids)}
+        roll = self.rng.random()
+        if roll < 0.02:
+            command = "/stats" if self.rng.random() < 0.5 else f"/history {user_id}"
+            update["message"] = self._message(ADMIN_ID, command)
+            self.counts["admin"] += 1
+        elif roll < 0.2 or user_id not in self.started_users:
+            # Пользователь начинает с /start (до него в БД нет строки users)
+            self.started_users.add(user_id)
+            update["message"] = self._message(user_id, "/start")
+            self.counts["start"] += 1
+        elif roll < 0.35:
+            update["chat_join_request"] = {
+                "chat": {"id": int(CHANNEL_2_ID), "type": "channel", "title": "Soak"},
+                "from": self._user(user_id),
+                "user_chat_id": user_id,
+                "date": int(time.time()),
+            }
+            self.counts["join_request"] += 1
+        else:
+            data = self.rng.choice(("channel_2_info", "my_subscriptions", "main_menu", "pay_channel_2", "pay_channel_2"))
+            update["callback_query"] = {
+                "id": str(update["update_id"]),
+                "from": self._user(user_id),
+                "chat_instance": "soak",
+                "data": data,
+                "message": {**self._message(user_id, "menu"), "from": {"id": 1, "is_bot": True, "first_name": "Stub"}},
+            }
+            self.counts["callback"] += 1
+        return update
+
+    async def feed_updates(self):
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+
+        async def feed(update):
+            async with semaphore:
+                try:
+                    await self.dispatcher.feed_raw_update(self.bot, update)
+                except Exception:
+                    self.counts["update_errors"] += 1
+
+        users = [BASE_USER_ID + self.rng.randrange(self.args.users) for _ in range(self.args.updates_per_round)]
+        await asyncio.gather(*(feed(self.update_for(user_id)) for user_id in users))
+
+    async def send_webhooks(self):
+        """
+        Счета, созданные за раунд: оплата с webhook'ом, оплата без webhook'а
+        (подтвердит сверка через OpState) или брошенный счет
+        """
+        from clock import clock
+        from database import db
+        from robokassa import get_channel_credentials
+
+        payments = await db.get_stale_pending_payments(
+            clock.now() + timedelta(seconds=1), self.payments_after_id, self.args.updates_per_round
+        )
+        if payments:
+            self.payments_after_id = payments[-1].id
+        for payment in payments:
+            roll = self.rng.random()
+            if roll < self.args.paid_share:
+                out_sum = f"{payment.amount:.2f}"
+                _, _, password_2 = get_channel_credentials(payment.channel_name)
+                shp = f"Shp_user_id={payment.telegram_id}"
+                signature = hashlib.md5(f"{out_sum}:{payment.payment_id}:{password_2}:{shp}".encode()).hexdigest()
+                data = {"OutSum": out_sum, "InvId": payment.payment_id,
+                        "Shp_user_id": str(payment.telegram_id), "SignatureValue": signature}
+                try:
+                    async with self.http.post(self.result_url, data=data) as response:
+                        text = await response.text()
+                    self.counts["webhooks" if text.startswith("OK") else "webhook_errors"] += 1
+                except aiohttp.ClientError:
+                    self.counts["webhook_errors"] += 1
+            elif roll < self.args.paid_share + self.args.lost_share:
+                self.robokassa_app['states'][payment.payment_id] = (100, f"{payment.amount}.000000")
+                self.counts["lost_webhooks"] += 1
+            else:
+                self.counts["abandoned"] += 1
+
+    async def scheduler_tick(self):
+        """Виртуальное время вперед и задачи планировщика, как их запускает scheduler"""
+        import scheduler
+        from clock import clock
+
+        clock.advance(timedelta(minutes=self.args.tick_minutes))
+        await scheduler.check_reminders(self.bot)
+        await scheduler.check_expired_subscriptions(self.bot)
+        await scheduler.reconcile_memberships(self.bot)
+        await scheduler.reconcile_payments(self.bot)
+        self.counts["ticks"] += 1
+
+    async def round(self):
+        from tools.fakes import silence_stdout
+
+        with silence_stdout():
+            await self.feed_updates()
+            await self.send_webhooks()
+            await self.scheduler_tick()
+        self.counts["rounds"] += 1
+
+
+# ---------------------------------------------------------------------------
+# Снимки памяти
+# ---------------------------------------------------------------------------
+
+class MemoryTracker:
+    """Снимки tracemalloc и счетчики объектов относительно базового снимка"""
+
+    def __init__(self, window: int, min_growth_kb: int, min_objects: int, top: int, models_are_data: bool):
+        self.window = window
+        self.min_growth = min_growth_kb * 1024
+        self.min_objects = min_objects
+        self.top = top
+        # In-memory хранилище держит строки как объекты models - их рост тоже данные
+        self.models_are_data = models_are_data
+        self.baseline: Optional[tracemalloc.Snapshot] = None
+        self.baseline_objects: Counter = Counter()
+        self.last: Optional[tracemalloc.Snapshot] = None
+        self.last_objects: Counter = Counter()
+        # Последние window снимков: место (файл, строка) -> байт; тип -> объектов
+        self.site_history = deque(maxlen=window)
+        self.object_history = deque(maxlen=window)
+        self.gauges: List[dict] = []
+
+    def take(self, gauges: dict) -> dict:
+        gc.collect()
+        snapshot = tracemalloc.take_snapshot().filter_traces(IGNORED_TRACES)
+        objects = count_objects()
+        traced, peak = tracemalloc.get_traced_memory()
+        gauges = {
+            **gauges,
+            "traced_mb": traced / 2 ** 20,
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        }
+        if self.baseline is None:
+            self.baseline, self.baseline_objects = snapshot, objects
+        self.site_history.append({
+            (stat.traceback[0].filename, stat.traceback[0].lineno): stat.size
+            for stat in snapshot.statistics("lineno")
+        })
+        self.object_history.append(objects)
+        self.last, self.last_objects = snapshot, objects
+        self.gauges.append(gauges)
+        return gauges
+
+    def top_growth(self) -> List[tracemalloc.StatisticDiff]:
+        return [diff for diff in self.last.compare_to(self.baseline, "lineno") if diff.size_diff > 0][:self.top]
+
+    def object_growth(self) -> List[tuple]:
+        names = set(self.last_objects) | set(self.baseline_objects)
+        growth = [(name, self.baseline_objects[name], self.last_objects[name]) for name in names
+                  if self.baseline_objects[name] != self.last_objects[name]]
+        growth.sort(key=lambda item: item[2] - item[1], reverse=True)
+        return growth[:self.top]
+
+    def owner(self, filename: str, lineno: int) -> str:
+        """Компонент по ближайшему к месту выделения кадру кода бота"""
+        trace_filter = tracemalloc.Filter(True, filename, lineno)
+        stats = self.last.filter_traces((trace_filter,)).statistics("traceback")
+        if stats:
+            for frame in reversed(stats[0].traceback):
+                component = component_of(frame.filename)
+                if component:
+                    return component
+        return "library"
+
+    def leaks(self) -> Dict[str, list]:
+        """Устойчивый рост за последние window снимков: компонент -> [(описание, рост)]"""
+        found: Dict[str, list] = {}
+        if len(self.site_history) < self.window:
+            return found
+        for site in self.site_history[-1]:
+            series = [sizes.get(site, 0) for sizes in self.site_history]
+            if steady_growth(series, self.min_growth):
+                filename, lineno = site
+                found.setdefault(self.owner(filename, lineno), []).append(
+                    (f"{filename}:{lineno}", series[-1] - series[0])
+                )
+        for name in self.object_history[-1]:
+            series = [objects[name] for objects in self.object_history]
+            if steady_growth(series, self.min_objects):
+                component = "storage" if self.models_are_data and name.startswith("models.") else "objects"
+                found.setdefault(component, []).append((name, series[-1] - series[0]))
+        return found
+
+
+def collect_gauges() -> dict:
+    """Размеры пула и структур бота, которые живут весь процесс"""
+    from database import db
+    from events import event_log
+    from subscriber_index import subscriber_index
+    from update_queue import update_executor
+
+    gauges = {
+        "tasks": len(asyncio.all_tasks()),
+        "event_buffer": len(event_log._buffer),
+        "subscribers": sum(subscriber_index.count(name) for name in ("channel_1", "channel_2")),
+    }
+    pool = getattr(db, "pool", None)
+    if pool is not None:
+        gauges["pool_size"] = pool.get_size()
+        gauges["pool_idle"] = pool.get_idle_size()
+    if hasattr(db, "_recent_writes"):
+        gauges["recent_writes"] = len(db._recent_writes)
+    # Очереди пользователей удаляются после последнего апдейта - рост означает утечку
+    gauges["update_keys"] = len(update_executor._tails)
+    return gauges
+
+
+def format_gauges(elapsed: float, gauges: dict) -> str:
+    parts = [f"{elapsed / 60:6.1f} min", f"traced {gauges['traced_mb']:.1f} MB",
+             f"peak RSS {gauges['peak_rss_mb']:.0f} MB"]
+    parts += [f"{name} {value}" for name, value in gauges.items() if name not in ("traced_mb", "peak_rss_mb")]
+    return " | ".join(parts)
+
+
+def print_report(tracker: MemoryTracker, workload: Workload, telegram_calls: Counter, leaks: Dict[str, list]):
+    print()
+    print(f"Нагрузка: {dict(workload.counts)}")
+    print(f"Вызовы Bot API: {dict(telegram_calls)}")
+
+    print(f"\nНаибольший рост памяти с базового снимка (top {tracker.top}):")
+    for diff in tracker.top_growth():
+        frame = diff.traceback[0]
+        print(f"  {diff.size_diff / 1024:+10.1f} KiB {diff.count_diff:+8d} blocks  "
+              f"[{tracker.owner(frame.filename, frame.lineno)}] {frame.filename}:{frame.lineno}")
+
+    print("\nОбъекты (базовый снимок -> последний):")
+    for name, before, after in tracker.object_growth():
+        print(f"  {name:<60} {before:>8} -> {after:>8} ({after - before:+d})")
+
+    print()
+    if not leaks:
+        print(f"Устойчивого роста за последние {tracker.window} снимков не найдено")
+    for component, items in sorted(leaks.items()):
+        kind = "рост данных (ожидаем)" if component in DATA_COMPONENTS else "ВОЗМОЖНАЯ УТЕЧКА"
+        print(f"{kind} [{component}]:")
+        for where, growth in sorted(items, key=lambda item: item[1], reverse=True):
+            print(f"  +{growth}  {where}")
+
+
+# ---------------------------------------------------------------------------
+# Прогон
+# ---------------------------------------------------------------------------
+
+async def run(args) -> Dict[str, list]:
+    from aiogram import Bot, Dispatcher
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    from aiogram.enums import ParseMode
+
+    from clock import clock
+    from config import BOT_TOKEN
+    from database import db
+    from events import event_log
+    from handlers import router
+    from payment_handler import setup_payment_routes
+    from payment_reconciler import close_session
+    from subscriber_index import subscriber_index
+    from tools import robokassa_stub, telegram_stub
+    from update_queue import OrderedUpdateMiddleware, update_executor
+
+    if args.dsn:
+        db.db_url = args.dsn
+
+    # Заглушки Telegram и Robokassa
+    telegram_app = telegram_stub.create_stub_app()
+    robokassa_app = robokassa_stub.create_stub_app()
+    runners = []
+    for app, port in ((telegram_app, args.port), (robokassa_app, args.port + 1)):
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        runners.append(runner)
+
+    bot = Bot(token=BOT_TOKEN, parse_mode=ParseMode.HTML, session=AiohttpSession(
+        api=TelegramAPIServer.from_base(f"http://127.0.0.1:{args.port}")
+    ))
+    dispatcher = Dispatcher(disable_fsm=True)  # как в main.py
+    dispatcher.update.outer_middleware(OrderedUpdateMiddleware(update_executor))
+    dispatcher.include_router(router)
+
+    clock.set(clock.now())
+    await db.init_db()
+    subscriber_index.load(await db.get_active_subscribers())
+    event_log.start()
+
+    payment_app = web.Application()
+    setup_payment_routes(payment_app, bot)
+    runner = web.AppRunner(payment_app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", args.port + 2).start()
+    runners.append(runner)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGINT, stop.set)
+
+    tracker = MemoryTracker(args.window, args.min_growth_kb, args.min_objects, args.top,
+                            models_are_data=not args.dsn)
+    tracemalloc.start(args.frames)
+    started = time.monotonic()
+    deadline = started + args.duration
+    next_snapshot = started + args.warmup_seconds
+    leaks: Dict[str, list] = {}
+    try:
+        async with aiohttp.ClientSession() as http:
+            workload = Workload(args, bot, dispatcher, http, robokassa_app)
+            while not stop.is_set() and time.monotonic() < deadline:
+                await workload.round()
+                if time.monotonic() >= next_snapshot:
+                    gauges = tracker.take(collect_gauges())
+                    print(format_gauges(time.monotonic() - started, gauges), flush=True)
+                    next_snapshot = time.monotonic() + args.snapshot_seconds
+                await asyncio.sleep(0)
+            if tracker.baseline is None:
+                print("Прогон короче прогрева (--warmup-seconds): снимков нет")
+                return leaks
+            leaks = tracker.leaks()
+            print_report(tracker, workload, telegram_app['calls'], leaks)
+    finally:
+        tracemalloc.stop()
+        loop.remove_signal_handler(signal.SIGINT)
+        await event_log.stop()
+        await close_session()
+        await bot.session.close()
+        for runner in runners:
+            await runner.cleanup()
+        await db.close()
+        clock.reset()
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            json.dump({
+                "counts": workload.counts,
+                "gauges": tracker.gauges,
+                "leaks": {component: [list(item) for item in items] for component, items in leaks.items()},
+            }, output, ensure_ascii=False, indent=2)
+    return leaks
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Длительный прогон бота с поиском утечек памяти (tracemalloc)")
+    duration = parser.add_mutually_exclusive_group()
+    duration.add_argument("--hours", type=float)
+    duration.add_argument("--minutes", type=float)
+    parser.add_argument("--dsn", help="PostgreSQL (отдельная база); по умолчанию in-memory хранилище")
+    parser.add_argument("--users", type=int, default=2000, help="пользователей в смеси апдейтов")
+    parser.add_argument("--updates-per-round", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50, help="апдейтов обрабатывается одновременно")
+    parser.add_argument("--paid-share", type=float, default=0.6, help="доля счетов, оплаченных с webhook'ом")
+    parser.add_argument("--lost-share", type=float, default=0.1,
+                        help="доля счетов, оплаченных без webhook'а (подтверждает сверка)")
+    parser.add_argument("--tick-minutes", type=float, default=60, help="сдвиг виртуального времени за раунд")
+    parser.add_argument("--warmup-seconds", type=float, default=120, help="прогрев до базового снимка")
+    parser.add_argument("--snapshot-seconds", type=float, default=300)
+    parser.add_argument("--window", type=int, default=6, help="снимков подряд с ростом для признака утечки")
+    parser.add_argument("--min-growth-kb", type=int, default=64, help="порог роста места выделения за окно")
+    parser.add_argument("--min-objects", type=int, default=500, help="порог роста числа объектов типа за окно")
+    parser.add_argument("--frames", type=int, default=10, help="глубина стека tracemalloc")
+    parser.add_argument("--top", type=int, default=20)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="записать снимки и найденные утечки в JSON")
+    args = parser.parse_args()
+    args.duration = args.hours * 3600 if args.hours else (args.minutes or 60) * 60
+
+    # Хранилище и адреса заглушек выбираются при импорте модулей бота
+    configure_offline_environment()
+    if args.dsn:
+        os.environ["DB_BACKEND"] = "postgres"
+    os.environ["ROBOKASSA_OPSTATE_URL"] = f"http://127.0.0.1:{args.port + 1}{OPSTATE_PATH}"
+    os.environ.setdefault("ADMIN_IDS", str(ADMIN_ID))
+
+    leaks = asyncio.run(run(args))
+    if any(component not in DATA_COMPONENTS for component in leaks):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
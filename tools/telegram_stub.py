@@ -0,0 +1,73 @@
+"""
+ЛОКАЛЬНАЯ ЗАГЛУШКА TELEGRAM BOT API
+
+В отличие от FakeBot (tools/fakes.py), работает на уровне HTTP: настоящий
+aiogram.Bot отправляет запросы через свою aiohttp-сессию, ответы проходят
+разбор в объекты aiogram. Нужна там, где проверяется весь путь запроса -
+например, в длительном прогоне tools/soak.py.
+
+Методы, которыми пользуется бот, отвечают правдоподобными объектами
+(Message, ChatInviteLink, ChatMember); остальные - True.
+app['calls']: метод -> число вызовов.
+
+Бот направляется на заглушку так:
+    Bot(token, session=AiohttpSession(api=TelegramAPIServer.from_base("http://127.0.0.1:8082")))
+"""
+import time
+from collections import Counter
+from itertools import count
+from aiohttp import web
+
+STUB_BOT = {"id": 1, "is_bot": True, "first_name": "Stub", "username": "stub_bot"}
+
+
+def _chat_id(value: str) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return abs(hash(value)) % 10 ** 9
+
+
+def create_stub_app() -> web.Application:
+    """Приложение-заглушка: POST /bot{token}/{method}"""
+    app = web.Application()
+    calls = Counter()
+    message_ids = count(1)
+    app['calls'] = calls
+
+    def message(params) -> dict:
+        return {
+            "message_id": next(message_ids),
+            "date": int(time.time()),
+            "chat": {"id": _chat_id(params.get("chat_id")), "type": "private"},
+            "from": STUB_BOT,
+            "text": params.get("text", ""),
+        }
+
+    results = {
+        "getme": lambda params: STUB_BOT,
+        "sendmessage": message,
+        "senddocument": message,
+        "getchat": lambda params: {"id": _chat_id(params.get("chat_id")), "type": "channel", "title": "Stub"},
+        "getchatmember": lambda params: {
+            "status": "member",
+            "user": {"id": _chat_id(params.get("user_id")), "is_bot": False, "first_name": "Stub"},
+        },
+        "createchatinvitelink": lambda params: {
+            "invite_link": f"https://t.me/+stub{_chat_id(params.get('chat_id'))}",
+            "creator": STUB_BOT,
+            "creates_join_request": params.get("creates_join_request") == "true",
+            "is_primary": False,
+            "is_revoked": False,
+        },
+    }
+
+    async def api_method(request):
+        method = request.match_info["method"].lower()
+        calls[method] += 1
+        params = await request.post()
+        result = results[method](params) if method in results else True
+        return web.json_response({"ok": True, "result": result})
+
+    app.router.add_post("/bot{token}/{method}", api_method)
+    return app
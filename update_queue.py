@@ -0,0 +1,197 @@
+"""
+ОЧЕРЕДЬ АПДЕЙТОВ: ПОРЯДОК ПО ПОЛЬЗОВАТЕЛЮ, ПАРАЛЛЕЛЬНО МЕЖДУ ПОЛЬЗОВАТЕЛЯМИ
+
+aiogram в polling запускает задачу на каждый апдейт и не ждет ее: апдейты
+выполняются без ограничения числа и без порядка. Два быстрых нажатия одного
+пользователя могут обработаться в обратном порядке, а всплеск апдейтов - занять
+весь пул соединений БД.
+
+OrderedUpdateMiddleware (outer middleware Dispatcher) пропускает апдейт
+через KeyedExecutor:
+- апдейты с одним ключом (бот, пользователь) выполняются строго в порядке
+  получения: следующий ждет окончания предыдущего;
+- одновременно выполняется не больше UPDATE_CONCURRENCY апдейтов, остальные
+  ждут свободного слота;
+- освободившийся слот получает сначала кнопка оплаты (pay_*), потом
+  остальные апдейты в порядке поступления (UPDATE_PRIORITIZE_PAYMENTS).
+
+Апдейт, ждущий предыдущего апдейта того же пользователя, слот не занимает.
+Долгие команды администратора (/import_users, /check_expired, /reconcile)
+только запускают фоновую задачу (jobs.py) и не держат очередь и слот.
+Метрики ожидания - update_executor.summary() в /profile.
+"""
+import asyncio
+import heapq
+import time
+from collections import Counter
+from itertools import count
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+from config import UPDATE_CONCURRENCY, UPDATE_PRIORITIZE_PAYMENTS
+
+# Приоритеты слотов: меньше - раньше
+PAYMENT_PRIORITY = 0
+DEFAULT_PRIORITY = 1
+PRIORITY_NAMES = {PAYMENT_PRIORITY: "payment", DEFAULT_PRIORITY: "default"}
+# Префиксы callback_data кнопок оплаты
+PAYMENT_CALLBACK_PREFIXES = ("pay_",)
+
+
+class KeyedExecutor:
+    """Выполнение по очереди для каждого ключа с общим лимитом и приоритетом слотов"""
+
+    def __init__(self, max_concurrent: int):
+        self.max_concurrent = max_concurrent
+        # Ключ -> future окончания последнего принятого апдейта с этим ключом
+        self._tails: Dict[Hashable, asyncio.Future] = {}
+        # Ожидающие слота: (приоритет, номер, future)
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._sequence = count()
+        self.active = 0
+        self.waiting = 0
+        self.max_active = 0
+        self.max_waiting = 0
+        self.completed = 0
+        # Ожидание предыдущего апдейта того же ключа и ожидание слота (секунды)
+        self.key_wait_total = 0.0
+        self.key_wait_max = 0.0
+        self.key_waits = 0
+        self.slot_wait_total: Counter = Counter()
+        self.slot_wait_max: Dict[int, float] = {}
+        self.slot_waits: Counter = Counter()
+
+    async def run(self, key: Optional[Hashable], priority: int, call: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Выполнить call() после предыдущих вызовов с тем же ключом (key=None - без порядка)
+
+        Место в очереди ключа занимается синхронно, до первого await, поэтому
+        порядок вызовов run() и есть порядок выполнения.
+        """
+        previous, done = None, None
+        if key is not None:
+            previous = self._tails.get(key)
+            done = self._tails[key] = asyncio.get_running_loop().create_future()
+        try:
+            if previous is not None and not previous.done():
+                started = time.perf_counter()
+                await asyncio.shield(previous)
+                waited = time.perf_counter() - started
+                self.key_waits += 1
+                self.key_wait_total += waited
+                self.key_wait_max = max(self.key_wait_max, waited)
+
+            await self._acquire(priority)
+            try:
+                return await call()
+            finally:
+                self._release()
+                self.completed += 1
+        finally:
+            if done is not None:
+                if previous is not None and not previous.done():
+                    # Отменен, не дождавшись очереди: следующий ждет и предыдущий апдейт
+                    previous.add_done_callback(lambda _: self._finish(key, done))
+                else:
+                    self._finish(key, done)
+
+    def _finish(self, key: Hashable, done: asyncio.Future):
+        done.set_result(None)
+        if self._tails.get(key) is done:
+            del self._tails[key]
+
+    async def _acquire(self, priority: int):
+        if self.active < self.max_concurrent and not self.waiting:
+            self._take_slot()
+            return
+
+        started = time.perf_counter()
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), waiter))
+        self.waiting += 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Слот уже передан этому апдейту - возвращаем его следующему
+                self._release()
+            else:
+                self.waiting -= 1
+            raise
+
+        waited = time.perf_counter() - started
+        self.slot_waits[priority] += 1
+        self.slot_wait_total[priority] += waited
+        self.slot_wait_max[priority] = max(self.slot_wait_max.get(priority, 0.0), waited)
+
+    def _take_slot(self):
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+
+    def _release(self):
+        """Отдать слот первому ожидающему по приоритету или освободить его"""
+        self.active -= 1
+        while self._waiters:
+            _, _, waiter = heapq.heappop(self._waiters)
+            if not waiter.done():
+                self.waiting -= 1
+                self._take_slot()
+                waiter.set_result(None)
+                return
+
+    def summary(self) -> str:
+        key_average = self.key_wait_total / self.key_waits if self.key_waits else 0.0
+        lines = [
+            f"Апдейты: выполнено {self.completed}, сейчас {self.active} из {self.max_concurrent} "
+            f"(макс. {self.max_active}), ждут слота {self.waiting} (макс. {self.max_waiting}), "
+            f"пользователей в очереди {len(self._tails)}",
+            f"Ожидание своего предыдущего апдейта: {self.key_waits} раз, "
+            f"среднее {key_average * 1000:.0f} мс, макс. {self.key_wait_max * 1000:.0f} мс",
+        ]
+        for priority, name in PRIORITY_NAMES.items():
+            waits = self.slot_waits[priority]
+            average = self.slot_wait_total[priority] / waits if waits else 0.0
+            lines.append(
+                f"Ожидание слота ({name}): {waits} раз, среднее {average * 1000:.0f} мс, "
+                f"макс. {self.slot_wait_max.get(priority, 0.0) * 1000:.0f} мс"
+            )
+        return "\n".join(lines)
+
+
+def update_key(data: Dict[str, Any]) -> Optional[Hashable]:
+    """
+    Ключ порядка апдейта: бот и пользователь (без пользователя - чат)
+
+    Заявки на вступление ключуются пользователем, а не каналом: заявки разных
+    пользователей в один канал выполняются параллельно.
+    """
+    user, chat = data.get("event_from_user"), data.get("event_chat")
+    if user is not None:
+        return data["bot"].id, user.id
+    if chat is not None:
+        return data["bot"].id, chat.id
+    return None
+
+
+def update_priority(update: Update) -> int:
+    callback = update.callback_query
+    if UPDATE_PRIORITIZE_PAYMENTS and callback is not None and callback.data \
+            and callback.data.startswith(PAYMENT_CALLBACK_PREFIXES):
+        return PAYMENT_PRIORITY
+    return DEFAULT_PRIORITY
+
+
+class OrderedUpdateMiddleware(BaseMiddleware):
+    """Outer middleware Dispatcher: апдейт выполняется через KeyedExecutor"""
+
+    def __init__(self, executor: KeyedExecutor):
+        self.executor = executor
+
+    async def __call__(self, handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]], event: Update,
+                       data: Dict[str, Any]) -> Any:
+        return await self.executor.run(update_key(data), update_priority(event), lambda: handler(event, data))
+
+
+# Глобальный исполнитель апдейтов всех ботов процесса
+update_executor = KeyedExecutor(UPDATE_CONCURRENCY)
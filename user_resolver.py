@@ -0,0 +1,117 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+from aiogram import Bot
+from database import db
+from throttling import telegram_limiter, call_with_retry
+from config import (
+    RESOLVE_CONCURRENCY, RESOLVE_CACHE_SIZE, RESOLVE_CACHE_TTL, RESOLVE_NEGATIVE_CACHE_TTL
+)
+
+
+class UsernameCache:
+    """
+    LRU-кэш username -> telegram_id с разным временем жизни записей
+
+    Найденные пользователи (positive) хранятся RESOLVE_CACHE_TTL секунд,
+    ненайденные (negative, значение None) - RESOLVE_NEGATIVE_CACHE_TTL секунд,
+    чтобы повторный импорт того же списка не обращался к Telegram снова.
+    """
+
+    def __init__(self, max_size: int, ttl: int, negative_ttl: int):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._items: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def get(self, username: str):
+        """Вернуть (найдено в кэше, telegram_id или None)"""
+        item = self._items.get(username)
+        if item is None:
+            return False, None
+        telegram_id, expires_at = item
+        if expires_at < time.monotonic():
+            del self._items[username]
+            return False, None
+        self._items.move_to_end(username)
+        return True, telegram_id
+
+    def set(self, username: str, telegram_id: Optional[int]):
+        ttl = self.ttl if telegram_id is not None else self.negative_ttl
+        self._items[username] = (telegram_id, time.monotonic() + ttl)
+        self._items.move_to_end(username)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+
+username_cache = UsernameCache(RESOLVE_CACHE_SIZE, RESOLVE_CACHE_TTL, RESOLVE_NEGATIVE_CACHE_TTL)
+
+
+def normalize_username(identifier: str) -> str:
+    """Убрать @ и привести username к нижнему регистру (username в Telegram регистронезависимы)"""
+    return identifier.lstrip('@').lower()
+
+
+async def _resolve_via_telegram(bot: Bot, username: str, semaphore: asyncio.Semaphore) -> Optional[int]:
+    """
+    Получить telegram_id через Bot API
+
+    Это работает только если:
+    - Пользователь хотя бы раз писал боту (/start)
+    - ИЛИ пользователь находится в общем чате/канале с ботом
+    """
+    async with semaphore:
+        try:
+            chat = await call_with_retry(telegram_limiter, lambda: bot.get_chat(f"@{username}"))
+            return chat.id if hasattr(chat, 'id') else None
+        except Exception:
+            return None
+
+
+async def resolve_user_identifiers(bot: Bot, identifiers: List[str]) -> Dict[str, Optional[int]]:
+    """
+    Разрешить список идентификаторов (ID или @username) в telegram_id
+
+    Порядок разрешения username:
+    1. Кэш (включая ранее ненайденные)
+    2. Таблица users - один запрос на весь список
+    3. Bot API get_chat - только для промахов, параллельно с ограничением RESOLVE_CONCURRENCY
+
+    Returns:
+        Словарь {исходный идентификатор: telegram_id или None}
+    """
+    result: Dict[str, Optional[int]] = {}
+    pending: Dict[str, List[str]] = {}  # username -> исходные идентификаторы
+
+    for identifier in identifiers:
+        if identifier.isdigit():
+            result[identifier] = int(identifier)
+            continue
+        username = normalize_username(identifier)
+        cached, telegram_id = username_cache.get(username)
+        if cached:
+            result[identifier] = telegram_id
+        else:
+            pending.setdefault(username, []).append(identifier)
+
+    if pending:
+        found = await db.get_user_ids_by_usernames(list(pending))
+        misses = [username for username in pending if username not in found]
+
+        if misses:
+            semaphore = asyncio.Semaphore(RESOLVE_CONCURRENCY)
+            resolved = await asyncio.gather(*[
+                _resolve_via_telegram(bot, username, semaphore) for username in misses
+            ])
+            found.update(zip(misses, resolved))
+
+        for username, originals in pending.items():
+            telegram_id = found.get(username)
+            username_cache.set(username, telegram_id)
+            for identifier in originals:
+                result[identifier] = telegram_id
+            if telegram_id is None:
+                print(f"Не удалось разрешить username {originals[0]}: пользователь не найден или не взаимодействовал с ботом")
+
+    return result